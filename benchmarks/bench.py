@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Benchmarks - Measures the instrumentation overhead of sh-instrument.sh against plain bash.
+
+Every benchmark is a script that is run (alternately) with `bash`, with
+`sh-instrument.sh --preprocess_only`, and with `sh-instrument.sh` several times,
+together with `sh-instrument.sh --preprocess_only` on an empty script (the startup
+of sh-instrument.sh and of the preprocessor). Each benchmark reports the median,
+p95 and minimum of the times (in seconds) of `bash`, `pash`, `startup` and
+`preprocess_only`, and of the overhead `ratio` of sh-instrument.sh to bash. From
+the minimum times, which are the least disturbed by the load of the machine, it
+also reports:
+
+  preprocess     the time of preprocessing the script, minus the startup
+  run_overhead   the time of sh-instrument.sh, minus the time of preprocessing the
+                 script and the time of bash, which is what the runtime adds to it
+
+There are three suites:
+
+  micro   the scripts in benchmarks/micro (JIT entry cost, loops, nesting, background jobs)
+  tests   the scripts in tests/ (run from a copy, since they write files next to them)
+  bash    the *.tests scripts in tests/bash_tests (slow)
+
+The results are written as JSON. Given a baseline (a previous result file),
+the run fails if the preprocessing time or the run overhead of a benchmark
+exceeds the one in the baseline both by more than the tolerance and by more than
+the minimum delta. Overhead ratios are not compared: the bash time of most
+benchmarks is a few ms, so their ratios mostly measure the startup of the
+preprocessor and change a lot between unchanged runs.
+"""
+
+import sys
+import os
+import argparse
+import glob
+import json
+import math
+import shlex
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PASH_TOP = os.path.dirname(BENCHMARKS_DIR)
+TESTS_DIR = os.path.join(PASH_TOP, "tests")
+BASH_TESTS_DIR = os.path.join(TESTS_DIR, "bash_tests")
+
+SUITES = ["micro", "tests", "bash"]
+DEFAULT_SUITES = ["micro", "tests"]
+
+## The test runners are not benchmarks themselves
+EXCLUDED_TESTS = {"run.sh", "run_bash_tests.sh"}
+
+## Exit code that marks a run that timed out
+TIMEOUT_EXIT_CODE = 124
+
+## Preprocessing an empty script measures the startup of sh-instrument.sh
+STARTUP_BENCHMARK_NAME = "startup"
+
+
+def log(*args):
+    print(*args, file=sys.stderr, flush=True)
+
+
+class Benchmark:
+    """A script that is run from a directory with some arguments"""
+
+    def __init__(self, name, script, cwd, args=None):
+        self.name = name
+        self.script = script
+        self.cwd = cwd
+        self.args = [] if args is None else args
+
+
+def suite_benchmarks(suite, work_dir):
+    if suite == "micro":
+        scripts = sorted(glob.glob(os.path.join(BENCHMARKS_DIR, "micro", "*.sh")))
+    elif suite == "tests":
+        ## The tests write their outputs (and temporary files) next to them
+        tests_dir = os.path.join(work_dir, "tests")
+        shutil.copytree(
+            TESTS_DIR, tests_dir, ignore=shutil.ignore_patterns("bash_tests", "output")
+        )
+        scripts = sorted(
+            script
+            for script in glob.glob(os.path.join(tests_dir, "*.sh"))
+            if os.path.basename(script) not in EXCLUDED_TESTS
+        )
+    else:
+        scripts = sorted(glob.glob(os.path.join(BASH_TESTS_DIR, "*.tests")))
+    return [
+        Benchmark(f"{suite}/{os.path.basename(script)}", script, os.path.dirname(script))
+        for script in scripts
+    ]
+
+
+def run_once(command, benchmark, timeout):
+    """Runs a benchmark once and returns its (wall time in seconds, exit code)"""
+    ## The bash test suite calls its helper scripts with $THIS_SH
+    env = dict(os.environ, THIS_SH="bash")
+    start_time = time.perf_counter()
+    try:
+        completed = subprocess.run(
+            command + [benchmark.script] + benchmark.args,
+            cwd=benchmark.cwd,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=timeout,
+        )
+        exit_code = completed.returncode
+    except subprocess.TimeoutExpired:
+        exit_code = TIMEOUT_EXIT_CODE
+    return time.perf_counter() - start_time, exit_code
+
+
+## The nearest-rank percentile
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(values):
+    return {
+        "median": statistics.median(values),
+        "p95": percentile(values, 95),
+        "min": min(values),
+    }
+
+
+def run_benchmark(benchmark, bash_command, pash_command, repeat, warmup, timeout):
+    """Runs a benchmark with both shells and returns its result (None if it timed out)"""
+    preprocess_command = pash_command + ["--preprocess_only"]
+    startup_benchmark = Benchmark(STARTUP_BENCHMARK_NAME, os.devnull, benchmark.cwd)
+    for _ in range(warmup):
+        run_once(bash_command, benchmark, timeout)
+        run_once(preprocess_command, benchmark, timeout)
+        run_once(pash_command, benchmark, timeout)
+
+    times = {key: [] for key in ["bash", "pash", "startup", "preprocess_only", "ratio"]}
+    exit_codes = set()
+    for _ in range(repeat):
+        ## The shells alternate so that all of them see the same changes in machine load
+        bash_time, bash_exit_code = run_once(bash_command, benchmark, timeout)
+        startup_time, _ = run_once(preprocess_command, startup_benchmark, timeout)
+        preprocess_time, preprocess_exit_code = run_once(preprocess_command, benchmark, timeout)
+        pash_time, pash_exit_code = run_once(pash_command, benchmark, timeout)
+        if TIMEOUT_EXIT_CODE in (bash_exit_code, preprocess_exit_code, pash_exit_code):
+            return None
+        times["bash"].append(bash_time)
+        times["pash"].append(pash_time)
+        times["startup"].append(startup_time)
+        times["preprocess_only"].append(preprocess_time)
+        times["ratio"].append(pash_time / bash_time)
+        exit_codes.add((bash_exit_code, pash_exit_code))
+
+    return {
+        **{key: summarize(values) for key, values in times.items()},
+        "preprocess": min(times["preprocess_only"]) - min(times["startup"]),
+        "run_overhead": min(times["pash"]) - min(times["preprocess_only"]) - min(times["bash"]),
+        ## Benchmarks whose exit codes differ are probably not running the same way
+        "exit_codes_match": all(bash_code == pash_code for bash_code, pash_code in exit_codes),
+    }
+
+
+## The times that are compared with the baseline, in seconds
+GATED_TIMES = {"preprocess": "preprocessing time", "run_overhead": "run overhead"}
+
+
+def check_baseline(results, baseline, tolerance, min_delta):
+    """Returns the regressions of the results with respect to the baseline"""
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        baseline_result = baseline["benchmarks"].get(name)
+        if baseline_result is None:
+            continue
+        for key, description in GATED_TIMES.items():
+            ## Baselines from before the times were measured have nothing to compare
+            if key not in baseline_result:
+                continue
+            time_s, baseline_time_s = result[key], baseline_result[key]
+            ## The run overhead can be negative, so the delta is compared separately
+            if (
+                time_s > baseline_time_s + abs(baseline_time_s) * tolerance
+                and time_s - baseline_time_s > min_delta
+            ):
+                regressions.append(
+                    f"{name}: {description} {time_s:.3f}s exceeds baseline {baseline_time_s:.3f}s"
+                )
+    return regressions
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments for the benchmarks"""
+    parser = argparse.ArgumentParser(
+        description="Measure the instrumentation overhead of sh-instrument.sh against bash",
+        prog="bench.py"
+    )
+
+    parser.add_argument(
+        "--suite",
+        choices=SUITES,
+        action="append",
+        default=None,
+        help=f"A suite to run (can be given several times); defaults to {' and '.join(DEFAULT_SUITES)}"
+    )
+
+    parser.add_argument(
+        "--filter",
+        default=None,
+        help="Only run the benchmarks whose name contains this string"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of measured runs of every benchmark with each shell; defaults to 5"
+    )
+
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=1,
+        help="Number of unmeasured runs before measuring; defaults to 1"
+    )
+
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30,
+        help="Seconds after which a run is stopped and its benchmark skipped; defaults to 30"
+    )
+
+    parser.add_argument(
+        "--pash-args",
+        default="",
+        help="Extra arguments for sh-instrument.sh, e.g., '--granularity block'"
+    )
+
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Path to write the JSON results to; defaults to stdout"
+    )
+
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="A previous JSON result; fail if a preprocessing time or run overhead exceeds it "
+        "by more than the tolerance and the minimum delta"
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative increase of the times over the baseline; defaults to 0.25"
+    )
+
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=0.1,
+        help="Allowed increase of the times over the baseline in seconds, below which "
+        "changes are noise; defaults to 0.1"
+    )
+
+    return parser.parse_args(argv)
+
+
+def run_suites(suites, args, bash_command, pash_command, work_dir, results):
+    """Runs the benchmarks of some suites and adds them to the results"""
+    for suite in suites:
+        for benchmark in suite_benchmarks(suite, work_dir):
+            if args.filter is not None and args.filter not in benchmark.name:
+                continue
+            result = run_benchmark(
+                benchmark, bash_command, pash_command, args.repeat, args.warmup, args.timeout
+            )
+            if result is None:
+                log(f"{benchmark.name}: timed out, skipping")
+                results["skipped"].append(benchmark.name)
+                continue
+            log(
+                f"{benchmark.name}: bash {result['bash']['median']:.3f}s, "
+                f"pash {result['pash']['median']:.3f}s "
+                f"(preprocessing {result['preprocess']:.3f}s, "
+                f"run overhead {result['run_overhead']:.3f}s), "
+                f"overhead ratio {result['ratio']['median']:.2f} (p95 {result['ratio']['p95']:.2f})"
+            )
+            results["benchmarks"][benchmark.name] = result
+
+
+def main(argv=None):
+    """Main entry point for the benchmarks"""
+    args = parse_args(argv)
+    suites = DEFAULT_SUITES if args.suite is None else args.suite
+    bash_command = ["bash"]
+    pash_command = [os.path.join(PASH_TOP, "sh-instrument.sh")] + shlex.split(args.pash_args)
+
+    results = {
+        "pash_args": args.pash_args,
+        "repeat": args.repeat,
+        "benchmarks": {},
+        "skipped": [],
+    }
+    work_dir = tempfile.mkdtemp(prefix="bench.")
+    try:
+        run_suites(suites, args, bash_command, pash_command, work_dir, results)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results_json = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(results_json)
+    else:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(results_json + "\n")
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = check_baseline(results, baseline, args.tolerance, args.min_delta)
+        for regression in regressions:
+            log(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
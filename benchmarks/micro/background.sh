@@ -0,0 +1,14 @@
+## Many background jobs, each of which is its own region
+n=${1:-50}
+i=0
+while [ "$i" -lt "$n" ]; do
+    sleep 0 &
+    i=$((i + 1))
+done
+wait
+i=0
+while [ "$i" -lt "$n" ]; do
+    { echo "$i" | cat > /dev/null; } &
+    i=$((i + 1))
+done
+wait
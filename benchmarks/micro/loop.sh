@@ -0,0 +1,7 @@
+## A loop that enters the JIT on every iteration (unless loops are stubbed whole)
+n=${1:-1000}
+i=0
+while [ "$i" -lt "$n" ]; do
+    echo "$i" > /dev/null
+    i=$((i + 1))
+done
@@ -0,0 +1,30 @@
+## Regions nested deep in `if` and `case` commands
+n=${1:-100}
+i=0
+while [ "$i" -lt "$n" ]; do
+    if [ "$i" -ge 0 ]; then
+        case "$((i % 3))" in
+            0)
+                if [ -n "$i" ]; then
+                    case "$i" in
+                        *[02468]) echo even > /dev/null ;;
+                        *) echo odd > /dev/null ;;
+                    esac
+                else
+                    echo never
+                fi
+                ;;
+            1)
+                if [ "$i" != x ]; then
+                    if true; then
+                        echo one > /dev/null
+                    fi
+                fi
+                ;;
+            *)
+                echo other > /dev/null
+                ;;
+        esac
+    fi
+    i=$((i + 1))
+done
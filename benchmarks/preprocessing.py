@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Preprocessing benchmarks - Measures the throughput of the preprocessor on large synthetic scripts.
+
+Every benchmark generates a script with a given shape and size, and preprocesses
+it in-process (parsing, transforming, and unparsing it) several times. The
+transformation (replacing regions with calls to the runtime) is timed separately
+from parsing and unparsing, and its throughput is reported in AST nodes per second.
+
+  flat        many top-level commands (pipelines, assignments, and small blocks)
+  nested_if   `if` statements nested in each other
+  and_chain   a long `&&` list
+  case        a `case` with many branches, each with a nested `if`
+  sequence    a `{ ...; }` group with a long `;` list
+
+The results are written as JSON. Given a baseline (a previous result file),
+the run fails if the transformation throughput of a benchmark is lower than the
+one in the baseline by more than the tolerance.
+"""
+
+import sys
+import os
+import argparse
+import io
+import json
+import statistics
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PASH_TOP = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(PASH_TOP, "preprocessor"))
+
+import preprocessor
+from parse import parse_shell_to_asts, write_asts_to_shell_file, SourceLines
+from util import walk_commands
+
+## The runtime that the stubs source
+RUNTIME_EXECUTABLE = os.path.join(PASH_TOP, "jit.sh")
+
+
+def flat_script(size):
+    lines = []
+    for i in range(size):
+        if i % 3 == 0:
+            lines.append(f"cat input{i}.txt | grep -v x{i} | sort | uniq -c")
+        elif i % 3 == 1:
+            lines.append(f"x{i}=$((x{i - 1} + {i}))")
+        else:
+            lines.append(f'if [ "$x{i - 1}" -gt {i} ]; then echo big; else echo small; fi')
+    return "\n".join(lines) + "\n"
+
+
+def nested_if_script(size):
+    return (
+        "".join(f'if [ "$n" -ne {i} ]; then\n  echo level {i}\n' for i in range(size))
+        + "fi\n" * size
+    )
+
+
+def and_chain_script(size):
+    return " &&\n".join(f"echo {i} | cat" for i in range(size)) + "\n"
+
+
+def case_script(size):
+    branches = "".join(
+        f'  {i}) if [ -f "f{i}" ]; then cat "f{i}" | wc -l; else echo {i}; fi ;;\n'
+        for i in range(size)
+    )
+    return f'case "$1" in\n{branches}esac\n'
+
+
+def sequence_script(size):
+    return "{\n" + "".join(f"  echo {i} | tr a-z A-Z;\n" for i in range(size)) + "}\n"
+
+
+## The default size of every shape is limited by the recursion of the parser and unparser
+SHAPES = {
+    "flat": (flat_script, 20000),
+    "nested_if": (nested_if_script, 150),
+    "and_chain": (and_chain_script, 200),
+    "case": (case_script, 2000),
+    "sequence": (sequence_script, 200),
+}
+
+
+def log(*args):
+    print(*args, file=sys.stderr, flush=True)
+
+
+def count_nodes(ast_objects):
+    return sum(
+        1 for ast, _text, _before, _after in ast_objects for _node in walk_commands(ast)
+    )
+
+
+def run_benchmark(script_path, region_mode, repeat):
+    """Preprocesses a script several times and returns the times of every stage"""
+    times = {"parse": [], "transform": [], "unparse": []}
+    nodes = None
+    with open(script_path, "rb") as script_file:
+        source_lines = SourceLines(script_file.read())
+    with tempfile.TemporaryDirectory() as region_dir:
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            ast_objects = parse_shell_to_asts(script_path)
+            parse_end_time = time.perf_counter()
+            if nodes is None:
+                nodes = count_nodes(ast_objects)
+
+            trans_state = preprocessor.TransformationState(
+                preprocessor.TransformationOptions(
+                    runtime_executable=RUNTIME_EXECUTABLE, region_mode=region_mode
+                ),
+                region_dir=region_dir,
+            )
+            transform_start_time = time.perf_counter()
+            preprocessed_asts = preprocessor.preprocess_asts(ast_objects, trans_state)
+            transform_end_time = time.perf_counter()
+            output_file = io.BytesIO()
+            output_file.write(trans_state.get_region_definitions().encode("utf-8"))
+            write_asts_to_shell_file(preprocessed_asts, output_file, source_lines)
+            unparse_end_time = time.perf_counter()
+
+            times["parse"].append(parse_end_time - start_time)
+            times["transform"].append(transform_end_time - transform_start_time)
+            times["unparse"].append(unparse_end_time - transform_end_time)
+
+    transform_median = statistics.median(times["transform"])
+    return {
+        "nodes": nodes,
+        "parse_s": statistics.median(times["parse"]),
+        "transform_s": transform_median,
+        "unparse_s": statistics.median(times["unparse"]),
+        "transform_nodes_per_s": nodes / transform_median if transform_median > 0 else None,
+    }
+
+
+def check_baseline(results, baseline, tolerance):
+    """Returns the regressions of the results with respect to the baseline"""
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        baseline_result = baseline["benchmarks"].get(name)
+        if baseline_result is None or baseline_result["nodes"] != result["nodes"]:
+            continue
+        throughput = result["transform_nodes_per_s"]
+        baseline_throughput = baseline_result["transform_nodes_per_s"]
+        if throughput < baseline_throughput * (1 - tolerance):
+            regressions.append(
+                f"{name}: transformation throughput {throughput:.0f} nodes/s "
+                f"is below baseline {baseline_throughput:.0f} nodes/s"
+            )
+    return regressions
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments for the preprocessing benchmarks"""
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of the preprocessor on large synthetic scripts",
+        prog="preprocessing.py"
+    )
+
+    parser.add_argument(
+        "--shape",
+        choices=list(SHAPES),
+        action="append",
+        default=None,
+        help="A script shape to benchmark (can be given several times); defaults to all of them"
+    )
+
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplies the default size of every script; defaults to 1"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of measured runs of every benchmark; defaults to 5"
+    )
+
+    parser.add_argument(
+        "--region-mode",
+        choices=["file", "function"],
+        default="file",
+        help="The region mode to preprocess with; defaults to file"
+    )
+
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Path to write the JSON results to; defaults to stdout"
+    )
+
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="A previous JSON result; fail if a throughput is below it by more than the tolerance"
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative decrease of the throughputs from the baseline; defaults to 0.25"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main entry point for the preprocessing benchmarks"""
+    args = parse_args(argv)
+    shapes = list(SHAPES) if args.shape is None else args.shape
+
+    results = {
+        "region_mode": args.region_mode,
+        "repeat": args.repeat,
+        "benchmarks": {},
+    }
+    with tempfile.TemporaryDirectory() as script_dir:
+        for shape in shapes:
+            generate, default_size = SHAPES[shape]
+            size = max(1, int(default_size * args.scale))
+            script_path = os.path.join(script_dir, f"{shape}.sh")
+            with open(script_path, "w", encoding="utf-8") as script_file:
+                script_file.write(generate(size))
+
+            name = f"{shape}/{size}"
+            result = run_benchmark(script_path, args.region_mode, args.repeat)
+            log(
+                f"{name}: {result['nodes']} nodes, parse {result['parse_s']:.3f}s, "
+                f"transform {result['transform_s']:.3f}s "
+                f"({result['transform_nodes_per_s']:.0f} nodes/s), "
+                f"unparse {result['unparse_s']:.3f}s"
+            )
+            results["benchmarks"][name] = result
+
+    results_json = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(results_json)
+    else:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(results_json + "\n")
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = check_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            log(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
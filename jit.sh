@@ -1,52 +1,215 @@
 #!/bin/bash
 
-## Assumes the following variable is set:
-## __jit_script_to_execute: the script that was stubbed
+## Assumes the following variables are set:
+## __jit_region_id: the id of the region that was stubbed
+## __jit_script_to_execute: the script that was stubbed (unless the preprocessor
+##   emitted regions as functions, in which case `__jit_region_<id>` sets
+##   `__jit_region_code` to the text of the region with every byte escaped as \xHH)
+## __jit_defer_exit_status (optional): if set, the region saves its exit status in
+##   `__jit_region_exit_status`, jit.sh returns 0, and the stub sets the exit status
+##   afterwards with `__jit_set_region_exit_status`
+## __jit_region_lines (optional): the source lines of the region, which are
+##   recorded in the profile if `PASH_PROFILE` is set (see runtime/jit_profile.sh)
+## __jit_parallel_job (optional): if set, the region is in a group of independent regions
+##   that run in parallel (see runtime/jit_scheduler.sh)
+## __jit_memo (optional): if set, the region is deterministic, and it replays an earlier
+##   execution with the same inputs (`__jit_memo_inputs`, `__jit_memo_variables`) from
+##   `PASH_MEMO_DIR` instead of running (see runtime/jit_memo.sh)
+
+## PASH_JIT_HOT_THRESHOLD (optional): the number of executions after which a region
+##   bypasses the JIT (see runtime/jit_tiers.sh)
+## PASH_TRACE_DIR (optional): the directory of the trace records of every process
+##   (see runtime/jit_trace.sh)
+## PASH_JIT_JOBS (optional): the maximum number of regions of a group that run as
+##   background jobs at a time (see runtime/jit_scheduler.sh)
+## PASH_REGION_INDEX (optional): the index of the metadata of every region by region id,
+##   e.g., its AST and the variables that it reads and writes (see preprocessor/region_index.py)
+## PASH_ANALYSIS_DIR (optional): the directory of the FIFOs of the analysis server, which
+##   sees every region before and after it runs (see runtime/jit_analysis.sh)
+## PASH_ACCOUNTING_DIR (optional): the directory of the resource records of every process,
+##   e.g., the CPU time and the bytes read by every region (see runtime/jit_accounting.sh)
+
+## First save the exit status and the shell state that the region runs in
+export __jit_previous_exit_status="$?"
+__jit_region_state="$-:${*@Q}"
+
+##
+## (0) Run independent regions in parallel, and bypass the JIT for hot regions
+##
+
+## A region of a group runs (through this script) as a background job, or runs and then
+## waits for the jobs of the group if it is the last one, unless it cannot run in parallel
+if [ -n "${__jit_parallel_job-}" ]; then
+    declare -F __jit_parallel_can_run > /dev/null || source "$RUNTIME_DIR/jit_scheduler.sh"
+    declare -F __jit_set_from_to > /dev/null || source "$RUNTIME_DIR/jit_set_from_to.sh"
+    if __jit_parallel_can_run "$__jit_parallel_job"; then
+        if [[ $__jit_parallel_job == spawn:* ]]; then
+            unset __jit_parallel_job
+            __jit_parallel_throttle
+            { __jit_set_exit_status "$__jit_previous_exit_status"; source "${BASH_SOURCE[0]}"; } &
+            __jit_parallel_started "$!"
+            return 0
+        fi
+        unset __jit_parallel_job
+        __jit_set_exit_status "$__jit_previous_exit_status"
+        source "${BASH_SOURCE[0]}"
+        __jit_parallel_wait "$?"
+        return
+    fi
+    unset __jit_parallel_job
+    __jit_parallel_wait
+fi
+
+## A region that is hot in this state is only counted and runs directly, like in (4) and (5)
+declare -F __jit_region_done > /dev/null || source "$RUNTIME_DIR/jit_tiers.sh"
+if [[ ${__jit_region_bypass[$__jit_region_id]-} == "$__jit_region_state" ]]; then
+    __jit_region_executions[$__jit_region_id]+=1
+    export JIT_REGION_ID="$__jit_region_id"
+    export SCRIPT_TO_EXECUTE="${__jit_script_to_execute-}"
+    unset __jit_region_id __jit_script_to_execute __jit_defer_exit_status __jit_region_lines \
+        __jit_memo __jit_memo_inputs __jit_memo_outputs __jit_memo_variables
+    if [ -z "$SCRIPT_TO_EXECUTE" ]; then
+        "__jit_region_$JIT_REGION_ID"
+        __jit_region_command="eval \$'$__jit_region_code'"
+        unset __jit_region_code
+    else
+        __jit_region_command='source "${SCRIPT_TO_EXECUTE}"'
+    fi
+    __jit_region_depth=${#BASH_SOURCE[@]}
+    __jit_saved_region_id[__jit_region_depth]=$JIT_REGION_ID
+    if __jit_set_exit_status "$__jit_previous_exit_status"
+    then
+        eval "$__jit_region_command"
+    else
+        eval "$__jit_region_command"
+    fi
+    __jit_runtime_final_status="$?"
+    unset __jit_region_command
+    if [ -n "${PASH_TRACE_DIR-}" ]; then
+        JIT_REGION_ID=${__jit_saved_region_id[${#BASH_SOURCE[@]}]}
+        declare -F __jit_trace > /dev/null || source "$RUNTIME_DIR/jit_trace.sh"
+        __jit_trace bypass "$EPOCHREALTIME" "${__jit_region_exit_status-$__jit_runtime_final_status}"
+    fi
+    ## A region that defers its exit status saves it last, i.e., after any nested region
+    if [[ -v __jit_region_exit_status ]]; then
+        __jit_runtime_final_status="$__jit_region_exit_status"
+        unset __jit_region_exit_status
+        return 0
+    fi
+    return "$__jit_runtime_final_status"
+fi
 
 ##
 ## (1) Save shell state
 ##
 
-## First save the state of the shell
-export __jit_previous_exit_status="$?"
 export __jit_previous_set_status=$-
-source "$RUNTIME_DIR/jit_set_from_to.sh" "$__jit_previous_set_status" "${DEFAULT_SET_STATE:-huB}"
+__jit_region_start=$EPOCHREALTIME
+## The state switching and loop hook functions are only loaded once per shell
+declare -F __jit_set_from_to > /dev/null || source "$RUNTIME_DIR/jit_set_from_to.sh"
+declare -F __jit_loop_iteration > /dev/null || source "$RUNTIME_DIR/jit_loop_iteration.sh"
+__jit_set_from_to "$__jit_previous_set_status" "${DEFAULT_SET_STATE:-huB}"
 __jit_redir_output echo "$$: (1) Pre-ec, pre-set, jit-set: ($__jit_previous_exit_status, $__jit_previous_set_status, $-)"
 
 ##
 ## (2) Prepare for dynamic analysis
 ##
+
+export JIT_REGION_ID="$__jit_region_id"
+export SCRIPT_TO_EXECUTE="${__jit_script_to_execute-}"
+__jit_region_defers_exit_status="${__jit_defer_exit_status-}"
+__jit_profile_lines="${__jit_region_lines-}"
+## Clean up JIT-specific environment variables to prevent leakage
+unset __jit_region_id __jit_script_to_execute __jit_defer_exit_status __jit_region_lines
+if [ -z "$SCRIPT_TO_EXECUTE" ]; then
+    "__jit_region_$JIT_REGION_ID"
+    ## The region text is only unescaped when evaluated, so it never appears in `set` output
+    __jit_region_command="eval \$'$__jit_region_code'"
+else
+    __jit_region_command='source "${SCRIPT_TO_EXECUTE}"'
+fi
+
+## Count the execution (which can make the region hot)
+__jit_region_warm_up "$JIT_REGION_ID"
+
+## Record that the region was entered
+if [ -n "${PASH_TRACE_DIR-}" ]; then
+    declare -F __jit_trace > /dev/null || source "$RUNTIME_DIR/jit_trace.sh"
+    __jit_trace enter "$__jit_region_start" "$__jit_previous_exit_status"
+fi
+
+## Send the region to the analysis server, which can mark it done
+if [ -n "${PASH_ANALYSIS_DIR-}" ]; then
+    declare -F __jit_analysis_pre > /dev/null || source "$RUNTIME_DIR/jit_analysis.sh"
+    __jit_analysis_pre
+fi
+
+## Replay a memoized region if it ran with the same inputs before, or store it after it runs
+if [ -n "${__jit_memo-}" ]; then
+    if [ -n "${PASH_MEMO_DIR-}" ]; then
+        declare -F __jit_memo_prepare > /dev/null || source "$RUNTIME_DIR/jit_memo.sh"
+        __jit_memo_prepare
+    fi
+    unset __jit_memo __jit_memo_inputs __jit_memo_outputs __jit_memo_variables
+fi
+
 ##
-## Your analysis on $__jit_script_to_execute here!
+## Your analysis on region $JIT_REGION_ID ($SCRIPT_TO_EXECUTE or $__jit_region_code) here!
+## (or in Python, in the analysis server, see preprocessor/analysis_server.py)
+## Its metadata is in the entry of $JIT_REGION_ID in $PASH_REGION_INDEX (if it is set), so it
+## does not need to parse the region again.
+## Call `__jit_region_done` once it does not need to see more executions of the region.
 ##
 
+## Read the resource counters right before the region (see runtime/jit_accounting.sh)
+if [ -n "${PASH_ACCOUNTING_DIR-}" ]; then
+    declare -F __jit_accounting_start > /dev/null || source "$RUNTIME_DIR/jit_accounting.sh"
+    __jit_accounting_start
+fi
+
 ##
 ## (3) & (4) Restore state and execute script
 ##
 
 ## Run the script
-export SCRIPT_TO_EXECUTE="$__jit_script_to_execute"
-## Clean up JIT-specific environment variables to prevent leakage
-unset __jit_script_to_execute
 export __jit_current_set_state=$-
-source "$RUNTIME_DIR/jit_set_from_to.sh" "$__jit_current_set_state" "$__jit_previous_set_status"
+__jit_set_from_to "$__jit_current_set_state" "$__jit_previous_set_status"
 __jit_redir_output echo "$$: (3) Restore (pre-ec,pre-set): ($__jit_previous_exit_status,$-)"
 
-## Execute the script
-__jit_redir_output echo "$$: (4) Will execute script in ${SCRIPT_TO_EXECUTE}:"
-__jit_redir_output cat "${SCRIPT_TO_EXECUTE}"
+## Execute the script (whose text is only logged with more debugging, since it is written on every execution)
+__jit_redir_output echo "$$: (4) Will execute region $JIT_REGION_ID (${SCRIPT_TO_EXECUTE:-function})"
+if [ "${PASH_DEBUG_LEVEL:-0}" -ge 2 ]; then
+    if [ -z "$SCRIPT_TO_EXECUTE" ]; then
+        __jit_redir_output printf '%b\n' "$__jit_region_code"
+    else
+        __jit_redir_output cat "${SCRIPT_TO_EXECUTE}"
+    fi
+fi
+
+## Regions that run nested in this one (e.g., in the functions that it calls) overwrite its
+## variables, so the ones that are used after it are saved by the depth of the source stack,
+## which is larger in nested regions.
+__jit_region_depth=${#BASH_SOURCE[@]}
+__jit_saved_region_id[__jit_region_depth]=$JIT_REGION_ID
+__jit_saved_region_lines[__jit_region_depth]=$__jit_profile_lines
+__jit_saved_region_start[__jit_region_depth]=$__jit_region_start
+__jit_saved_exit_status[__jit_region_depth]=$__jit_previous_exit_status
+__jit_saved_defers_exit_status[__jit_region_depth]=$__jit_region_defers_exit_status
+__jit_saved_accounting[__jit_region_depth]=${__jit_accounting_before-}
 
-## Note: We run the `exit` in a checked position so that we don't simply exit when we are in `set -e`.
-if (exit "$__jit_previous_exit_status")
+## Note: We set the exit status in a checked position so that we don't simply exit when we are in `set -e`.
+__jit_region_body_start=$EPOCHREALTIME
+__jit_saved_body_start[__jit_region_depth]=$__jit_region_body_start
+if __jit_set_exit_status "$__jit_previous_exit_status"
 then 
 {
-    ## This works w.r.t. arguments because source does not change them if there are no arguments
+    ## This works w.r.t. arguments because source (and eval) do not change them if there are no arguments
     ## being given.
-    source "${SCRIPT_TO_EXECUTE}"
+    eval "$__jit_region_command"
 }
 else 
 {
-    source "${SCRIPT_TO_EXECUTE}"
+    eval "$__jit_region_command"
 }
 fi
 
@@ -57,22 +220,73 @@ fi
 ##
 
 ## Save the state after execution
-export __jit_runtime_final_status="$?"
+__jit_runtime_final_status="$?"
+__jit_region_body_end=$EPOCHREALTIME
+__jit_region_depth=${#BASH_SOURCE[@]}
+JIT_REGION_ID=${__jit_saved_region_id[__jit_region_depth]}
+__jit_profile_lines=${__jit_saved_region_lines[__jit_region_depth]}
+__jit_region_start=${__jit_saved_region_start[__jit_region_depth]}
+__jit_region_body_start=${__jit_saved_body_start[__jit_region_depth]}
+__jit_previous_exit_status=${__jit_saved_exit_status[__jit_region_depth]}
+__jit_region_defers_exit_status=${__jit_saved_defers_exit_status[__jit_region_depth]}
+__jit_accounting_before=${__jit_saved_accounting[__jit_region_depth]}
+if [ -n "$__jit_region_defers_exit_status" ]; then
+    __jit_runtime_final_status="$__jit_region_exit_status"
+    unset __jit_region_exit_status
+fi
 export __jit_previous_set_status=$-
-source "$RUNTIME_DIR/jit_set_from_to.sh" "$__jit_previous_set_status" "${DEFAULT_SET_STATE:-huB}"
+unset __jit_region_command __jit_region_code
+__jit_set_from_to "$__jit_previous_set_status" "${DEFAULT_SET_STATE:-huB}"
 __jit_redir_output echo "$$: (5) Script exited with ec: $__jit_runtime_final_status"
+if [ -n "${PASH_ACCOUNTING_DIR-}" ]; then
+    __jit_accounting_end
+fi
+
+## A memoized region only contains commands, so no other region ran since it was prepared
+if [ -n "${__jit_memo_entry-}" ]; then
+    __jit_memo_store "$__jit_runtime_final_status"
+fi
 
 ##
 ## (6) Your analysis post execution here
 ##
 
+## Record the timing of the region
+if [ -n "${PASH_PROFILE-}" ]; then
+    declare -F __jit_profile_region > /dev/null || source "$RUNTIME_DIR/jit_profile.sh"
+    __jit_profile_region
+fi
+
+## Record the resources that the region used
+if [ -n "${PASH_ACCOUNTING_DIR-}" ]; then
+    __jit_accounting_region
+fi
+
+## Record when the region started and ended
+if [ -n "${PASH_TRACE_DIR-}" ]; then
+    __jit_trace body "$__jit_region_body_start" "$__jit_previous_exit_status" \
+        exit "$__jit_region_body_end" "$__jit_runtime_final_status"
+fi
+
+## Send the exit status and the timing of the region to the analysis server
+if [ -n "${PASH_ANALYSIS_DIR-}" ]; then
+    __jit_analysis_post
+fi
+
 ##
 ## (7) Restore final state before exit
 ##
 
 ## Set the shell state before exiting
 __jit_redir_output echo "$$: (7) Reverting set (from,to): ($-,$__jit_previous_set_status)"
-source "$RUNTIME_DIR/jit_set_from_to.sh" "$-" "$__jit_previous_set_status"
+__jit_set_from_to "$-" "$__jit_previous_set_status"
 
 ## Set the exit code
-(exit "$__jit_runtime_final_status")
+## Note: If the region's exit status can come from a failure that was ignored under `set -e`
+##       (e.g., `false && :`), returning it here would exit, so the stub sets it instead.
+if [ -n "$__jit_region_defers_exit_status" ]; then
+    unset __jit_region_defers_exit_status
+else
+    unset __jit_region_defers_exit_status
+    __jit_set_exit_status "$__jit_runtime_final_status"
+fi
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Accounting report - Ranks the regions of a run by the resources that they used.
+
+The records are written by `sh-instrument.sh --accounting FILE` (which writes this
+report to FILE when the script exits), one file per process, with one tab-separated
+record per line:
+
+  S <script>                                                        the script
+  A <region id> <first>-<last> <body> <user> <system> <faults> <ns processes> <read> <written> <max rss>
+
+for every region execution, with its time in us, its CPU time in clock ticks, the bytes
+that it read and wrote, and the peak RSS of its processes in KiB. See
+runtime/jit_accounting.sh for how they are measured.
+"""
+
+import sys
+import os
+import argparse
+
+from profile_report import print_table, read_source_lines, source_of
+
+SORT_KEYS = ["cpu", "body", "processes", "io", "faults", "rss"]
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+class RegionAccount:
+    """The resources used by every execution of a region"""
+
+    def __init__(self, region_id, lines):
+        self.region_id = region_id
+        self.lines = lines
+        self.executions = 0
+        self.body = 0
+        self.user = 0
+        self.system = 0
+        self.faults = 0
+        ## The processes started in the pid namespace while the region ran, or None if they
+        ## were not counted (see runtime/jit_accounting.sh)
+        self.processes = 0
+        self.read = 0
+        self.written = 0
+        ## The peak RSS in KiB of the processes of the region, or None if it is unknown
+        self.max_rss = 0
+
+    def add_execution(self, body, user, system, faults, processes, read, written, max_rss):
+        self.executions += 1
+        self.body += body
+        self.user += user
+        self.system += system
+        self.faults += faults
+        if processes is None or self.processes is None:
+            self.processes = None
+        else:
+            self.processes += processes
+        self.read += read
+        self.written += written
+        if max_rss is None or self.max_rss is None:
+            self.max_rss = None
+        else:
+            self.max_rss = max(self.max_rss, max_rss)
+
+    def cpu(self):
+        """The CPU time in seconds"""
+        return (self.user + self.system) / CLOCK_TICKS
+
+    def cpu_ratio(self):
+        """The CPU time per wall time of the region, which is over 1 if it ran in parallel"""
+        return self.cpu() / (self.body / 1e6) if self.body > 0 else 0.0
+
+    def sort_key(self, sort_by):
+        if sort_by == "body":
+            return (self.body, self.cpu())
+        if sort_by == "processes":
+            return (self.processes or 0, self.cpu())
+        if sort_by == "io":
+            return (self.read + self.written, self.cpu())
+        if sort_by == "faults":
+            return (self.faults, self.cpu())
+        if sort_by == "rss":
+            return (self.max_rss or 0, self.cpu())
+        return (self.cpu(), self.body)
+
+
+def record_files(paths):
+    """The files of the given paths, with the files in the given directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def optional_int(field):
+    """The value of a field that is `-` if it was not measured"""
+    return None if field == "-" else int(field)
+
+
+def read_records(paths):
+    """Returns the script (None if unknown) and the account of every region"""
+    script = None
+    regions = {}
+    for path in record_files(paths):
+        with open(path, encoding="utf-8", errors="replace") as record_file:
+            for line_number, line in enumerate(record_file, start=1):
+                fields = line.rstrip("\n").split("\t")
+                try:
+                    if fields[0] == "S" and len(fields) == 2:
+                        script = None if fields[1] == "-" else fields[1]
+                    elif fields[0] == "A" and len(fields) == 11:
+                        region_id, lines = fields[1], fields[2]
+                        body, user, system, faults = (int(field) for field in fields[3:7])
+                        processes = optional_int(fields[7])
+                        read, written = int(fields[8]), int(fields[9])
+                        max_rss = optional_int(fields[10])
+                        if region_id not in regions:
+                            regions[region_id] = RegionAccount(region_id, lines)
+                        regions[region_id].add_execution(
+                            body, user, system, faults, processes, read, written, max_rss
+                        )
+                    else:
+                        raise ValueError(line.rstrip("\n"))
+                except ValueError:
+                    ## A record can be cut short if the script was killed while writing it
+                    print(
+                        f"Skipping malformed record on line {line_number} of {path}",
+                        file=sys.stderr,
+                    )
+    return script, list(regions.values())
+
+
+def format_seconds(seconds):
+    return f"{seconds:.3f}"
+
+
+def format_optional(value):
+    return "-" if value is None else str(value)
+
+
+def print_report(script, regions, sort_by="cpu", top=None, output=sys.stdout):
+    source_lines = read_source_lines(script)
+    regions = sorted(regions, key=lambda region: region.sort_key(sort_by), reverse=True)
+    counted = [region.processes for region in regions if region.processes is not None]
+    peaks = [region.max_rss for region in regions if region.max_rss is not None]
+
+    print(f"Script: {script if script is not None else '-'}", file=output)
+    print(
+        f"Regions: {len(regions)}, "
+        f"executions: {sum(region.executions for region in regions)}, "
+        f"cpu: {format_seconds(sum(region.cpu() for region in regions))} s, "
+        f"processes (pid namespace): {sum(counted) if counted else '-'}, "
+        f"read: {sum(region.read for region in regions)} B, "
+        f"written: {sum(region.written for region in regions)} B, "
+        f"max rss: {f'{max(peaks)} KiB' if peaks else '-'}",
+        file=output,
+    )
+    print(file=output)
+    header = [
+        "region", "lines", "executions", "body_s", "user_s", "system_s", "cpu_%",
+        "ns_processes", "faults", "read_B", "written_B", "max_rss_KiB", "source",
+    ]
+    rows = [
+        [
+            region.region_id,
+            region.lines,
+            str(region.executions),
+            format_seconds(region.body / 1e6),
+            format_seconds(region.user / CLOCK_TICKS),
+            format_seconds(region.system / CLOCK_TICKS),
+            f"{100 * region.cpu_ratio():.1f}",
+            format_optional(region.processes),
+            str(region.faults),
+            str(region.read),
+            str(region.written),
+            format_optional(region.max_rss),
+            source_of(region, source_lines),
+        ]
+        for region in regions[:top]
+    ]
+    print_table(header, rows, output)
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments for the accounting report"""
+    parser = argparse.ArgumentParser(
+        description="Rank the regions of a run by CPU time, time, processes, I/O, page faults, "
+        "or peak RSS",
+        prog="accounting_report.py"
+    )
+
+    parser.add_argument(
+        "records",
+        nargs="+",
+        help="Files (or directories of files) with the records of `sh-instrument.sh --accounting`"
+    )
+
+    parser.add_argument(
+        "--sort",
+        choices=SORT_KEYS,
+        default="cpu",
+        help="Rank regions by their CPU time, time, processes started in the pid namespace, "
+        "bytes read and written, page faults, or peak RSS; defaults to cpu"
+    )
+
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=None,
+        help="Only report the first N regions"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main entry point for the accounting report"""
+    args = parse_args(argv)
+    script, regions = read_records(args.records)
+    print_report(script, regions, sort_by=args.sort, top=args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+An example analysis for the analysis server (see analysis_server.py), which counts the
+executions, failures and time of every region, and prints a summary to stderr once the
+script exited:
+
+  sh-instrument.sh --analysis preprocessor/analysis_example.py script.sh
+
+A region is done (i.e., it bypasses the JIT, see runtime/jit_tiers.sh) once it ran
+DONE_AFTER times, since its summary would hardly change after that. With a region
+index (see `--region_index`), the summary also shows the lines and the commands of
+every region.
+"""
+
+import sys
+
+DONE_AFTER = 100
+
+
+class RegionSummary:
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.executions = 0
+        self.failures = 0
+        self.seconds = 0.0
+
+    def describe(self, region_id):
+        if self.metadata is None:
+            return region_id
+        lines = self.metadata["lines"]
+        lines = f"lines {lines[0]}-{lines[1]}" if lines is not None else "no lines"
+        return f"{region_id} ({lines}: {' '.join(self.metadata['commands']) or '-'})"
+
+
+## The summary of every region (by region id)
+summaries = {}
+
+
+def pre_region(event):
+    summary = summaries.get(event.region_id)
+    return summary is not None and summary.executions >= DONE_AFTER
+
+
+def post_region(event):
+    summary = summaries.get(event.region_id)
+    if summary is None:
+        ## The metadata is only looked up once per region
+        summary = summaries[event.region_id] = RegionSummary(event.metadata())
+    summary.executions += 1
+    if event.status != 0:
+        summary.failures += 1
+    summary.seconds += event.duration() or 0.0
+
+
+def sort_key(item):
+    region_id, summary = item
+    if summary.metadata is not None and summary.metadata["lines"] is not None:
+        return (0, summary.metadata["lines"][0], region_id)
+    return (1, 0, region_id)
+
+
+def finish():
+    for region_id, summary in sorted(summaries.items(), key=sort_key):
+        print(
+            f"{summary.describe(region_id)}: {summary.executions} executions, "
+            f"{summary.failures} failed, {summary.seconds:.6f}s",
+            file=sys.stderr,
+        )
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Analysis server - Runs a Python analysis of the regions of a script in one long-lived
+process, so that jit.sh does not start an interpreter on every region execution.
+
+`sh-instrument.sh --analysis FILE` starts the server for the run, in a fresh directory
+(`PASH_ANALYSIS_DIR`) with a `requests` FIFO that every process of the script writes
+its events to, and every process that runs a region reads the replies to its events from
+its own FIFO, named after its pid. Both FIFOs are opened once per process by the client
+in runtime/jit_analysis.sh. Events are single tab-separated lines (so that the ones of
+concurrent processes are never interleaved):
+
+  pre   <reply> <pid> <region id> <exit status before it> <time> <region file or empty>
+  post  <reply> <pid> <region id> <exit status>           <time> <start time of its body>
+
+where `pre` is sent before the region runs (step (2) in jit.sh) and `post` after it ran
+(step (6)), and <reply> is 1 if the client waits for the reply, which is a line with
+`done` if the analysis does not need to see more executions of the region (the client
+then calls `__jit_region_done`, which only `pre` events can do, since it records the shell
+state that the region runs in), and `ok` otherwise. `pre` events always wait, and so do
+`post` events unless `--analysis_async` (`PASH_ANALYSIS_ASYNC`) is given, in which case
+the client goes on without waiting for the analysis, and the server handles the events
+that are queued in the FIFO in batches. `finish` is sent by sh-instrument.sh once the
+script exited.
+
+The analysis is a Python file with any of the following functions:
+
+  pre_region(event)   before a region runs; returns True if the region is done
+  post_region(event)  after a region ran
+  finish()            once the script exited
+
+where `event` is a RegionEvent. See analysis_example.py for an example.
+"""
+
+import argparse
+import importlib.util
+import logging
+import os
+import signal
+import sys
+import traceback
+
+from region_index import RegionIndex
+
+REQUESTS_FIFO = "requests"
+READY_FIFO = "ready"
+READ_BUFFER_SIZE = 65536
+
+
+def log(*args, level=1):
+    """Simple logging function"""
+    if level >= 1:
+        message = " ".join([str(a) for a in args])
+        logging.info(f"PaSh: {message}")
+
+
+class RegionEvent:
+    """An execution of a region, before (`pre`) or after (`post`) it runs"""
+
+    __slots__ = ("kind", "pid", "region_id", "status", "time", "script", "start", "server")
+
+    def __init__(self, kind, pid, region_id, status, time, argument, server):
+        self.kind = kind
+        self.pid = pid
+        self.region_id = region_id
+        ## The exit status before the region (`pre`) or of the region (`post`)
+        self.status = status
+        self.time = time
+        ## The file of the region (None if regions are functions, see --region_mode)
+        self.script = (argument or None) if kind == "pre" else None
+        ## When the body of the region started (`post` only)
+        self.start = parse_time(argument) if kind == "post" else None
+        self.server = server
+
+    def duration(self):
+        """The time that the body of the region took (`post` only)"""
+        return self.time - self.start if self.start is not None else None
+
+    def metadata(self):
+        """The entry of the region in the region index (None without an index)"""
+        return self.server.region_metadata(self.region_id)
+
+
+## EPOCHREALTIME has a 6-digit microsecond fraction (its separator depends on the locale)
+def parse_time(string):
+    return float(f"{string[:-7]}.{string[-6:]}") if len(string) > 7 else None
+
+
+class AnalysisServer:
+    def __init__(self, directory, analysis, region_index_path=None):
+        self.directory = directory
+        self.analysis = analysis
+        self.region_index_path = region_index_path
+        self.region_index = None
+        ## The replies FIFO of every process (by pid), opened once
+        self.reply_fds = {}
+        self.events = 0
+
+    def region_metadata(self, region_id):
+        if self.region_index_path is None:
+            return None
+        if self.region_index is None:
+            self.region_index = RegionIndex(self.region_index_path)
+        return self.region_index.get(region_id)
+
+    def serve(self):
+        """Handles events until `finish`"""
+        ## Opened for reading and writing, so that reading never sees the end of the file
+        ## when no process of the script has it open
+        requests_fd = os.open(os.path.join(self.directory, REQUESTS_FIFO), os.O_RDWR)
+        self.signal_ready()
+        pending = b""
+        try:
+            while True:
+                data = os.read(requests_fd, READ_BUFFER_SIZE)
+                *lines, pending = (pending + data).split(b"\n")
+                for line in lines:
+                    if line == b"finish":
+                        return
+                    self.handle(line.decode("utf-8", errors="replace"))
+        finally:
+            os.close(requests_fd)
+            for fd in self.reply_fds.values():
+                os.close(fd)
+            call_analysis(self.analysis, "finish")
+            if self.region_index is not None:
+                self.region_index.close()
+            log(f"Analysis server handled {self.events} events")
+
+    def signal_ready(self):
+        ## sh-instrument.sh waits for this line before it runs the script
+        with open(os.path.join(self.directory, READY_FIFO), "w") as ready:
+            ready.write("ready\n")
+
+    def handle(self, line):
+        fields = line.split("\t")
+        if len(fields) != 7 or fields[0] not in ("pre", "post"):
+            log(f"Ignoring malformed event: {line!r}")
+            return
+        kind, reply, pid, region_id, status, time, argument = fields
+        event = RegionEvent(kind, int(pid), region_id, int(status), parse_time(time), argument, self)
+        self.events += 1
+        try:
+            done = call_analysis(self.analysis, f"{kind}_region", event) and kind == "pre"
+        except Exception:
+            ## A failing analysis must not leave the client waiting for its reply
+            traceback.print_exc()
+            done = False
+        if reply == "1":
+            self.reply(event.pid, b"done\n" if done else b"ok\n")
+
+    def reply(self, pid, message):
+        fd = self.reply_fds.get(pid)
+        try:
+            if fd is None:
+                ## The client keeps its FIFO open, so this never blocks
+                fd = os.open(os.path.join(self.directory, str(pid)), os.O_WRONLY | os.O_NONBLOCK)
+                os.set_blocking(fd, True)
+                self.reply_fds[pid] = fd
+            os.write(fd, message)
+        except OSError as e:
+            log(f"Cannot reply to process {pid}: {e}")
+            if fd is not None:
+                os.close(fd)
+                self.reply_fds.pop(pid, None)
+
+
+def load_analysis(path):
+    """Loads the analysis in a Python file as a module"""
+    spec = importlib.util.spec_from_file_location("analysis", path)
+    analysis = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(analysis)
+    return analysis
+
+
+## Calls a function of the analysis if it defines it, and returns whether it returned True
+def call_analysis(analysis, name, *args):
+    function = getattr(analysis, name, None)
+    return function is not None and function(*args) is True
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments for the analysis server"""
+    parser = argparse.ArgumentParser(
+        description="Serve the region events of a script to a Python analysis",
+        prog="analysis_server.py"
+    )
+
+    parser.add_argument(
+        "analysis",
+        help="Path to the Python file of the analysis"
+    )
+
+    parser.add_argument(
+        "--dir",
+        required=True,
+        help="Directory with the FIFOs of the run (see sh-instrument.sh --analysis)"
+    )
+
+    parser.add_argument(
+        "--region-index",
+        default=os.environ.get("PASH_REGION_INDEX") or None,
+        help="Path to the region index of the script, for RegionEvent.metadata() "
+        "(PASH_REGION_INDEX by default)"
+    )
+
+    parser.add_argument(
+        "-d",
+        "--debug",
+        type=int,
+        default=0,
+        help="Configure debug level; defaults to 0"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main entry point for the analysis server"""
+    args = parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+    if args.debug >= 1:
+        logging.getLogger().setLevel(logging.INFO)
+
+    ## Finish the analysis when stopped with SIGTERM as well as with `finish`
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+
+    server = AnalysisServer(args.dir, load_analysis(args.analysis), args.region_index)
+    log(f"Analysis server listening on: {args.dir}")
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
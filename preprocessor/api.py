@@ -0,0 +1,127 @@
+"""
+Preprocessing API - Preprocesses scripts in memory from Python, without files or processes.
+
+    import api
+
+    result = api.preprocess(b"cat in.txt | sort\\n", runtime="/path/to/jit.sh")
+    result.script    # the preprocessed script (bytes)
+    result.regions   # every Region (by region id), with its text and source lines
+
+The options are the ones of preprocessor.py. Regions are functions of the preprocessed
+script by default, so nothing is written anywhere. With `region_mode="file"`, the stubs
+name region files in `region_dir`, which are only written by `Result.write_region_files()`.
+
+preprocess() can be called from many threads at a time (and preprocess_async() from many
+asyncio tasks): the parsers keep their state in C globals, so only parsing is serialized
+(see parse.PARSER_LOCK), and everything else is per call. Both raise ParsingError if the
+script does not parse, and ValueError if an option is not valid.
+"""
+
+import argparse
+import asyncio
+import io
+
+from cost import CostModel
+from parse import ParsingError, parse_shell_bytes_to_asts
+from policy import InstrumentationPolicy
+from preprocessor import (
+    GRANULARITIES,
+    TransformationOptions,
+    TransformationState,
+    parse_loop_policy,
+    preprocess_parsed_script,
+    region_namespace_of_bytes,
+)
+
+__all__ = ["ParsingError", "Result", "preprocess", "preprocess_async"]
+
+REGION_MODES = ["function", "file"]
+
+
+class Result:
+    """A preprocessed script and its regions"""
+
+    __slots__ = ("script", "regions")
+
+    def __init__(self, script, regions):
+        self.script = script
+        ## Every preprocessor.Region (by region id), in the order of the script
+        self.regions = regions
+
+    def write_region_files(self):
+        """Writes the region files that the stubs name (with region_mode="file")"""
+        for region in self.regions.values():
+            region.write()
+
+
+def preprocess(
+    source,
+    *,
+    runtime,
+    bash=False,
+    region_mode="function",
+    region_dir=None,
+    loop_policy=None,
+    granularity="command",
+    max_region_size=None,
+    policy=None,
+    cost_threshold=None,
+    profile=False,
+    function_bodies=False,
+    parallel=False,
+    memoize=False,
+    instrument_sourced=False,
+):
+    """
+    Preprocesses a script (bytes, or str that is encoded as UTF-8) whose stubs source the
+    runtime (jit.sh). The policy is an InstrumentationPolicy or its JSON (see policy.py).
+    """
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    if region_mode not in REGION_MODES:
+        raise ValueError(f"region_mode must be one of {REGION_MODES}, not {region_mode!r}")
+    if region_mode == "file" and region_dir is None:
+        raise ValueError('region_mode="file" needs a region_dir')
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {GRANULARITIES}, not {granularity!r}")
+    if max_region_size is not None and max_region_size < 1:
+        raise ValueError(f"max_region_size must be positive, not {max_region_size}")
+    if loop_policy is not None:
+        try:
+            loop_policy = parse_loop_policy(loop_policy)
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e)) from e
+    if policy is not None and not isinstance(policy, InstrumentationPolicy):
+        policy = InstrumentationPolicy.from_json(policy)
+
+    regions = {}
+    options = TransformationOptions(
+        runtime_executable=runtime,
+        bash_mode=bash,
+        region_mode=region_mode,
+        loop_policy=loop_policy,
+        granularity=granularity,
+        max_region_size=max_region_size,
+        policy=policy,
+        cost_model=CostModel(cost_threshold) if cost_threshold is not None else None,
+        profile=profile,
+        function_bodies=function_bodies,
+        parallel=parallel,
+        memoize=memoize,
+        instrument_sourced=instrument_sourced,
+    )
+    trans_state = TransformationState(
+        options,
+        region_dir=region_dir,
+        region_namespace=region_namespace_of_bytes(source),
+        regions=regions,
+    )
+    ast_objects = parse_shell_bytes_to_asts(source, bash_mode=bash)
+    output_file = io.BytesIO()
+    preprocess_parsed_script(ast_objects, source, trans_state, output_file)
+    return Result(output_file.getvalue(), regions)
+
+
+async def preprocess_async(source, **options):
+    """preprocess() in a worker thread, so that it does not block the event loop"""
+    return await asyncio.to_thread(preprocess, source, **options)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Batch preprocessor - Preprocesses many scripts in parallel across a pool of workers.
+
+Every worker loads the parsers once and then preprocesses scripts exactly like
+`preprocessor.py`, writing each of them to the same relative path in the output
+directory (and its region files, if any, next to it in `<output>.regions/`).
+A script that fails to preprocess is reported and does not stop the batch.
+"""
+
+import sys
+import os
+import argparse
+import json
+import logging
+import multiprocessing
+import shutil
+import time
+
+import preprocessor
+from parse import warm_up_parsers
+
+## The options of every worker, set when the worker starts
+WORKER_ARGS = None
+
+
+def log(*args, level=1):
+    preprocessor.log(*args, level=level)
+
+
+def read_manifest(manifest_path):
+    """
+    Returns the scripts listed in a manifest (or stdin if it is `-`), one per line,
+    skipping empty lines and `#` comments, e.g., the output of `find . -name '*.sh'`.
+    """
+    if manifest_path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            lines = manifest_file.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+
+def output_path_of(script, root, output_dir):
+    return os.path.join(output_dir, os.path.relpath(os.path.abspath(script), root))
+
+
+def init_worker(args):
+    global WORKER_ARGS
+    WORKER_ARGS = args
+    logging.basicConfig(format="%(message)s")
+    if args.debug >= 1:
+        logging.getLogger().setLevel(logging.INFO)
+    warm_up_parsers()
+
+
+def preprocess_script(job):
+    """Preprocesses a single script in a worker and returns its report entry"""
+    index, script, output_path = job
+    report = {"script": script, "output": output_path}
+    start_time = time.perf_counter()
+    region_dir = None
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        ## The stubs refer to the region files by their absolute paths, so that
+        ## the preprocessed script runs from any directory
+        if WORKER_ARGS.region_mode == "file":
+            region_dir = os.path.abspath(output_path + ".regions")
+            os.makedirs(region_dir, exist_ok=True)
+        with open(output_path, "wb") as output_file:
+            preprocessor.preprocess(
+                script,
+                output_file,
+                preprocessor.transformation_options(WORKER_ARGS),
+                region_dir=region_dir,
+            )
+        report["status"] = "ok"
+    except Exception as e:
+        report["status"] = "failed"
+        report["error"] = f"{type(e).__name__}: {e}"
+        ## Do not leave a partial output behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        if region_dir is not None:
+            shutil.rmtree(region_dir, ignore_errors=True)
+    report["time_ms"] = round((time.perf_counter() - start_time) * 1000, 3)
+    return index, report
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments for the batch preprocessor"""
+    parser = argparse.ArgumentParser(
+        description="Preprocess many shell scripts in parallel",
+        prog="batch.py"
+    )
+
+    parser.add_argument(
+        "scripts",
+        nargs="*",
+        help="Paths of the scripts to preprocess"
+    )
+
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        help="A file (or - for stdin) that lists more scripts to preprocess, one per line"
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        required=True,
+        help="Directory to write the preprocessed scripts to"
+    )
+
+    parser.add_argument(
+        "--root",
+        default=None,
+        help="The directory that the output paths are relative to; "
+        "defaults to the common directory of the scripts"
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes; defaults to the number of cores"
+    )
+
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="Path to write a JSON line per script to, with its status, error, and time"
+    )
+
+    parser.add_argument(
+        "-d",
+        "--debug",
+        type=int,
+        default=0,
+        help="Configure debug level; defaults to 0"
+    )
+
+    preprocessor.add_preprocessing_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main entry point for the batch preprocessor"""
+    args = parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+    if args.debug >= 1:
+        logging.getLogger().setLevel(logging.INFO)
+
+    scripts = list(args.scripts)
+    if args.manifest is not None:
+        scripts += read_manifest(args.manifest)
+    if len(scripts) == 0:
+        log("No scripts to preprocess", level=0)
+        sys.exit(0)
+
+    root = args.root
+    if root is None:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(script)) for script in scripts])
+    output_dir = os.path.abspath(args.output_dir)
+    jobs = [
+        (index, script, output_path_of(script, root, output_dir))
+        for index, script in enumerate(scripts)
+    ]
+
+    log(f"Preprocessing {len(jobs)} scripts with {args.jobs} workers")
+    start_time = time.perf_counter()
+    reports = [None] * len(jobs)
+    with multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(args,)) as pool:
+        for index, report in pool.imap_unordered(preprocess_script, jobs):
+            reports[index] = report
+            if report["status"] != "ok":
+                print(f"Failed to preprocess {report['script']}: {report['error']}", file=sys.stderr)
+    total_time = time.perf_counter() - start_time
+
+    if args.report is not None:
+        with open(args.report, "w", encoding="utf-8") as report_file:
+            for report in reports:
+                report_file.write(json.dumps(report) + "\n")
+
+    failed = sum(1 for report in reports if report["status"] != "ok")
+    print(
+        f"Preprocessed {len(reports) - failed}/{len(reports)} scripts "
+        f"({failed} failed) in {total_time:.3f} s",
+        file=sys.stderr,
+    )
+    sys.exit(1 if failed > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from util import log
+
+## Preprocessed scripts are cached in a directory with one entry per key:
+##
+##   <cache_dir>/<key>/script       the preprocessed script
+##
+## The entry directory is created by the process that preprocesses the script,
+## and the `script` file is renamed into place last, so an entry is complete
+## if and only if its `script` file exists. Cached scripts define their regions
+## as functions instead of sourcing region files, so an entry can be evicted
+## while its script still runs (the lookup copied the script).
+
+ENTRY_SCRIPT = "script"
+LOCK_FILE = ".lock"
+TRASH_PREFIX = ".trash-"
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+## Entries that are still incomplete after this many seconds were abandoned
+## by a crashed preprocessor and can be evicted.
+INCOMPLETE_ENTRY_TIMEOUT = 3600
+
+
+def cache_key(script_bytes, options):
+    """
+    Computes the key of a script given its contents and every preprocessing
+    option that affects the output (including the preprocessor version).
+    """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(script_bytes)
+    return hasher.hexdigest()
+
+
+class PreprocessingCache:
+    """A size-bounded LRU cache of preprocessed scripts shared between processes"""
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key, output_path):
+        """Copies the cached script to `output_path`; returns False on a miss"""
+        entry_dir = self.entry_dir(key)
+        try:
+            shutil.copyfile(os.path.join(entry_dir, ENTRY_SCRIPT), output_path)
+            ## The modification time of the entry directory is its last use
+            os.utime(entry_dir)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def reserve(self, key):
+        """
+        Creates the entry for `key` so that the caller can fill it.
+        Returns False if another process is already filling it.
+        """
+        try:
+            os.mkdir(self.entry_dir(key))
+        except FileExistsError:
+            return False
+        return True
+
+    def abandon(self, key):
+        """Removes a reserved entry that could not be filled"""
+        self.remove_entry(self.entry_dir(key))
+
+    def commit(self, key, script_path):
+        """Completes a reserved entry with a copy of a script and evicts old entries if needed"""
+        entry_dir = self.entry_dir(key)
+        tmp_script = os.path.join(entry_dir, ENTRY_SCRIPT + ".tmp")
+        shutil.copyfile(script_path, tmp_script)
+        os.rename(tmp_script, os.path.join(entry_dir, ENTRY_SCRIPT))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in max_size.
+        The entry for `keep` is never removed, since its script is about to run.
+        """
+        with open(os.path.join(self.cache_dir, LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = []
+            total_size = 0
+            now = time.time()
+            for name in os.listdir(self.cache_dir):
+                entry_dir = os.path.join(self.cache_dir, name)
+                if name.startswith(TRASH_PREFIX):
+                    self.remove_entry(entry_dir)
+                    continue
+                if name == LOCK_FILE or name == keep:
+                    continue
+                try:
+                    last_use = os.stat(entry_dir).st_mtime
+                    complete = os.path.exists(os.path.join(entry_dir, ENTRY_SCRIPT))
+                    size = directory_size(entry_dir)
+                except FileNotFoundError:
+                    continue
+                if not complete:
+                    if now - last_use > INCOMPLETE_ENTRY_TIMEOUT:
+                        self.remove_entry(entry_dir)
+                    continue
+                entries.append((last_use, size, entry_dir))
+                total_size += size
+
+            entries.sort()
+            for _last_use, size, entry_dir in entries:
+                if total_size <= self.max_size:
+                    break
+                log("Evicting preprocessing cache entry:", entry_dir)
+                self.remove_entry(entry_dir)
+                total_size -= size
+
+    def remove_entry(self, entry_dir):
+        ## Entries are first moved out of the way so that concurrent lookups
+        ## never see a partially removed entry.
+        if not os.path.basename(entry_dir).startswith(TRASH_PREFIX):
+            trash_dir = os.path.join(
+                self.cache_dir, f"{TRASH_PREFIX}{os.getpid()}-{os.path.basename(entry_dir)}"
+            )
+            try:
+                os.rename(entry_dir, trash_dir)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    return
+                raise
+            entry_dir = trash_dir
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+
+def directory_size(path):
+    size = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
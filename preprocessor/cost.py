@@ -0,0 +1,195 @@
+import logging
+
+from util import format_arg_chars, line_range_of, log
+from shasta.ast_node import (
+    AstNode,
+    ArgChar,
+    BArgChar,
+    BackgroundNode,
+    CArgChar,
+    CommandNode,
+    CoprocNode,
+    DefunNode,
+    PipeNode,
+    RedirectionNode,
+    SubshellNode,
+)
+
+## A static cost model estimates how long a region takes to run, so that the regions that
+## are cheaper than calling the runtime (e.g., `:`, `shift`, `local x=1`) are left as they
+## are (see `--cost-threshold`). The estimate is in (very rough) microseconds:
+##
+##   a builtin                                BUILTIN_COST
+##   an external command, a function call,    EXTERNAL_COST
+##     or a builtin that runs arbitrary code
+##     or blocks (e.g., `eval`, `read`)
+##   a subshell, i.e., every command in a     FORK_COST
+##     pipeline, `( ... )`, `&`, `$( ... )`
+##   a redirection                            REDIRECTION_COST
+##
+## and everything in a loop (e.g., in `... | while read x; do ...; done`) is counted
+## LOOP_ITERATIONS times per nesting level. Regions are stubbed if their estimated cost
+## is at least the threshold. Calling the runtime costs about a millisecond, so the
+## thresholds that make sense are in the hundreds.
+
+BUILTIN_COST = 1
+EXTERNAL_COST = 1000
+FORK_COST = 300
+REDIRECTION_COST = 20
+LOOP_ITERATIONS = 10
+
+## The builtins that cost BUILTIN_COST. Every other command, including functions and the
+## builtins that can run arbitrary code or block (e.g., `eval`, `source`, `read`, `wait`),
+## costs as much as an external command.
+BUILTINS = {
+    ":", "[", "alias", "bg", "bind", "break", "caller", "cd", "compgen", "complete", "compopt",
+    "continue", "declare", "dirs", "disown", "echo", "enable", "exit", "export", "false", "fc",
+    "getopts", "hash", "help", "history", "jobs", "kill", "let", "local", "logout", "popd",
+    "printf", "pushd", "pwd", "readonly", "return", "set", "shift", "shopt", "test", "times",
+    "trap", "true", "type", "typeset", "ulimit", "umask", "unalias", "unset",
+}
+## Builtins that run the command in their arguments (e.g., `command grep`)
+WRAPPER_BUILTINS = {"builtin", "command"}
+
+LOOP_NODE_NAMES = {"For", "While", "Select", "ArithFor"}
+
+
+class CostEstimate:
+    """The estimated cost of a region, and the features it was estimated from"""
+
+    __slots__ = ("cost", "builtins", "externals", "pipeline_width", "substitutions", "loop_depth")
+
+    def __init__(self):
+        self.cost = 0
+        self.builtins = 0
+        self.externals = 0
+        self.pipeline_width = 1
+        self.substitutions = 0
+        self.loop_depth = 0
+
+    def features(self):
+        return (
+            f"builtins={self.builtins} externals={self.externals} "
+            f"pipeline_width={self.pipeline_width} substitutions={self.substitutions} "
+            f"loop_depth={self.loop_depth}"
+        )
+
+
+class CostModel:
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def to_json(self):
+        return {"threshold": self.threshold}
+
+    def selects(self, ast_node):
+        """Returns whether a region consisting of this AST node is worth stubbing"""
+        estimate = estimate_cost(ast_node)
+        selected = estimate.cost >= self.threshold
+        ## The report is only built when it is logged, since it unparses the region
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            line_range = line_range_of([ast_node])
+            lines = "-" if line_range is None else f"{line_range[0]}-{line_range[1]}"
+            text = " ".join(ast_node.pretty().split())
+            log(
+                f"Cost model: {'stub' if selected else 'skip'} lines {lines}, "
+                f"cost {estimate.cost} ({estimate.features()}): "
+                f"{text if len(text) <= 60 else text[:57] + '...'}"
+            )
+        return selected
+
+
+## Returns the estimated cost of an AST node. It keeps an explicit stack (like walk_commands),
+## with the number of times that every node runs (which grows in loops).
+def estimate_cost(ast_node):
+    estimate = CostEstimate()
+    stack = [(ast_node, 1, 0)]
+    while stack:
+        node, runs, loop_depth = stack.pop()
+        if isinstance(node, DefunNode):
+            ## Defining a function does not run its body
+            estimate.cost += runs * BUILTIN_COST
+            continue
+        if node.NodeName in LOOP_NODE_NAMES:
+            runs, loop_depth = runs * LOOP_ITERATIONS, loop_depth + 1
+            estimate.loop_depth = max(estimate.loop_depth, loop_depth)
+        estimate.cost += runs * node_cost(node, estimate)
+        children, raw_substitutions = ast_children(node)
+        ## What a substitution in a raw word runs is unknown, so it counts as an external command
+        estimate.substitutions += raw_substitutions
+        estimate.cost += runs * raw_substitutions * (FORK_COST + EXTERNAL_COST)
+        for child in children:
+            stack.append((child, runs, loop_depth))
+    return estimate
+
+
+## The cost of a node itself (without its children), which also records its features
+def node_cost(node, estimate):
+    if isinstance(node, CommandNode) and len(node.arguments) > 0:
+        if is_builtin(node.arguments):
+            estimate.builtins += 1
+            return BUILTIN_COST
+        estimate.externals += 1
+        return EXTERNAL_COST
+    if isinstance(node, PipeNode):
+        estimate.pipeline_width = max(estimate.pipeline_width, len(node.items))
+        forks = len(node.items) if len(node.items) > 1 else 0
+        return FORK_COST * (forks + (1 if node.is_background else 0))
+    if isinstance(node, BArgChar):
+        estimate.substitutions += 1
+        return FORK_COST
+    if isinstance(node, (SubshellNode, BackgroundNode, CoprocNode)):
+        return FORK_COST
+    if isinstance(node, RedirectionNode):
+        return REDIRECTION_COST
+    return 0
+
+
+def is_builtin(arguments):
+    for i, argument in enumerate(arguments):
+        ## A command name that is not literal (e.g., `$cmd`) could be anything
+        if not all(isinstance(arg_char, CArgChar) for arg_char in argument):
+            return False
+        name = format_arg_chars(argument)
+        if name in WRAPPER_BUILTINS:
+            continue
+        if i > 0 and name.startswith("-"):
+            continue
+        return name in BUILTINS
+    return True
+
+
+## Returns the nodes nested in an AST node: commands, redirections, assignments, and
+## the characters of arguments (e.g., command substitutions), together with the number
+## of substitutions in its raw words (see count_raw_substitutions).
+def ast_children(node):
+    children = []
+    raw_substitutions = 0
+    values = list(vars(node).values())
+    while values:
+        value = values.pop()
+        if isinstance(value, list) and value and all(isinstance(c, CArgChar) for c in value):
+            raw_substitutions += count_raw_substitutions(value)
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, AstNode) and not (
+            isinstance(value, ArgChar) and not hasattr(value, "arg") and not hasattr(value, "node")
+        ):
+            children.append(value)
+    return children, raw_substitutions
+
+
+## The bash parser keeps words as their raw characters, so their substitutions
+## (`$(...)`, `` `...` ``, `<(...)`, `>(...)`) are only found in the text.
+def count_raw_substitutions(word):
+    if not word[0].bash_mode:
+        return 0
+    text = format_arg_chars(word)
+    return (
+        text.count("$(") - text.count("$((")
+        + text.count("`") // 2
+        + text.count("<(")
+        + text.count(">(")
+    )
@@ -0,0 +1,483 @@
+import posixpath
+import re
+
+from util import format_arg_chars
+from shasta.ast_node import (
+    AArgChar,
+    BArgChar,
+    CArgChar,
+    CommandNode,
+    DupRedirNode,
+    FileRedirNode,
+    HeredocRedirNode,
+    PipeNode,
+    QArgChar,
+    SingleArgRedirNode,
+    VArgChar,
+)
+
+## The effects of a region are the resources that it reads and writes, which decide whether
+## it can run in parallel with the regions next to it (see `--parallel`). The analysis is
+## conservative, and a region has no effects (i.e., it never runs in parallel) unless:
+##
+## - it is a command or a (foreground) pipeline of commands whose effects are known
+##   (see COMMANDS), with literal command names and options,
+## - it changes no shell state, i.e., it has no assignments and no expansions that assign
+##   (`${x:=...}`) or run code (`$(...)`, `$((...))`), and it reads no special parameter
+##   whose value depends on the previous command or on the process (e.g., `$?`, `$!`).
+##
+## Since such regions write no variables, reading variables never makes them depend on
+## each other. The resources are the region's stdin (which a command consumes, so reading
+## it counts as a write), its stdout, and the files in its redirections and operands. A
+## word that is not literal (e.g., `"$f"`, `*.txt`) can be any file, so it is written
+## (since it could also expand to an option that writes). Two regions depend on each other
+## if one writes a resource that the other reads or writes, where a file conflicts with
+## the files in it if it is a directory, and relative and absolute paths always conflict.
+## Writes to stderr are not resources, so the diagnostics of regions that run in parallel
+## can be interleaved.
+
+STDIN = "&0"
+STDOUT = "&1"
+## Any file (e.g., the target of `> "$f"`)
+ANY_FILE = "*"
+
+## Parameters whose value depends on the previous command or on the process
+SPECIAL_PARAMETERS = {"?", "!", "_", "RANDOM", "SRANDOM", "BASHPID", "BASH_SUBSHELL"}
+## Parameter expansions that assign or exit (`${x:=...}`, `${x:?...}`)
+UNSAFE_EXPANSIONS = {"Assign", "Question"}
+## Characters that make a (raw) word expand to something other than itself
+NON_LITERAL_CHARS = set("$`'\"\\*?[]{}~")
+## Substitutions in the raw words of the bash parser, and special parameters in them
+UNSAFE_RAW_WORD = re.compile(
+    r"\$\(|`|<\(|>\(|\$\[|\$\{[^}]*[=?]|"
+    r"\$\{?(?:[?!]|(?:_|RANDOM|SRANDOM|BASHPID|BASH_SUBSHELL)(?![A-Za-z0-9_]))"
+)
+
+
+class CommandSpec:
+    """
+    The effects of a command, given by its options (single letters, with a value or not)
+    and operands: the first `patterns` operands are not files (unless a pattern option
+    is given), and the rest are files that it reads or writes
+    """
+
+    __slots__ = (
+        "flags", "value_options", "operands", "stdin", "output", "patterns",
+        "pattern_options", "read_options", "write_options", "required_flag", "default_operand",
+        "output_operand",
+    )
+
+    def __init__(
+        self,
+        flags="",
+        value_options="",
+        operands="read",
+        stdin="operandless",
+        output=True,
+        patterns=0,
+        pattern_options="",
+        read_options="",
+        write_options="",
+        required_flag=None,
+        default_operand=None,
+        output_operand=None,
+    ):
+        self.flags = flags
+        self.value_options = value_options
+        ## Whether its file operands are read, written, or are not files ("none")
+        self.operands = operands
+        ## When it reads its stdin: "always", "never", "operandless" (if it has no file
+        ## operands), or "dash" (only for a `-` operand, which it reads in every other case)
+        self.stdin = stdin
+        ## Whether it writes to stdout (unless given `-v`)
+        self.output = output
+        self.patterns = patterns
+        self.pattern_options = pattern_options
+        self.read_options = read_options
+        self.write_options = write_options
+        ## An option without which the command has unknown effects (e.g., `gzip -c`)
+        self.required_flag = required_flag
+        ## The file that it reads without file operands (e.g., `ls` lists `.`)
+        self.default_operand = default_operand
+        ## The (0-based) file operand that is written (e.g., `uniq input output`)
+        self.output_operand = output_operand
+
+
+DIGITS = "0123456789"
+CHECKSUMS = CommandSpec(flags="btz")
+COMMANDS = {
+    "basename": CommandSpec(flags="az", value_options="s", operands="none", stdin="never"),
+    "base64": CommandSpec(flags="di", value_options="w"),
+    "b2sum": CHECKSUMS,
+    "bzip2": CommandSpec(flags="cdfkqstvz" + DIGITS, required_flag="c"),
+    "cat": CommandSpec(flags="AbeEnstTuv"),
+    "cksum": CommandSpec(),
+    "comm": CommandSpec(flags="123iz", stdin="dash"),
+    "cp": CommandSpec(
+        flags="aRrfinlLPpsuvxHbdT", value_options="tS", write_options="t",
+        operands="write", stdin="never", output=False,
+    ),
+    "cut": CommandSpec(flags="nsz", value_options="bcdf"),
+    "date": CommandSpec(
+        flags="uRI", value_options="dfr", read_options="fr", operands="none", stdin="never",
+    ),
+    "diff": CommandSpec(flags="abBdeiEnNpqrstTuwy", value_options="CUxXSLIF", stdin="dash"),
+    "dirname": CommandSpec(flags="z", operands="none", stdin="never"),
+    "fold": CommandSpec(flags="bs", value_options="w"),
+    "grep": CommandSpec(
+        flags="EFGPiywxvcLlonhHsqabzUT", value_options="efmABC", patterns=1,
+        pattern_options="ef", read_options="f",
+    ),
+    "gzip": CommandSpec(flags="cdfkqtvn" + DIGITS, required_flag="c"),
+    "head": CommandSpec(flags="qvz" + DIGITS, value_options="nc"),
+    "join": CommandSpec(flags="ivz", value_options="aejot12", stdin="dash"),
+    "ln": CommandSpec(
+        flags="sfnrvbTiLP", value_options="tS", write_options="t",
+        operands="write", stdin="never", output=False,
+    ),
+    "ls": CommandSpec(flags="1aAlRrtSdhFip", stdin="never", default_operand="."),
+    "md5sum": CHECKSUMS,
+    "mkdir": CommandSpec(
+        flags="pv", value_options="m", operands="write", stdin="never", output=False,
+    ),
+    "mv": CommandSpec(
+        flags="fintuvbT", value_options="tS", write_options="t",
+        operands="write", stdin="never", output=False,
+    ),
+    "nl": CommandSpec(flags="p", value_options="bdfhilnsvw"),
+    "od": CommandSpec(flags="bcdfilosvx", value_options="AjNSt"),
+    "paste": CommandSpec(flags="sz", value_options="d"),
+    "rev": CommandSpec(),
+    "rm": CommandSpec(flags="fiIrRdv", operands="write", stdin="never", output=False),
+    "rmdir": CommandSpec(flags="pv", operands="write", stdin="never", output=False),
+    "seq": CommandSpec(flags="w", value_options="fs", operands="none", stdin="never"),
+    "sha1sum": CHECKSUMS,
+    "sha256sum": CHECKSUMS,
+    "sha512sum": CHECKSUMS,
+    "sleep": CommandSpec(operands="none", stdin="never", output=False),
+    "sort": CommandSpec(
+        flags="bdfgiMhnRrVcCmsuz", value_options="ktSTo", write_options="o",
+    ),
+    "tac": CommandSpec(flags="br", value_options="s"),
+    "tail": CommandSpec(flags="qvz" + DIGITS, value_options="nc"),
+    "tee": CommandSpec(flags="aip", operands="write", stdin="always"),
+    "touch": CommandSpec(
+        flags="acfhm", value_options="drt", read_options="r",
+        operands="write", stdin="never", output=False,
+    ),
+    "tr": CommandSpec(flags="cCdst", operands="none", stdin="always"),
+    "uniq": CommandSpec(flags="cdDiuz", value_options="fsw", output_operand=1),
+    "wc": CommandSpec(flags="clmwL"),
+    "xz": CommandSpec(flags="cdfkqtvze" + DIGITS, value_options="T", required_flag="c"),
+    "zcat": CommandSpec(flags="fqv"),
+}
+## Builtins that only write to stdout (`printf -v` assigns, so it is not one of them)
+OUTPUT_BUILTINS = {"echo", "printf", "true", "false", ":", "test", "["}
+
+
+class Effects:
+    """The resources that a region reads and writes, and the external commands that it runs"""
+
+    __slots__ = ("reads", "writes", "commands", "can_spawn")
+
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        ## The commands are checked at runtime, since a function can have the same name
+        self.commands = []
+        ## Whether the region can run as a background job (the last region of the
+        ## script cannot, so that its exit status is never lost)
+        self.can_spawn = True
+
+    def conflicts_with(self, other):
+        return (
+            resources_conflict(self.writes, other.reads | other.writes)
+            or resources_conflict(other.writes, self.reads)
+        )
+
+
+def resources_conflict(resources, other_resources):
+    return any(
+        resource_conflicts(resource, other_resource)
+        for resource in resources
+        for other_resource in other_resources
+    )
+
+
+def resource_conflicts(resource, other_resource):
+    if resource == other_resource:
+        return True
+    if resource.startswith("&") or other_resource.startswith("&"):
+        return False
+    if ANY_FILE in (resource, other_resource):
+        return True
+    if resource.startswith("/") != other_resource.startswith("/"):
+        return True
+    ## A directory contains the files under it (e.g., `rm -r d` and `cat d/f`)
+    return is_path_prefix(resource, other_resource) or is_path_prefix(other_resource, resource)
+
+
+def is_path_prefix(directory, path):
+    return directory in (".", "/") or path.startswith(directory.rstrip("/") + "/")
+
+
+## Returns the effects of the ASTs of a region, or None if it cannot run in parallel
+def region_effects(asts):
+    effects = Effects()
+    for ast in asts:
+        if isinstance(ast, CommandNode):
+            commands = [ast]
+        elif isinstance(ast, PipeNode) and not ast.is_background:
+            commands = ast.items
+        else:
+            return None
+        for i, command in enumerate(commands):
+            if not isinstance(command, CommandNode):
+                return None
+            if not add_command_effects(
+                command, effects, first=(i == 0), last=(i == len(commands) - 1)
+            ):
+                return None
+    return effects
+
+
+## Adds the effects of a command (in a pipeline, between its first and last command) and
+## returns whether they are known
+def add_command_effects(command, effects, first, last):
+    if len(command.assignments) > 0 or len(command.arguments) == 0:
+        return False
+    if any(is_unsafe_word(argument) for argument in command.arguments):
+        return False
+    words = [literal_word(argument) for argument in command.arguments]
+    if words[0] == "command":
+        words = words[1:]
+    if len(words) == 0 or words[0] is None:
+        return False
+    name, arguments = words[0], words[1:]
+
+    ## Where the standard file descriptors of the command point (None if they are pipes or
+    ## closed, or if they are not resources, i.e., stderr and /dev/null)
+    fds = {0: STDIN if first else None, 1: STDOUT if last else None, 2: None}
+    if not add_redirection_effects(command.redir_list, fds, effects):
+        return False
+
+    if name in OUTPUT_BUILTINS:
+        if name == "printf" and len(arguments) > 0 and arguments[0] in (None, "-v"):
+            return False
+        ## `test -f f` reads (the metadata of) f
+        if name in ("test", "["):
+            effects.reads.update(file_resource(argument) or ANY_FILE for argument in arguments)
+        add_output(fds, effects)
+        return True
+    spec = COMMANDS.get(name)
+    if spec is None:
+        return False
+    parsed = parse_arguments(spec, arguments, effects)
+    if parsed is None:
+        return False
+    operands, patterns = parsed
+
+    ## A word that is not literal can expand to any number of words (or options)
+    known_operands = None not in operands
+    if not known_operands:
+        effects.writes.add(ANY_FILE)
+    ## The patterns (e.g., of grep) are not files
+    files = operands[patterns:] if known_operands else []
+    if spec.operands != "none":
+        if len(files) == 0 and spec.default_operand is not None:
+            files = [spec.default_operand]
+        for i, operand in enumerate(files):
+            resource = file_resource(operand)
+            if operand == "-" or resource is None:
+                continue
+            if spec.operands == "write" or i == spec.output_operand:
+                effects.writes.add(resource)
+            else:
+                effects.reads.add(resource)
+    if spec.stdin == "always" or (
+        spec.stdin != "never" and (not known_operands or len(files) == 0 or "-" in files)
+    ):
+        add_input(fds, effects)
+    if spec.output or "v" in flags_of(arguments):
+        add_output(fds, effects)
+    effects.commands.append(name)
+    return True
+
+
+## Returns the operands of a command (None for words that are not literal) and the number
+## of them that are patterns, after adding the files of its options to the effects, or
+## None if its options are not known
+def parse_arguments(spec, arguments, effects):
+    operands = []
+    patterns = spec.patterns
+    has_required_flag = spec.required_flag is None
+    i = 0
+    while i < len(arguments):
+        argument = arguments[i]
+        i += 1
+        if argument is None or argument == "-" or not argument.startswith("-"):
+            operands.append(argument)
+            continue
+        if argument == "--":
+            operands.extend(arguments[i:])
+            break
+        ## GNU commands also take options after the operands, and their long options are
+        ## not known
+        if operands or argument.startswith("--"):
+            return None
+        for j, option in enumerate(argument[1:], start=1):
+            if option in spec.flags:
+                has_required_flag = has_required_flag or option == spec.required_flag
+                continue
+            if option not in spec.value_options:
+                return None
+            ## The value is either the rest of the word or the next word
+            if j + 1 < len(argument):
+                value = argument[j + 1:]
+            elif i < len(arguments):
+                value = arguments[i]
+                i += 1
+            else:
+                return None
+            if value is None:
+                return None
+            if option in spec.pattern_options:
+                patterns = 0
+            if option in spec.read_options and file_resource(value) is not None:
+                effects.reads.add(file_resource(value))
+            elif option in spec.write_options and file_resource(value) is not None:
+                effects.writes.add(file_resource(value))
+            break
+    if not has_required_flag:
+        return None
+    return operands, patterns
+
+
+def flags_of(arguments):
+    return {
+        flag
+        for argument in arguments
+        if argument is not None and argument.startswith("-") and not argument.startswith("--")
+        for flag in argument[1:]
+    }
+
+
+## Follows the redirections of a command in order (e.g., `2>&1 > f` leaves stderr on stdout)
+## and adds the files that they open, returning whether they are known
+def add_redirection_effects(redirections, fds, effects):
+    for redirection in redirections:
+        if redirection.fd[0] != "fixed":
+            ## `{fd}> file` assigns the descriptor to a variable
+            return False
+        fd = redirection.fd[1]
+        if isinstance(redirection, FileRedirNode):
+            if is_unsafe_word(redirection.arg):
+                return False
+            if redirection.redir_type == "ReadingString":
+                fds[fd] = None
+                continue
+            resource = file_resource(literal_word(redirection.arg))
+            if redirection.redir_type in ("From", "FromTo") and resource is not None:
+                effects.reads.add(resource)
+            if redirection.redir_type != "From" and resource is not None:
+                effects.writes.add(resource)
+            fds[fd] = resource
+        elif isinstance(redirection, DupRedirNode):
+            target = dup_target(redirection.arg)
+            if target is None:
+                return False
+            if target == "-":
+                fds[fd] = None
+                continue
+            fds[fd] = fds.get(target, f"&{target}")
+            if redirection.move:
+                fds[target] = None
+        elif isinstance(redirection, HeredocRedirNode):
+            if is_unsafe_word(redirection.arg):
+                return False
+            fds[fd] = None
+        elif isinstance(redirection, SingleArgRedirNode):
+            if redirection.redir_type == "CloseThis":
+                fds[fd] = None
+                continue
+            ## `&> f` and `&>> f`, whose target is in place of the descriptor
+            return False
+        else:
+            return False
+    return True
+
+
+## The descriptor that a redirection duplicates (`-` if it closes one), or None if it is not known
+def dup_target(arg):
+    if arg[0] == "fixed":
+        return arg[1]
+    ## The POSIX parser keeps the target as a word
+    word = literal_word(arg[1])
+    if word == "-":
+        return word
+    return int(word) if word is not None and word.isdigit() else None
+
+
+def add_input(fds, effects):
+    resource = fds[0]
+    if resource is None:
+        return
+    ## Reading stdin (or another inherited descriptor) consumes it
+    if resource.startswith("&"):
+        effects.writes.add(resource)
+    else:
+        effects.reads.add(resource)
+
+
+def add_output(fds, effects):
+    for fd in (1, 2):
+        if fds[fd] is not None:
+            effects.writes.add(fds[fd])
+
+
+## The resource of a file operand (None if it is not one, e.g., /dev/null)
+def file_resource(word):
+    if word is None:
+        return ANY_FILE
+    if word in ("/dev/null", "/dev/stderr", "/dev/fd/2"):
+        return None
+    if word in ("/dev/stdin", "/dev/fd/0"):
+        return STDIN
+    if word in ("/dev/stdout", "/dev/fd/1"):
+        return STDOUT
+    path = posixpath.normpath(word)
+    if path == ".." or path.startswith("../") or path.startswith("/dev/") or path == "/dev":
+        return ANY_FILE
+    return path
+
+
+## The text of a word if it expands to itself, or None
+def literal_word(arg_chars):
+    if not all(isinstance(arg_char, CArgChar) for arg_char in arg_chars):
+        return None
+    text = format_arg_chars(arg_chars)
+    if len(text) == 0 or any(char in NON_LITERAL_CHARS for char in text):
+        return None
+    return text
+
+
+## Returns whether expanding a word changes the shell state or depends on the previous command
+def is_unsafe_word(arg_chars):
+    stack = list(arg_chars)
+    while stack:
+        arg_char = stack.pop()
+        if isinstance(arg_char, (BArgChar, AArgChar)):
+            return True
+        if isinstance(arg_char, VArgChar):
+            if arg_char.var in SPECIAL_PARAMETERS or arg_char.fmt in UNSAFE_EXPANSIONS:
+                return True
+            stack.extend(arg_char.arg)
+        elif isinstance(arg_char, QArgChar):
+            stack.extend(arg_char.arg)
+        elif isinstance(arg_char, CArgChar) and arg_char.bash_mode:
+            ## The bash parser keeps words as their raw characters
+            return UNSAFE_RAW_WORD.search(format_arg_chars(arg_chars)) is not None
+        elif not isinstance(arg_char, CArgChar):
+            ## Other characters (e.g., `~`) are safe
+            continue
+    return False
@@ -0,0 +1,162 @@
+import contextlib
+import difflib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+
+## Incremental preprocessing keeps an index per script (and preprocessing options):
+##
+##   <index_dir>/<key>/index.json   the source lines of the last run and its units
+##   <index_dir>/<key>/regions/...  the region files that the units refer to
+##
+## A unit is a preprocessed top-level command (or a group of them that were merged
+## into one region) together with the source lines that it covers, which include
+## the comments and empty lines before it. The index is a JSON object:
+##
+##   {
+##     "namespace": the prefix of region ids (kept across runs),
+##     "next_id":   the number of the next region id,
+##     "lines":     the source lines of the last run,
+##     "units":     [{"first": LINE, "last": LINE, "text": TEXT, "regions": {ID: DEFINITION}}, ...]
+##   }
+##
+## where "text" is the preprocessed shell text of the unit (None if it only has
+## comments) and "regions" has the region function of every region that the unit
+## calls (None in "file" mode, where the region is in the regions directory).
+##
+## On the next run, the units whose lines did not change are reused as they are
+## (keeping their region ids and region bodies), and only the changed lines between
+## them are parsed and preprocessed again (see preprocessor.preprocess_incremental).
+## The region files that the new units no longer call are only removed after a grace
+## period, since a run of an earlier version of the script may still source them.
+
+INDEX_FILE = "index.json"
+INDEX_REGIONS = "regions"
+LOCK_FILE = ".lock"
+
+REGION_FILE_PREFIX = "region_"
+## Region files are removed once no version of the script has called them for this many
+## seconds, so that the runs of earlier versions can finish first
+UNUSED_REGION_TIMEOUT = 24 * 3600
+REGION_ID_PATTERN = re.compile(r"__jit_region_id=([0-9A-Za-z_]+)")
+
+
+def index_key(script_path, options):
+    """The key of the index of a script given its path and every preprocessing option"""
+    hasher = hashlib.sha256()
+    hasher.update(os.path.abspath(script_path).encode("utf-8", errors="surrogateescape"))
+    hasher.update(b"\0")
+    hasher.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class IncrementalIndex:
+    """The index of the last preprocessing run of a script"""
+
+    def __init__(self, index_dir, key):
+        self.entry_dir = os.path.join(index_dir, key)
+        os.makedirs(self.regions_dir(), exist_ok=True)
+
+    def regions_dir(self):
+        return os.path.join(self.entry_dir, INDEX_REGIONS)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Keeps concurrent runs on the same script from reusing the same region ids"""
+        with open(os.path.join(self.entry_dir, LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def load(self):
+        """Returns the index of the last run (None if there is none)"""
+        try:
+            with open(os.path.join(self.entry_dir, INDEX_FILE), encoding="utf-8") as index_file:
+                return json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, index):
+        index_path = os.path.join(self.entry_dir, INDEX_FILE)
+        with open(index_path + ".tmp", "w", encoding="utf-8") as index_file:
+            json.dump(index, index_file)
+        os.rename(index_path + ".tmp", index_path)
+
+    def remove_unused_regions(self, units, last_units):
+        """
+        Removes the region files that neither the units nor the units of the last run
+        have called for UNUSED_REGION_TIMEOUT seconds
+        """
+        region_ids = {region_id for unit in units for region_id in unit["regions"]}
+        last_region_ids = {region_id for unit in last_units for region_id in unit["regions"]}
+        now = time.time()
+        for name in os.listdir(self.regions_dir()):
+            region_id = name[len(REGION_FILE_PREFIX):]
+            region_path = os.path.join(self.regions_dir(), name)
+            if region_id in region_ids:
+                continue
+            if region_id in last_region_ids:
+                ## The last run called the region, so its grace period starts now
+                os.utime(region_path)
+            elif now - os.stat(region_path).st_mtime > UNUSED_REGION_TIMEOUT:
+                os.remove(region_path)
+
+
+def region_ids_of(text):
+    """The ids of the regions that some preprocessed text calls"""
+    return REGION_ID_PATTERN.findall(text) if text is not None else []
+
+
+def match_units(old_lines, old_units, new_lines, allow_moves=True):
+    """
+    Returns the units of the last run whose lines did not change, as a list of
+    units that cover their new lines. If allow_moves is False, units are only
+    reused if they are still in the same lines (e.g., if the units contain
+    their line numbers).
+    """
+    if old_lines == new_lines:
+        return list(old_units)
+
+    matching_blocks = difflib.SequenceMatcher(
+        None, old_lines, new_lines, autojunk=False
+    ).get_matching_blocks()
+    matched_units = []
+    block_index = 0
+    for unit in old_units:
+        ## Lines are numbered from 1, and matching blocks from 0
+        start, end = unit["first"] - 1, unit["last"]
+        while (
+            block_index < len(matching_blocks)
+            and matching_blocks[block_index].a + matching_blocks[block_index].size < end
+        ):
+            block_index += 1
+        if block_index == len(matching_blocks):
+            break
+        block = matching_blocks[block_index]
+        if block.a > start:
+            continue
+        new_first = start - block.a + block.b + 1
+        if new_first != unit["first"] and not allow_moves:
+            continue
+        matched_units.append(
+            dict(unit, first=new_first, last=new_first + unit["last"] - unit["first"])
+        )
+    return matched_units
+
+
+def changed_chunks(reused_units, line_count):
+    """
+    Returns the (first, last) line ranges that the reused units do not cover, each
+    with the unit that follows it (None if it is at the end of the script).
+    """
+    chunks = []
+    next_line = 1
+    for unit in reused_units:
+        if unit["first"] > next_line:
+            chunks.append(((next_line, unit["first"] - 1), unit))
+        next_line = unit["last"] + 1
+    if next_line <= line_count:
+        chunks.append(((next_line, line_count), None))
+    return chunks
@@ -0,0 +1,122 @@
+import hashlib
+import re
+
+from effects import ANY_FILE, OUTPUT_BUILTINS, STDOUT, flags_of, literal_word, region_effects
+from region_index import VARIABLE_NAME, region_summary
+from util import string_to_arg_chars
+from shasta.ast_node import AssignNode, CommandNode, FileRedirNode, PipeNode, QArgChar
+
+## A memoized region (see `--memoize`) replays the outputs of an earlier execution with the
+## same inputs instead of running (see runtime/jit_memo.sh). Only the regions whose outputs
+## are given by their inputs are memoized, i.e., regions that:
+##
+## - have known effects (see effects.py), and thus change no shell state,
+## - only run deterministic commands (see DETERMINISTIC_COMMANDS) and output builtins,
+## - read no stdin (or other inherited descriptor) and no file that is not literal,
+## - only write their stdout and stderr, and literal files that they truncate (not `>>`),
+## - run some external command (since looking a region up costs more than a builtin).
+##
+## Their inputs are the text of the region, the variables that it reads (found
+## syntactically, see region_index.py), the positional parameters if it reads any of them,
+## and the files that it reads, and their outputs are
+## their stdout, their stderr, their exit status, and the files that they write.
+
+## Commands whose outputs only depend on their arguments, their input files and the locale
+## (e.g., not `date`, `ls`, or `mkdir`), unless given the flags in NONDETERMINISTIC_FLAGS
+DETERMINISTIC_COMMANDS = {
+    "basename", "base64", "b2sum", "bzip2", "cat", "cksum", "comm", "cut", "diff", "dirname",
+    "fold", "grep", "gzip", "head", "join", "md5sum", "nl", "od", "paste", "rev", "seq",
+    "sha1sum", "sha256sum", "sha512sum", "sort", "tac", "tail", "tee", "tr", "uniq", "wc", "xz",
+    "zcat",
+}
+## `sort -R` shuffles, and `tee -a` appends to its files
+NONDETERMINISTIC_FLAGS = {"sort": "R", "tee": "a"}
+## Redirections that do not truncate the file that they write
+NON_TRUNCATING_REDIRECTIONS = {"Append", "FromTo"}
+## The positional parameters (`$1`, `${#}`, `"$@"`, ...) in the text of a region
+POSITIONAL_PARAMETER = re.compile(r"\$\{?#?[0-9@*#]")
+## The variable that stands for the positional parameters in the stub
+POSITIONAL_PARAMETERS = "@"
+
+
+class MemoSpec:
+    """The inputs and outputs of a memoized region, which its stub passes to the runtime"""
+
+    __slots__ = ("text_hash", "commands", "inputs", "outputs", "variables")
+
+    def __init__(self, text_hash, commands, inputs, outputs, variables):
+        self.text_hash = text_hash
+        ## The commands are checked at runtime, since a function can have the same name
+        self.commands = commands
+        self.inputs = inputs
+        self.outputs = outputs
+        self.variables = variables
+
+    def assignments(self):
+        """The assignments of the stub, whose lists are (quoted and) separated by spaces"""
+        assignments = [
+            AssignNode(
+                "__jit_memo", string_to_arg_chars(f"{self.text_hash}:{','.join(self.commands)}")
+            )
+        ]
+        for name, values in (
+            ("__jit_memo_inputs", self.inputs),
+            ("__jit_memo_outputs", self.outputs),
+            ("__jit_memo_variables", self.variables),
+        ):
+            if len(values) > 0:
+                assignments.append(
+                    AssignNode(name, [QArgChar(string_to_arg_chars(" ".join(values)))])
+                )
+        return assignments
+
+
+## Returns the MemoSpec of a region given its ASTs and its text, or None if it is not memoized
+def memo_spec(asts, text):
+    effects = region_effects(asts)
+    if effects is None:
+        return None
+    if ANY_FILE in effects.reads or ANY_FILE in effects.writes:
+        return None
+    if any(resource.startswith("&") for resource in effects.reads):
+        return None
+    if any(resource.startswith("&") and resource != STDOUT for resource in effects.writes):
+        return None
+    if not all(is_deterministic(command) for ast in asts for command in commands_of(ast)):
+        return None
+    ## Looking a region up costs a few processes, which is more than running only builtins
+    if len(effects.commands) == 0:
+        return None
+    read, _written, _commands, _redirections = region_summary(asts)
+    variables = sorted(variable for variable in read if VARIABLE_NAME.fullmatch(variable))
+    ## The bash parser keeps words as their raw characters, so they are found in the text
+    if POSITIONAL_PARAMETER.search(text):
+        variables.append(POSITIONAL_PARAMETERS)
+    outputs = sorted(resource for resource in effects.writes if resource != STDOUT)
+    return MemoSpec(
+        hashlib.sha256(text.encode("utf-8", errors="replace")).hexdigest()[:16],
+        effects.commands,
+        sorted(effects.reads),
+        outputs,
+        variables,
+    )
+
+
+def commands_of(ast):
+    return [ast] if isinstance(ast, CommandNode) else ast.items if isinstance(ast, PipeNode) else []
+
+
+def is_deterministic(command):
+    if any(
+        isinstance(redirection, FileRedirNode)
+        and redirection.redir_type in NON_TRUNCATING_REDIRECTIONS
+        for redirection in command.redir_list
+    ):
+        return False
+    words = [literal_word(argument) for argument in command.arguments]
+    if words[0] == "command":
+        words = words[1:]
+    name, arguments = words[0], words[1:]
+    if name not in DETERMINISTIC_COMMANDS:
+        return name in OUTPUT_BUILTINS
+    return not (set(NONDETERMINISTIC_FLAGS.get(name, "")) & flags_of(arguments))
@@ -1,6 +1,11 @@
+import contextlib
+import ctypes
+import functools
+import io
 import os
 import subprocess
-import sys
+import tempfile
+import threading
 
 from util import UnparsedScript, log
 from shasta.json_to_ast import to_ast_node
@@ -13,23 +18,63 @@ import libbash
 ## through python without calling it as an executable
 
 
+class ParsingError(Exception):
+    """Raised when the input script cannot be parsed"""
+
+
 def parse_shell_to_asts(input_script_path, bash_mode=False):
+    return list(iter_shell_to_asts(input_script_path, bash_mode=bash_mode))
+
+
+## Like parse_shell_to_asts, but converts (and, with libdash, parses) the top-level
+## commands one at a time, so that the first ones can be preprocessed before the rest
+## of the script is parsed. A ParsingError is only raised when the parser reaches it.
+def iter_shell_to_asts(input_script_path, bash_mode=False):
     if bash_mode:
-        return parse_shell_to_asts_bash(input_script_path)
+        return iter_shell_to_asts_bash(input_script_path)
     else:
-        return parse_shell_to_asts_dash(input_script_path)
+        return iter_shell_to_asts_dash(input_script_path)
+
 
+## libdash and libbash keep the state of their parser in C globals (and so does the conversion
+## of libbash ASTs, see shasta.bash_to_shasta_ast), so the scripts that are parsed from memory
+## (see parse_shell_bytes_to_asts) are parsed one at a time, by the thread that holds this.
+PARSER_LOCK = threading.Lock()
 
-INITIALIZE_LIBDASH = True
+
+## The state of libdash is per process, so it is only initialized once
+@functools.cache
+def libdash_library():
+    library = ctypes.CDLL(libdash.parser.libdash_library_path())
+    libdash.parser.initialize(library)
+    return library
+
+
+## libdash opens a new descriptor for every script and never closes it, so it is closed
+## once the script is parsed (since a long-lived process can parse many scripts)
+def close_libdash_input(library):
+    current = ctypes.cast(
+        ctypes.addressof(libdash.parser.parsefile.in_dll(library, "parsefile")),
+        ctypes.POINTER(ctypes.POINTER(libdash.parser.parsefile)),
+    ).contents
+    if current.contents.fd > 2:
+        os.close(current.contents.fd)
+        current.contents.fd = -1
 
 
 def parse_shell_to_asts_dash(input_script_path):
-    global INITIALIZE_LIBDASH
+    return list(iter_shell_to_asts_dash(input_script_path))
+
+
+def iter_shell_to_asts_dash(input_script_path):
+    library = libdash_library()
+    ## libdash keeps a pointer to the errno of the thread that initialized it, which is
+    ## gone once that thread exits, so it points to the errno of the thread that parses
+    libdash.parser.initialize_dash_errno(library)
     try:
-        new_ast_objects = libdash.parser.parse(input_script_path, INITIALIZE_LIBDASH)
-        INITIALIZE_LIBDASH = False
+        ## libdash parses the next top-level command whenever we ask for it
+        new_ast_objects = libdash.parser.parse(input_script_path, False)
         ## Transform the untyped ast objects to typed ones
-        typed_ast_objects = []
         for (
             untyped_ast,
             original_text,
@@ -37,22 +82,24 @@ def parse_shell_to_asts_dash(input_script_path):
             linno_after,
         ) in new_ast_objects:
             typed_ast = to_ast_node(untyped_ast)
-            typed_ast_objects.append(
-                (typed_ast, original_text, linno_before, linno_after)
-            )
-
-        return typed_ast_objects
+            yield (typed_ast, original_text, linno_before, linno_after)
     except libdash.parser.ParsingException as e:
         log("Parsing error!", e)
-        sys.exit(1)
+        raise ParsingError(f"{input_script_path}: {e}") from e
+    finally:
+        close_libdash_input(library)
 
 
 def parse_shell_to_asts_bash(input_script_path):
+    return list(iter_shell_to_asts_bash(input_script_path))
+
+
+def iter_shell_to_asts_bash(input_script_path):
     try:
+        ## libbash parses the whole script at once, so only the conversion is lazy
         new_ast_objects = libbash.bash_to_ast(input_script_path, with_linno_info=True)
 
         ## convert the libbash AST to a shasta AST
-        typed_ast_objects = []
         for (
             untyped_ast,
             original_text,
@@ -60,18 +107,51 @@ def parse_shell_to_asts_bash(input_script_path):
             linno_after,
         ) in new_ast_objects:
             typed_ast = bash_to_shasta_ast(untyped_ast)
-            typed_ast_objects.append(
-                (
-                    typed_ast,
-                    original_text.decode("utf-8", errors="replace"),
-                    linno_before,
-                    linno_after,
-                )
+            yield (
+                typed_ast,
+                original_text.decode("utf-8", errors="replace"),
+                linno_before,
+                linno_after,
             )
-        return typed_ast_objects
     except RuntimeError as e:
         log("Parsing error!", e)
-        sys.exit(1)
+        raise ParsingError(f"{input_script_path}: {e}") from e
+
+
+## Like parse_shell_to_asts, but for a script in memory, which can be called from many
+## threads at a time (see api.py)
+def parse_shell_bytes_to_asts(script_bytes, bash_mode=False):
+    with PARSER_LOCK, memory_file(script_bytes) as script_path:
+        return parse_shell_to_asts(script_path, bash_mode=bash_mode)
+
+
+## The parsers only read files, so a script in memory is given to them as the path of a
+## memory file (or of a temporary file, where there are no memory files)
+@contextlib.contextmanager
+def memory_file(contents):
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("script")
+        try:
+            write_all(fd, contents)
+            yield f"/proc/self/fd/{fd}"
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile(prefix="script-") as temporary_file:
+            temporary_file.write(contents)
+            temporary_file.flush()
+            yield temporary_file.name
+
+
+def write_all(fd, data):
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
+
+
+def warm_up_parsers():
+    """Loads both parsers and initializes libdash, so that later parses are fast"""
+    parse_shell_bytes_to_asts(b"true\n", bash_mode=False)
+    parse_shell_bytes_to_asts(b"true\n", bash_mode=True)
 
 
 def parse_shell_to_asts_interactive(input_script_path: str):
@@ -79,19 +159,55 @@ def parse_shell_to_asts_interactive(input_script_path: str):
 
 
 def from_ast_objects_to_shell(asts):
-    shell_list = []
-    for ast in asts:
-        # log("Ast:", ast)
-        if isinstance(ast, UnparsedScript):
-            shell_list.append(ast.text)
+    shell_list = [from_ast_object_to_shell(ast) for ast in asts]
+    return "\n".join(shell_list) + "\n"
+
+
+def from_ast_object_to_shell(ast):
+    # log("Ast:", ast)
+    if isinstance(ast, UnparsedScript):
+        shell = ast.text
+    else:
+        shell = ast.pretty()
+    return shell.decode("utf-8", errors="replace") if isinstance(shell, bytes) else shell
+
+
+class SourceLines:
+    """The lines of a source script as bytes, numbered like the parser numbers them"""
+
+    __slots__ = ("lines",)
+
+    def __init__(self, script_bytes, bash_mode=False):
+        if bash_mode:
+            ## libbash reads the script in binary mode, where only \n ends a line
+            self.lines = io.BytesIO(script_bytes).readlines()
         else:
-            shell_list.append(ast.pretty())
+            ## libdash reads the script in text mode, where \r and \r\n also end a line
+            self.lines = script_bytes.splitlines(keepends=True)
 
-    shell_list = [
-        x.decode("utf-8", errors="replace") if isinstance(x, bytes) else x
-        for x in shell_list
-    ]
-    return "\n".join(shell_list) + "\n"
+    def get(self, line_range):
+        """The source bytes of the (first, last) lines, numbered from 1"""
+        first, last = line_range
+        return b"".join(self.lines[first - 1 : last])
+
+
+## Writes ASTs to a binary file like from_ast_objects_to_shell, but without decoding
+## and encoding the text that preprocessing did not modify: given the source lines, an
+## UnparsedScript is copied from the source bytes, so only the ASTs that contain a
+## replaced region are unparsed.
+def write_asts_to_shell_file(asts, output_file, source_lines=None):
+    for ast in asts:
+        output_file.write(ast_object_to_shell_bytes(ast, source_lines) + b"\n")
+
+
+def ast_object_to_shell_bytes(ast, source_lines=None):
+    if (
+        isinstance(ast, UnparsedScript)
+        and source_lines is not None
+        and ast.line_range is not None
+    ):
+        return source_lines.get(ast.line_range)
+    return from_ast_object_to_shell(ast).encode("utf-8", errors="replace")
 
 
 def from_ast_objects_to_shell_file(asts, new_shell_filename):
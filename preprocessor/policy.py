@@ -0,0 +1,118 @@
+import fnmatch
+import json
+
+from util import command_children, walk_commands, format_arg_chars
+from shasta.ast_node import CommandNode, PipeNode
+
+## An instrumentation policy selects which regions are stubbed. It is a JSON file:
+##
+##   {
+##     "include": [RULE, ...],
+##     "exclude": [RULE, ...]
+##   }
+##
+## where every RULE is an object with any of the following fields (all of which must match):
+##
+##   "command":             a glob (or list of globs) matched against the command names
+##   "lines":               [FIRST, LAST], matched if a command starts in these source lines
+##   "min_pipeline_length": the minimum number of commands in the pipeline
+##   "max_pipeline_length": the maximum number of commands in the pipeline
+##
+## A pipeline (or simple command) is selected if it matches some include rule (or if there
+## are no include rules) and no exclude rule. Larger regions (e.g., with `--granularity block`)
+## are selected if any of their pipelines is selected. Regions that are not selected are
+## emitted as they are, so they do not call the runtime at all.
+
+POLICY_FIELDS = {"include", "exclude"}
+RULE_FIELDS = {"command", "lines", "min_pipeline_length", "max_pipeline_length"}
+
+
+class InstrumentationPolicy:
+    def __init__(self, include=None, exclude=None):
+        self.include = [] if include is None else include
+        self.exclude = [] if exclude is None else exclude
+
+    @staticmethod
+    def from_file(policy_path):
+        with open(policy_path, encoding="utf-8") as policy_file:
+            policy_json = json.load(policy_file)
+        return InstrumentationPolicy.from_json(policy_json)
+
+    @staticmethod
+    def from_json(policy_json):
+        if not isinstance(policy_json, dict):
+            raise ValueError("the policy must be an object")
+        unknown_fields = set(policy_json) - POLICY_FIELDS
+        if unknown_fields:
+            raise ValueError(f"unknown policy fields: {', '.join(sorted(unknown_fields))}")
+        include = [check_rule(rule) for rule in policy_json.get("include", [])]
+        exclude = [check_rule(rule) for rule in policy_json.get("exclude", [])]
+        return InstrumentationPolicy(include, exclude)
+
+    def to_json(self):
+        return {"include": self.include, "exclude": self.exclude}
+
+    def selects(self, ast_node):
+        """Returns whether a region consisting of this AST node should be stubbed"""
+        return any(self.selects_pipeline(pipeline) for pipeline in pipelines_of(ast_node))
+
+    def selects_pipeline(self, pipeline):
+        if self.include and not any(rule_matches(rule, pipeline) for rule in self.include):
+            return False
+        return not any(rule_matches(rule, pipeline) for rule in self.exclude)
+
+
+def check_rule(rule):
+    if not isinstance(rule, dict):
+        raise ValueError(f"a policy rule must be an object: {rule}")
+    unknown_fields = set(rule) - RULE_FIELDS
+    if unknown_fields:
+        raise ValueError(f"unknown policy rule fields: {', '.join(sorted(unknown_fields))}")
+    if "lines" in rule and not (
+        isinstance(rule["lines"], list)
+        and len(rule["lines"]) == 2
+        and all(isinstance(line, int) for line in rule["lines"])
+    ):
+        raise ValueError(f"lines must be a [FIRST, LAST] pair: {rule['lines']}")
+    return rule
+
+
+## Returns the pipelines (or simple commands with arguments) in an AST node,
+## which are the units that the rules are matched against.
+def pipelines_of(ast_node):
+    if isinstance(ast_node, PipeNode):
+        return [ast_node]
+    if isinstance(ast_node, CommandNode):
+        return [ast_node] if len(ast_node.arguments) > 0 else []
+    pipelines = []
+    for child in command_children(ast_node):
+        pipelines += pipelines_of(child)
+    return pipelines
+
+
+def rule_matches(rule, pipeline):
+    simple_commands = [
+        node
+        for node in walk_commands(pipeline)
+        if isinstance(node, CommandNode) and len(node.arguments) > 0
+    ]
+    if "command" in rule:
+        globs = rule["command"] if isinstance(rule["command"], list) else [rule["command"]]
+        command_names = [format_arg_chars(command.arguments[0]) for command in simple_commands]
+        if not any(
+            fnmatch.fnmatchcase(command_name, glob)
+            for command_name in command_names
+            for glob in globs
+        ):
+            return False
+    if "lines" in rule:
+        first_line, last_line = rule["lines"]
+        line_numbers = [command.line_number for command in simple_commands]
+        if not any(first_line <= line_number <= last_line for line_number in line_numbers):
+            return False
+    pipeline_length = len(pipeline.items) if isinstance(pipeline, PipeNode) else 1
+    if "min_pipeline_length" in rule and pipeline_length < rule["min_pipeline_length"]:
+        return False
+    if "max_pipeline_length" in rule and pipeline_length > rule["max_pipeline_length"]:
+        return False
+    return True
@@ -1,5 +1,3 @@
-import copy
-
 from util import *
 from shasta.ast_node import AstNode
 
@@ -22,31 +20,81 @@ def preprocess_node(
         PreprocessedAst: the preprocessed version of the original AstNode
 
     Note:
-        For preprocess_node to dispatch the right function, the function being
-        called must follow the convention "preprocess_node_<node_name>"
+        The preprocessor of every node type is in NODE_PREPROCESSORS. The ones of
+        compound nodes are generators that yield the (child node, last_object) of
+        every child that they need preprocessed, and receive its PreprocessedAST
+        back. This function runs them on an explicit stack (instead of recursing),
+        so that deeply nested scripts do not hit Python's recursion limit.
     """
-    node_name = type(ast_node).NodeName.lower()
-    preprocess_fn = globals().get(f"preprocess_node_{node_name}")
+    stack = []
+    pending = start_preprocessing_node(ast_node, trans_options, last_object)
+    while True:
+        if isinstance(pending, PreprocessedAST):
+            if len(stack) == 0:
+                return pending
+            ## Resume the parent with the preprocessed child
+            preprocessor, child_result = stack[-1], pending
+        else:
+            stack.append(pending)
+            preprocessor, child_result = pending, None
+        try:
+            child_node, child_last_object = preprocessor.send(child_result)
+        except StopIteration as stop:
+            stack.pop()
+            pending = stop.value
+            continue
+        pending = start_preprocessing_node(child_node, trans_options, child_last_object)
+
+
+## Returns the PreprocessedAST of a node, or the generator that preprocesses it
+## if it has children to preprocess first (see preprocess_node).
+def start_preprocessing_node(ast_node: AstNode, trans_options, last_object: bool):
+    ## With the "block" granularity, compound commands are replaced as a whole
+    ## (except for the ones that `return` or source a script, see preprocess_node_command)
+    if (
+        trans_options.get_granularity() == "block"
+        and is_block(ast_node)
+        and trans_options.selects(ast_node)
+        and not contains_return(ast_node)
+        and not (trans_options.instruments_sourced_scripts() and contains_source(ast_node))
+    ):
+        return PreprocessedAST(
+            ast_node, replace_whole=True, non_maximal=False, last_ast=last_object
+        )
+
+    preprocess_fn = NODE_PREPROCESSORS.get(type(ast_node))
     if preprocess_fn is None:
-        raise KeyError(f"Could not find appropriate preprocessor for {node_name}")
+        raise KeyError(f"Could not find appropriate preprocessor for {type(ast_node).NodeName}")
     return preprocess_fn(ast_node, trans_options, last_object)
 
 
 ## This preprocesses the AST node and also replaces it if it needs replacement .
-## It is called by constructs that cannot be included in a dataflow region.
+## It is called by constructs that cannot be included in a dataflow region,
+## as `yield from preprocess_close_node(...)` (see preprocess_node).
 def preprocess_close_node(
     ast_node: AstNode,
     trans_options,
     last_object: bool = False,
 ):
-    preprocessed_ast_object = preprocess_node(
-        ast_node, trans_options, last_object=last_object
+    preprocessed_ast_object = yield (ast_node, last_object)
+    return close_preprocessed_node(
+        preprocessed_ast_object, trans_options, last_object=last_object
     )
+
+
+## This replaces an already preprocessed AST node if it needs replacement.
+def close_preprocessed_node(
+    preprocessed_ast_object: PreprocessedAST,
+    trans_options,
+    last_object: bool = False,
+):
     preprocessed_ast = preprocessed_ast_object.ast
     should_replace_whole_ast = preprocessed_ast_object.should_replace_whole_ast()
     if should_replace_whole_ast:
         final_ast = trans_options.replace_df_region(
-            asts=[preprocessed_ast], disable_parallel_pipelines=last_object
+            asts=[preprocessed_ast],
+            disable_parallel_pipelines=last_object,
+            defer_exit_status=needs_deferred_exit_status([preprocessed_ast], trans_options),
         )
         something_replaced = True
     else:
@@ -55,6 +103,265 @@ def preprocess_close_node(
     return final_ast, something_replaced
 
 
+## Region granularity
+##
+## With the "command" granularity, every command (or pipeline) is a region of its own,
+## except for background commands that are merged with the command that follows them.
+## With the "sequence" and "block" granularities, runs of adjacent commands (in the
+## top-level script, or in a `;` list) are merged into one region, up to the maximum
+## region size, and `&&`, `||`, `!` lists of such commands are replaced as a whole.
+## With the "block" granularity, compound commands (e.g., `if`, `case`, `{ ... }`) that
+## do not contain loops are replaced as a whole too; loops follow the loop policy.
+
+BLOCK_NODE_NAMES = {
+    "If", "Case", "And", "Or", "Not", "Semi", "Subshell", "Group", "Redir", "Cond", "Arith", "Time",
+}
+LOOP_NODE_NAMES = {"For", "While", "Select", "ArithFor"}
+
+
+def is_block(ast_node: AstNode):
+    return ast_node.NodeName in BLOCK_NODE_NAMES and not contains_loop(ast_node)
+
+
+def contains_loop(ast_node: AstNode):
+    return any(node.NodeName in LOOP_NODE_NAMES for node in walk_commands(ast_node))
+
+
+def contains_return(ast_node: AstNode):
+    return any(is_return_command(node) for node in walk_commands(ast_node))
+
+
+def contains_source(ast_node: AstNode):
+    return any(is_source_command(node) for node in walk_commands(ast_node))
+
+
+## An AST can be merged in a region with its neighbours if it would be replaced
+## as a whole, or if nothing in it would be replaced (e.g., an assignment).
+def can_merge(preprocessed_ast_object: PreprocessedAST, trans_options):
+    if trans_options.get_granularity() == "command":
+        return False
+    return (
+        preprocessed_ast_object.should_replace_whole_ast()
+        or not preprocessed_ast_object.will_anything_be_replaced()
+    )
+
+
+## Returns whether a list of preprocessed ASTs can be replaced as a whole
+## (as part of a bigger region), i.e., if they all can be merged and at least
+## one of them would be replaced.
+def can_merge_all(preprocessed_ast_objects, trans_options):
+    return all(
+        can_merge(preprocessed_ast_object, trans_options)
+        for preprocessed_ast_object in preprocessed_ast_objects
+    ) and any(
+        preprocessed_ast_object.should_replace_whole_ast()
+        for preprocessed_ast_object in preprocessed_ast_objects
+    )
+
+
+## Replaces the regions in a sequence of preprocessed ASTs, merging adjacent ones
+## according to the granularity.
+##
+## The sequence is given as a list of (preprocessed_ast_object, original_text, line_range, last_object)
+## and the result is a list of (final_ast, something_replaced, original_text, line_range).
+## The original text and line range of nested ASTs are None. Both are iterated lazily,
+## so a region is yielded as soon as the sequence shows that it is closed.
+def replace_regions_in_sequence(preprocessed_items, trans_options):
+    candidate_region = []
+    for preprocessed_ast_object, original_text, line_range, last_object in preprocessed_items:
+        mergeable = can_merge(preprocessed_ast_object, trans_options)
+        ## If the previous AST was in the background, then the current one
+        ## has to be included in the region no matter what.
+        continues_region = (
+            len(candidate_region) > 0 and candidate_region[-1][0].is_non_maximal()
+        )
+        if not (continues_region or mergeable or preprocessed_ast_object.is_non_maximal()):
+            yield from close_candidate_region(candidate_region, trans_options, last_object)
+            candidate_region = [(preprocessed_ast_object, original_text, line_range)]
+            yield from close_candidate_region(candidate_region, trans_options, last_object)
+            candidate_region = []
+            continue
+
+        candidate_region.append((preprocessed_ast_object, original_text, line_range))
+        if preprocessed_ast_object.is_non_maximal():
+            continue
+        if not mergeable or trans_options.is_region_full(len(candidate_region)):
+            yield from close_candidate_region(candidate_region, trans_options, last_object)
+            candidate_region = []
+
+    ## Close the final region
+    yield from close_candidate_region(candidate_region, trans_options, True)
+
+
+## Parallel regions
+##
+## With --parallel, runs of adjacent regions (in the top-level script, or in a `;` list)
+## that do not depend on each other (see effects.py) are scheduled as a group: the stubs of
+## all of them but the last run their region as a background job, and the stub of the last
+## one runs it and then waits for the jobs (see runtime/jit_scheduler.sh), so the exit
+## status of the group is the one of its last region. The sequence is given and returned
+## like in replace_regions_in_sequence, and a group is yielded once the next item ends it.
+def schedule_parallel_regions(final_items, trans_options):
+    group = []
+    for item in final_items:
+        effects = parallel_region_effects(item[0], trans_options)
+        if (
+            effects is None
+            or len(group) == 0
+            or not group[-1][1].can_spawn
+            or any(effects.conflicts_with(other_effects) for _item, other_effects in group)
+        ):
+            yield from close_parallel_group(group)
+            group = []
+        if effects is None:
+            yield item
+        else:
+            group.append((item, effects))
+    yield from close_parallel_group(group)
+
+
+## The effects of a stubbed region that can run in parallel (None for anything else)
+def parallel_region_effects(final_ast, trans_options):
+    if not (
+        isinstance(final_ast, CommandNode)
+        and len(final_ast.assignments) > 0
+        and final_ast.assignments[0].var == "__jit_region_id"
+    ):
+        return None
+    return trans_options.take_region_effects(format_arg_chars(final_ast.assignments[0].val))
+
+
+def close_parallel_group(group):
+    if len(group) < 2:
+        return [item for item, _effects in group]
+    log(
+        "Parallel regions: "
+        + ", ".join(format_arg_chars(item[0].assignments[0].val) for item, _effects in group)
+    )
+    return [
+        (
+            make_parallel_job_stub(
+                final_ast, "spawn" if i < len(group) - 1 else "last", effects.commands
+            ),
+            something_replaced,
+            original_text,
+            line_range,
+        )
+        for i, ((final_ast, something_replaced, original_text, line_range), effects) in enumerate(
+            group
+        )
+    ]
+
+
+def close_candidate_region(candidate_region, trans_options, last_object: bool):
+    if len(candidate_region) == 0:
+        return []
+
+    ## If nothing in the region would be replaced, it stays as it is
+    if not any(
+        preprocessed_ast_object.should_replace_whole_ast()
+        for preprocessed_ast_object, _original_text, _line_range in candidate_region
+    ):
+        return [
+            (
+                preprocessed_ast_object.ast,
+                preprocessed_ast_object.will_anything_be_replaced(),
+                original_text,
+                line_range,
+            )
+            for preprocessed_ast_object, original_text, line_range in candidate_region
+        ]
+
+    region_asts, region_lines = unzip(
+        [
+            (preprocessed_ast_object.ast, original_text)
+            for preprocessed_ast_object, original_text, _line_range in candidate_region
+        ]
+    )
+    region_text = join_original_text_lines(region_lines)
+    region_line_range = join_line_ranges(
+        [line_range for _preprocessed_ast_object, _text, line_range in candidate_region]
+    )
+    replaced_ast = trans_options.replace_df_region(
+        region_asts,
+        ast_text=region_text,
+        line_range=region_line_range,
+        disable_parallel_pipelines=last_object,
+        defer_exit_status=needs_deferred_exit_status(region_asts, trans_options),
+    )
+    return [(replaced_ast, True, region_text, region_line_range)]
+
+
+## The exit status of a merged region can come from a failure that was ignored,
+## e.g., `false && :`, which must not trigger `set -e` (see make_deferred_status_stub).
+def needs_deferred_exit_status(region_asts, trans_options):
+    return trans_options.get_granularity() != "command" and (
+        len(region_asts) > 1 or not isinstance(region_asts[0], (CommandNode, PipeNode))
+    )
+
+
+## Preprocesses the commands of a `;` list and merges the adjacent ones
+## according to the granularity.
+def preprocess_sequence(
+    ast_node: AstNode,
+    trans_options,
+    last_object: bool = False,
+):
+    preprocessed_ast_objects = []
+    for command in flatten_semi(ast_node):
+        preprocessed_ast_objects.append((yield (command, last_object)))
+    ## If the whole sequence can be merged, it can also be merged with its neighbours
+    if can_merge_all(preprocessed_ast_objects, trans_options):
+        return PreprocessedAST(
+            ast_node,
+            replace_whole=True,
+            non_maximal=preprocessed_ast_objects[-1].is_non_maximal(),
+            last_ast=last_object,
+        )
+
+    final_items = replace_regions_in_sequence(
+        [
+            (preprocessed_ast_object, None, None, last_object)
+            for preprocessed_ast_object in preprocessed_ast_objects
+        ],
+        trans_options,
+    )
+    if trans_options.schedules_parallel_regions():
+        final_items = schedule_parallel_regions(final_items, trans_options)
+    final_items = list(final_items)
+    final_asts = [final_ast for final_ast, _sth_replaced, _text, _line_range in final_items]
+    preprocessed_ast_object = PreprocessedAST(
+        make_semi(final_asts),
+        replace_whole=False,
+        non_maximal=False,
+        something_replaced=any(
+            sth_replaced for _ast, sth_replaced, _text, _line_range in final_items
+        ),
+        last_ast=last_object,
+    )
+    return preprocessed_ast_object
+
+
+def flatten_semi(ast_node: AstNode):
+    commands = []
+    stack = [ast_node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, SemiNode):
+            stack.append(node.right_operand)
+            stack.append(node.left_operand)
+        else:
+            commands.append(node)
+    return commands
+
+
+def make_semi(asts):
+    semi = asts[-1]
+    for ast in reversed(asts[:-1]):
+        semi = SemiNode(ast, semi)
+    return semi
+
+
 ## TODO: I am a little bit confused about how compilation happens.
 ##       Does it happen bottom up or top down: i.e. when we first encounter an occurence
 ##       do we recurse in it and then compile from the leaf, or just compile the surface?
@@ -78,6 +385,17 @@ def preprocess_close_node(
 ## or if we are in the end of a script, then we set a variable.
 
 
+## Regions that the instrumentation policy does not select are left as they are
+def make_unselected(ast_node: AstNode, last_object: bool):
+    return PreprocessedAST(
+        ast_node,
+        replace_whole=False,
+        non_maximal=False,
+        something_replaced=False,
+        last_ast=last_object,
+    )
+
+
 def preprocess_node_pipe(
     ast_node: PipeNode,
     trans_options,
@@ -92,6 +410,9 @@ def preprocess_node_pipe(
     ##       For example, if a command in the pipe has a command substitution
     ##       in one of its arguments then we would like to call our runtime
     ##       there instead of
+    if not trans_options.selects(ast_node):
+        return make_unselected(ast_node, last_object)
+
     preprocessed_ast_object = PreprocessedAST(
         ast_node,
         replace_whole=True,
@@ -126,6 +447,36 @@ def preprocess_node_command(
         )
         return preprocessed_ast_object
 
+    ## In a region, `return` would only return from the runtime (which sources or
+    ## evaluates the region), so it is never replaced (nor merged in a region). In a
+    ## function body, it calls the function's leave hook before returning, and elsewhere
+    ## (i.e., in a sourced script) it is left as it is.
+    if is_return_command(ast_node):
+        scope = trans_options.get_function_scope()
+        preprocessed_ast_object = PreprocessedAST(
+            make_function_return(scope, ast_node) if scope is not None else ast_node,
+            replace_whole=False,
+            non_maximal=False,
+            something_replaced=True,
+            last_ast=last_object,
+        )
+        return preprocessed_ast_object
+
+    ## The script that a `source` reads is preprocessed by the runtime (see
+    ## make_sourced_command), and its commands are the regions, so the command is not one.
+    if trans_options.instruments_sourced_scripts() and is_source_command(ast_node):
+        preprocessed_ast_object = PreprocessedAST(
+            make_sourced_command(ast_node),
+            replace_whole=False,
+            non_maximal=False,
+            something_replaced=True,
+            last_ast=last_object,
+        )
+        return preprocessed_ast_object
+
+    if not trans_options.selects(ast_node):
+        return make_unselected(ast_node, last_object)
+
     ## This means we have a command. Commands are always candidate dataflow
     ## regions.
     preprocessed_ast_object = PreprocessedAST(
@@ -141,7 +492,7 @@ def preprocess_node_redir(
     trans_options,
     last_object: bool = False,
 ):
-    preprocessed_node, something_replaced = preprocess_close_node(
+    preprocessed_node, something_replaced = yield from preprocess_close_node(
         ast_node.node, trans_options, last_object=last_object
     )
     ast_node.node = preprocessed_node
@@ -166,6 +517,9 @@ def preprocess_node_background(
 
     ## TODO: Preprocess the internals of the background to allow
     ##       for mutually recursive calls to PaSh.
+    if not trans_options.selects(ast_node):
+        return make_unselected(ast_node, last_object)
+
     preprocessed_ast_object = PreprocessedAST(
         ast_node, replace_whole=True, non_maximal=True, last_ast=last_object
     )
@@ -184,7 +538,7 @@ def preprocess_node_subshell(
     trans_options,
     last_object: bool = False,
 ):
-    preprocessed_body, something_replaced = preprocess_close_node(
+    preprocessed_body, something_replaced = yield from preprocess_close_node(
         ast_node.body, trans_options, last_object=last_object
     )
     ast_node.body = preprocessed_body
@@ -201,20 +555,108 @@ def preprocess_node_subshell(
 ## TODO: For all of the constructs below, think whether we are being too conservative
 
 
-## TODO: This is not efficient at all since it calls the PaSh runtime everytime the loop is entered.
-##       We have to find a way to improve that.
+## Loops are instrumented according to the loop policy of their kind:
+## - "iteration": The loop body is preprocessed like any other node, so the runtime
+##   is called for the regions of the body on every iteration.
+## - "loop": The whole loop is stubbed as a single region, so the runtime is called once,
+##   and a cheap hook (`__jit_loop_iteration <region id>`) is called on every iteration.
+## With the "loop" policy, a loop is replaced as a whole, unless its body `return`s,
+## or `break`s/`continue`s to an enclosing loop, which the stub cannot do (it runs the
+## loop in a region of its own). These loops fall back to per-iteration stubbing, and
+## so do the ones that the instrumentation policy or the cost model do not select.
+def stubs_whole_loop(ast_node, trans_options, loop_kind: str):
+    return (
+        trans_options.get_loop_policy(loop_kind) == "loop"
+        and not contains_return(ast_node)
+        and not exits_enclosing_loop(ast_node)
+        and trans_options.selects(ast_node)
+    )
+
+
+## Returns whether a `break N` or `continue N` in a loop exits it, i.e., if N is
+## more than the number of loops around it (including this one). A level that
+## is not a literal number is assumed to exit the loop.
+def exits_enclosing_loop(loop_node):
+    stack = [(loop_node, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if node.NodeName in LOOP_NODE_NAMES:
+            depth += 1
+        elif is_loop_control_command(node):
+            levels = loop_control_levels(node)
+            if levels is None or levels > depth:
+                return True
+        stack.extend((child, depth) for child in command_children(node))
+    return False
+
+
+def is_loop_control_command(ast_node):
+    return (
+        isinstance(ast_node, CommandNode)
+        and len(ast_node.arguments) > 0
+        and format_arg_chars(ast_node.arguments[0]) in ("break", "continue")
+    )
+
+
+## The N of `break N` or `continue N` (1 by default), or None if it is not a literal number
+def loop_control_levels(ast_node):
+    if len(ast_node.arguments) < 2:
+        return 1
+    levels = format_arg_chars(ast_node.arguments[1])
+    return int(levels) if levels.isdigit() else None
+
+
+def preprocess_loop(
+    ast_node,
+    trans_options,
+    last_object: bool,
+    body_field: str,
+):
+    region_id = trans_options.get_next_region_id()
+    body = getattr(ast_node, body_field)
+    setattr(ast_node, body_field, SemiNode(make_loop_iteration_hook(region_id), body))
+    ## The exit status of the loop can come from a failure that was ignored,
+    ## e.g., `false && :`, which must not trigger `set -e` (see make_deferred_status_stub).
+    replaced_ast = trans_options.replace_df_region(
+        asts=[ast_node],
+        disable_parallel_pipelines=last_object,
+        region_id=region_id,
+        defer_exit_status=True,
+    )
+    preprocessed_ast_object = PreprocessedAST(
+        replaced_ast,
+        replace_whole=False,
+        non_maximal=False,
+        something_replaced=True,
+        last_ast=last_object,
+    )
+    return preprocessed_ast_object
+
+
+## Generates: __jit_loop_iteration <region id> && :
+##
+## The hook returns the exit status that the body would see, and `&& :`
+## makes sure that a non-zero one does not trigger `set -e`.
+def make_loop_iteration_hook(region_id):
+    hook = make_command_node(["__jit_loop_iteration", region_id])
+    return AndNode(hook, make_command_node([":"]), no_braces=True)
+
+
 def preprocess_node_for(
     ast_node: ForNode,
     trans_options,
     last_object: bool = False,
 ):
+    if stubs_whole_loop(ast_node, trans_options, "for"):
+        return preprocess_loop(ast_node, trans_options, last_object, "body")
+
     ## Preprocess the loop body
-    preprocessed_body, something_replaced = preprocess_close_node(
+    preprocessed_body, something_replaced = yield from preprocess_close_node(
         ast_node.body, trans_options, last_object=last_object
     )
 
     ## Update the loop body with the preprocessed version
-    ast_node.body = copy.deepcopy(preprocessed_body)
+    ast_node.body = preprocessed_body
 
     preprocessed_ast_object = PreprocessedAST(
         ast_node,
@@ -232,10 +674,13 @@ def preprocess_node_while(
     trans_options,
     last_object: bool = False,
 ):
-    preprocessed_test, sth_replaced_test = preprocess_close_node(
+    if stubs_whole_loop(ast_node, trans_options, "while"):
+        return preprocess_loop(ast_node, trans_options, last_object, "body")
+
+    preprocessed_test, sth_replaced_test = yield from preprocess_close_node(
         ast_node.test, trans_options, last_object=last_object
     )
-    preprocessed_body, sth_replaced_body = preprocess_close_node(
+    preprocessed_body, sth_replaced_body = yield from preprocess_close_node(
         ast_node.body, trans_options, last_object=last_object
     )
     ast_node.test = preprocessed_test
@@ -258,14 +703,30 @@ def preprocess_node_defun(
     trans_options,
     last_object: bool = False,
 ):
-    ## TODO: For now we don't want to compile function bodies
-    # preprocessed_body = preprocess_close_node(ast_node.body)
-    # ast_node.body = preprocessed_body
+    ## Function bodies are left as they are, unless they are instrumented
+    if not trans_options.instruments_function_bodies():
+        preprocessed_ast_object = PreprocessedAST(
+            ast_node,
+            replace_whole=False,
+            non_maximal=False,
+            something_replaced=False,
+            last_ast=last_object,
+        )
+        return preprocessed_ast_object
+
+    ## The body is preprocessed once, where the function is defined, with its region ids
+    ## scoped to the function, and it calls the runtime's hooks on every call
+    scope = trans_options.enter_function(format_arg_chars(ast_node.name))
+    preprocessed_body, _something_replaced = yield from preprocess_close_node(
+        ast_node.body, trans_options
+    )
+    trans_options.leave_function()
+    ast_node.body = make_instrumented_function_body(scope, preprocessed_body)
     preprocessed_ast_object = PreprocessedAST(
-        ast_node,
+        make_instrumented_function_definition(scope, ast_node),
         replace_whole=False,
         non_maximal=False,
-        something_replaced=False,
+        something_replaced=True,
         last_ast=last_object,
     )
     return preprocessed_ast_object
@@ -277,12 +738,19 @@ def preprocess_node_semi(
     trans_options,
     last_object: bool = False,
 ):
+    ## The regions of a sequence are merged, or scheduled in parallel
+    if (
+        trans_options.get_granularity() != "command"
+        or trans_options.schedules_parallel_regions()
+    ):
+        return (yield from preprocess_sequence(ast_node, trans_options, last_object=last_object))
+
     ##
     ## TODO: Is it valid that only the right one is considered the last command?
-    preprocessed_left, sth_replaced_left = preprocess_close_node(
+    preprocessed_left, sth_replaced_left = yield from preprocess_close_node(
         ast_node.left_operand, trans_options, last_object
     )
-    preprocessed_right, sth_replaced_right = preprocess_close_node(
+    preprocessed_right, sth_replaced_right = yield from preprocess_close_node(
         ast_node.right_operand, trans_options, last_object=last_object
     )
     ast_node.left_operand = preprocessed_left
@@ -305,11 +773,17 @@ def preprocess_node_and(
     trans_options,
     last_object: bool = False,
 ):
-    preprocessed_left, sth_replaced_left = preprocess_close_node(
-        ast_node.left_operand, trans_options, last_object=last_object
+    preprocessed_left_object = yield (ast_node.left_operand, last_object)
+    preprocessed_right_object = yield (ast_node.right_operand, last_object)
+    if can_merge_all([preprocessed_left_object, preprocessed_right_object], trans_options):
+        return PreprocessedAST(
+            ast_node, replace_whole=True, non_maximal=False, last_ast=last_object
+        )
+    preprocessed_left, sth_replaced_left = close_preprocessed_node(
+        preprocessed_left_object, trans_options, last_object=last_object
     )
-    preprocessed_right, sth_replaced_right = preprocess_close_node(
-        ast_node.right_operand, trans_options, last_object=last_object
+    preprocessed_right, sth_replaced_right = close_preprocessed_node(
+        preprocessed_right_object, trans_options, last_object=last_object
     )
     ast_node.left_operand = preprocessed_left
     ast_node.right_operand = preprocessed_right
@@ -329,11 +803,17 @@ def preprocess_node_or(
     trans_options,
     last_object: bool = False,
 ):
-    preprocessed_left, sth_replaced_left = preprocess_close_node(
-        ast_node.left_operand, trans_options, last_object=last_object
+    preprocessed_left_object = yield (ast_node.left_operand, last_object)
+    preprocessed_right_object = yield (ast_node.right_operand, last_object)
+    if can_merge_all([preprocessed_left_object, preprocessed_right_object], trans_options):
+        return PreprocessedAST(
+            ast_node, replace_whole=True, non_maximal=False, last_ast=last_object
+        )
+    preprocessed_left, sth_replaced_left = close_preprocessed_node(
+        preprocessed_left_object, trans_options, last_object=last_object
     )
-    preprocessed_right, sth_replaced_right = preprocess_close_node(
-        ast_node.right_operand, trans_options, last_object=last_object
+    preprocessed_right, sth_replaced_right = close_preprocessed_node(
+        preprocessed_right_object, trans_options, last_object=last_object
     )
     ast_node.left_operand = preprocessed_left
     ast_node.right_operand = preprocessed_right
@@ -354,8 +834,13 @@ def preprocess_node_not(
     last_object: bool = False,
 ):
     # preprocessed_left, should_replace_whole_ast, is_non_maximal = preprocess_node(ast_node.left)
-    preprocessed_body, sth_replaced = preprocess_close_node(
-        ast_node.body, trans_options, last_object=last_object
+    preprocessed_body_object = yield (ast_node.body, last_object)
+    if can_merge_all([preprocessed_body_object], trans_options):
+        return PreprocessedAST(
+            ast_node, replace_whole=True, non_maximal=False, last_ast=last_object
+        )
+    preprocessed_body, sth_replaced = close_preprocessed_node(
+        preprocessed_body_object, trans_options, last_object=last_object
     )
     ast_node.body = preprocessed_body
     preprocessed_ast_object = PreprocessedAST(
@@ -373,15 +858,17 @@ def preprocess_node_if(
     trans_options,
     last_object: bool = False,
 ):
-    preprocessed_cond, sth_replaced_cond = preprocess_close_node(
+    preprocessed_cond, sth_replaced_cond = yield from preprocess_close_node(
         ast_node.cond, trans_options, last_object=last_object
     )
-    preprocessed_then, sth_replaced_then = preprocess_close_node(
+    preprocessed_then, sth_replaced_then = yield from preprocess_close_node(
         ast_node.then_b, trans_options, last_object=last_object
     )
-    preprocessed_else, sth_replaced_else = preprocess_close_node(
-        ast_node.else_b, trans_options, last_object=last_object
-    ) if ast_node.else_b is not None else (None, False)
+    preprocessed_else, sth_replaced_else = None, False
+    if ast_node.else_b is not None:
+        preprocessed_else, sth_replaced_else = yield from preprocess_close_node(
+            ast_node.else_b, trans_options, last_object=last_object
+        )
     ast_node.cond = preprocessed_cond
     ast_node.then_b = preprocessed_then
     ast_node.else_b = preprocessed_else
@@ -399,9 +886,11 @@ def preprocess_node_if(
 def preprocess_case(
     case, trans_options, last_object: bool
 ):
-    preprocessed_body, sth_replaced = preprocess_close_node(
-        case["cbody"], trans_options, last_object=last_object
-    ) if case["cbody"] is not None else (None, False)
+    preprocessed_body, sth_replaced = None, False
+    if case["cbody"] is not None:
+        preprocessed_body, sth_replaced = yield from preprocess_close_node(
+            case["cbody"], trans_options, last_object=last_object
+        )
     case["cbody"] = preprocessed_body
     return case, sth_replaced
 
@@ -411,10 +900,11 @@ def preprocess_node_case(
     trans_options,
     last_object: bool = False,
 ):
-    preprocessed_cases_replaced = [
-        preprocess_case(case, trans_options, last_object=last_object)
-        for case in ast_node.cases
-    ]
+    preprocessed_cases_replaced = []
+    for case in ast_node.cases:
+        preprocessed_cases_replaced.append(
+            (yield from preprocess_case(case, trans_options, last_object=last_object))
+        )
     preprocessed_cases, sth_replaced_cases = list(zip(*preprocessed_cases_replaced))
     ast_node.cases = preprocessed_cases
     preprocessed_ast_object = PreprocessedAST(
@@ -428,7 +918,9 @@ def preprocess_node_case(
 
 def preprocess_node_select(ast_node, trans_options, last_object=False):
     ast_node: SelectNode = ast_node
-    preprocessed_body, sth_replaced = preprocess_close_node(ast_node.body, trans_options, last_object=last_object)
+    if stubs_whole_loop(ast_node, trans_options, "select"):
+        return preprocess_loop(ast_node, trans_options, last_object, "body")
+    preprocessed_body, sth_replaced = yield from preprocess_close_node(ast_node.body, trans_options, last_object=last_object)
     ast_node.body = preprocessed_body
     preprocessed_ast_node = PreprocessedAST(ast_node,
                                             replace_whole=False,
@@ -447,10 +939,12 @@ def preprocess_node_arith(ast_node, trans_options, last_object=False):
 
 def preprocess_node_cond(ast_node, trans_options, last_object=False):
     ast_node: CondNode = ast_node
-    preprocessed_left, sth_replaced_left = preprocess_close_node(ast_node.left, trans_options, last_object=last_object) \
-        if ast_node.left is not None else (None, False)
-    preprocessed_right, sth_replaced_right = preprocess_close_node(ast_node.right, trans_options, last_object=last_object) \
-        if ast_node.right is not None else (None, False)
+    preprocessed_left, sth_replaced_left = None, False
+    if ast_node.left is not None:
+        preprocessed_left, sth_replaced_left = yield from preprocess_close_node(ast_node.left, trans_options, last_object=last_object)
+    preprocessed_right, sth_replaced_right = None, False
+    if ast_node.right is not None:
+        preprocessed_right, sth_replaced_right = yield from preprocess_close_node(ast_node.right, trans_options, last_object=last_object)
     ast_node.left = preprocessed_left
     ast_node.right = preprocessed_right
     sth_replaced = sth_replaced_left or sth_replaced_right
@@ -462,9 +956,11 @@ def preprocess_node_cond(ast_node, trans_options, last_object=False):
     return preprocessed_ast_node
 
 
-def preprocess_node_arith_for(ast_node, trans_options, last_object=False):
+def preprocess_node_arithfor(ast_node, trans_options, last_object=False):
     ast_node: ArithForNode = ast_node
-    preprocessed_action, sth_replaced_action = preprocess_close_node(ast_node.action, trans_options, last_object=last_object)
+    if stubs_whole_loop(ast_node, trans_options, "arith_for"):
+        return preprocess_loop(ast_node, trans_options, last_object, "action")
+    preprocessed_action, sth_replaced_action = yield from preprocess_close_node(ast_node.action, trans_options, last_object=last_object)
     ast_node.action = preprocessed_action
     preprocessed_ast_node = PreprocessedAST(ast_node,
                                             replace_whole=False,
@@ -475,7 +971,7 @@ def preprocess_node_arith_for(ast_node, trans_options, last_object=False):
 
 def preprocess_node_coproc(ast_node, trans_options, last_object=False):
     ast_node: CoprocNode = ast_node
-    preprocessed_body, sth_replaced = preprocess_close_node(ast_node.body, trans_options, last_object=last_object)
+    preprocessed_body, sth_replaced = yield from preprocess_close_node(ast_node.body, trans_options, last_object=last_object)
     ast_node.body = preprocessed_body
     preprocessed_ast_node = PreprocessedAST(ast_node,
                                             replace_whole=False,
@@ -486,7 +982,7 @@ def preprocess_node_coproc(ast_node, trans_options, last_object=False):
 
 def preprocess_node_time(ast_node, trans_options, last_object=False):
     ast_node: TimeNode = ast_node
-    preprocessed_body, sth_replaced = preprocess_close_node(ast_node.command, trans_options, last_object=last_object)
+    preprocessed_body, sth_replaced = yield from preprocess_close_node(ast_node.command, trans_options, last_object=last_object)
     ast_node.command = preprocessed_body
     preprocessed_ast_node = PreprocessedAST(ast_node,
                                             replace_whole=False,
@@ -497,7 +993,7 @@ def preprocess_node_time(ast_node, trans_options, last_object=False):
 
 def preprocess_node_group(ast_node, trans_options, last_object=False):
     ast_node: GroupNode = ast_node
-    preprocessed_body, sth_replaced = preprocess_close_node(ast_node.body, trans_options, last_object=last_object)
+    preprocessed_body, sth_replaced = yield from preprocess_close_node(ast_node.body, trans_options, last_object=last_object)
     ast_node.body = preprocessed_body
     preprocessed_ast_node = PreprocessedAST(ast_node,
                                             replace_whole=False,
@@ -506,24 +1002,73 @@ def preprocess_node_group(ast_node, trans_options, last_object=False):
                                             last_ast=last_object)
     return preprocessed_ast_node
 
+## The preprocessor of every node type (see preprocess_node)
+NODE_PREPROCESSORS = {
+    PipeNode: preprocess_node_pipe,
+    CommandNode: preprocess_node_command,
+    RedirNode: preprocess_node_redir,
+    BackgroundNode: preprocess_node_background,
+    SubshellNode: preprocess_node_subshell,
+    ForNode: preprocess_node_for,
+    WhileNode: preprocess_node_while,
+    DefunNode: preprocess_node_defun,
+    SemiNode: preprocess_node_semi,
+    AndNode: preprocess_node_and,
+    OrNode: preprocess_node_or,
+    NotNode: preprocess_node_not,
+    IfNode: preprocess_node_if,
+    CaseNode: preprocess_node_case,
+    SelectNode: preprocess_node_select,
+    ArithNode: preprocess_node_arith,
+    CondNode: preprocess_node_cond,
+    ArithForNode: preprocess_node_arithfor,
+    CoprocNode: preprocess_node_coproc,
+    TimeNode: preprocess_node_time,
+    GroupNode: preprocess_node_group,
+}
+
+
 def replace_ast_regions(ast_objects, trans_options):
     """
     Replace candidate dataflow AST regions with calls to PaSh's runtime.
     """
-    preprocessed_asts = []
-    candidate_dataflow_region = []
-    last_object = False
-    for i, ast_object in enumerate(ast_objects):
-        # log("Preprocessing AST {}".format(i))
-        # log(ast_object)
-        ## If we are working on the last object we need to keep that in mind when replacing.
-        ##
-        ## The last df-region should not be executed in parallel no matter what (to not lose its exit code.)
-        if i == len(ast_objects) - 1:
-            # log("Last object")
-            last_object = True
+    return [
+        preprocessed_ast
+        for preprocessed_ast, _line_range in replace_ast_regions_with_lines(
+            ast_objects, trans_options
+        )
+    ]
+
 
-        ast, original_text, _linno_before, _linno_after = ast_object
+## Like replace_ast_regions, but also yields the (first, last) source lines
+## that every preprocessed AST comes from (see incremental.py).
+##
+## The ASTs are preprocessed and yielded one at a time, so both the input and
+## the output can be streams (see preprocessor.preprocess_stream).
+def replace_ast_regions_with_lines(ast_objects, trans_options):
+    preprocessed_items = preprocess_top_level_asts(ast_objects, trans_options)
+
+    ## Merge adjacent ASTs into regions (according to the granularity) and replace them
+    final_items = replace_regions_in_sequence(preprocessed_items, trans_options)
+    if trans_options.schedules_parallel_regions():
+        final_items = schedule_parallel_regions(final_items, trans_options)
+    for final_ast, something_replaced, original_text, line_range in final_items:
+        ## In this case, it is possible that no replacement happened,
+        ## meaning that we can simply return the original parsed text as it was.
+        if something_replaced or original_text is None:
+            yield (final_ast, line_range)
+        else:
+            yield (UnparsedScript(original_text, line_range), line_range)
+        ## The regions nested in compound commands (e.g., in an `if`) are never scheduled
+        trans_options.forget_region_effects()
+
+
+def preprocess_top_level_asts(ast_objects, trans_options):
+    ## If we are working on the last object we need to keep that in mind when replacing.
+    ##
+    ## The last df-region should not be executed in parallel no matter what (to not lose its exit code.)
+    for ast_object, last_object in with_last(ast_objects):
+        ast, original_text, linno_before, linno_after = ast_object
         assert isinstance(ast, AstNode)
 
         ## Goals: This transformation can approximate in several directions.
@@ -560,64 +1105,9 @@ def replace_ast_regions(ast_objects, trans_options):
             or preprocessed_ast_object.will_anything_be_replaced()
         )
 
-        ## If it isn't maximal then we just add it to the candidate
-        if preprocessed_ast_object.is_non_maximal():
-            candidate_dataflow_region.append(
-                (preprocessed_ast_object.ast, original_text)
-            )
-        else:
-            ## If the current candidate dataflow region is non-empty
-            ## it means that the previous AST was in the background so
-            ## the current one has to be included in the process no matter what
-            if len(candidate_dataflow_region) > 0:
-                candidate_dataflow_region.append(
-                    (preprocessed_ast_object.ast, original_text)
-                )
-                ## Since the current one is maximal (or not wholy replaced)
-                ## we close the candidate.
-                dataflow_region_asts, dataflow_region_lines = unzip(
-                    candidate_dataflow_region
-                )
-                dataflow_region_text = join_original_text_lines(dataflow_region_lines)
-                replaced_ast = trans_options.replace_df_region(
-                    dataflow_region_asts,
-                    ast_text=dataflow_region_text,
-                    disable_parallel_pipelines=last_object,
-                )
-                candidate_dataflow_region = []
-                preprocessed_asts.append(replaced_ast)
-            else:
-                if preprocessed_ast_object.should_replace_whole_ast():
-                    replaced_ast = trans_options.replace_df_region(
-                        [preprocessed_ast_object.ast],
-                        ast_text=original_text,
-                        disable_parallel_pipelines=last_object,
-                    )
-                    preprocessed_asts.append(replaced_ast)
-                else:
-                    ## In this case, it is possible that no replacement happened,
-                    ## meaning that we can simply return the original parsed text as it was.
-                    if (
-                        preprocessed_ast_object.will_anything_be_replaced()
-                        or original_text is None
-                    ):
-                        preprocessed_asts.append(preprocessed_ast_object.ast)
-                    else:
-                        preprocessed_asts.append(UnparsedScript(original_text))
-
-    ## Close the final dataflow region
-    if len(candidate_dataflow_region) > 0:
-        dataflow_region_asts, dataflow_region_lines = unzip(candidate_dataflow_region)
-        dataflow_region_text = join_original_text_lines(dataflow_region_lines)
-        replaced_ast = trans_options.replace_df_region(
-            dataflow_region_asts,
-            ast_text=dataflow_region_text,
-            disable_parallel_pipelines=True,
-        )
-        candidate_dataflow_region = []
-        preprocessed_asts.append(replaced_ast)
-
-    return preprocessed_asts
+        ## The AST spans the lines after the previous one (which ends at linno_before)
+        line_range = (linno_before + 1, linno_after)
+        yield (preprocessed_ast_object, original_text, line_range, last_object)
 
 
 ## This function joins original unparsed shell source in a safe way
@@ -9,17 +9,58 @@ a preprocessed version. It does NOT execute the script.
 import sys
 import os
 import argparse
+import contextlib
+import hashlib
+import re
+import tempfile
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 import logging
 
+import incremental
 import preprocess_ast_cases
-from parse import parse_shell_to_asts, from_ast_objects_to_shell
-from util import string_to_argument, make_command
-from shasta.json_to_ast import to_ast_node
-
-
-# Global state for runtime executable path
-RUNTIME_EXECUTABLE = None
+from cache import PreprocessingCache, cache_key, DEFAULT_MAX_SIZE
+from incremental import IncrementalIndex, index_key
+from policy import InstrumentationPolicy
+from cost import CostModel
+from effects import region_effects
+from memo import memo_spec
+from region_index import region_index_entry, write_region_index
+from parse import (
+    ParsingError,
+    memory_file,
+    parse_shell_to_asts,
+    iter_shell_to_asts,
+    from_ast_objects_to_shell,
+    ast_object_to_shell_bytes,
+    write_asts_to_shell_file,
+    SourceLines,
+)
+from util import (
+    make_command_node,
+    make_deferred_status_stub,
+    hex_escape,
+    line_range_of,
+)
+
+## Part of the preprocessing cache key; bump it whenever the output changes.
+PREPROCESSOR_VERSION = "0.9"
+
+LOOP_KINDS = ["for", "while", "select", "arith_for"]
+LOOP_POLICIES = ["iteration", "loop"]
+DEFAULT_LOOP_POLICY = {loop_kind: "iteration" for loop_kind in LOOP_KINDS}
+GRANULARITIES = ["command", "sequence", "block"]
+
+DEFERRED_EXIT_STATUS_TRAILER = "__jit_region_exit_status=$?\n"
+
+## A function definition sets $? to 0, so region functions that are defined between two
+## commands of a streamed script are wrapped in these to keep the status of the first one
+## (`&& :` keeps a non-zero status from triggering `set -e`, see make_deferred_status_stub).
+STREAM_DEFINITIONS_PROLOGUE = "__jit_stream_status=$?\n"
+STREAM_DEFINITIONS_EPILOGUE = (
+    '__jit_stream_restore_status()\n{\n    return "$__jit_stream_status"\n}\n'
+    "__jit_stream_restore_status && :\n"
+)
 
 
 def log(*args, level=1):
@@ -35,11 +76,77 @@ def print_time_delta(prefix, start_time, end_time):
     log("{} time:".format(prefix), time_difference, " ms")
 
 
+@dataclass
+class TransformationOptions:
+    """The options of a preprocessing run (see transformation_options for the command line)"""
+
+    ## The runtime (jit.sh) that the stubs source
+    runtime_executable: str = None
+    ## Whether the script is parsed (and its source lines are split) like bash does
+    bash_mode: bool = False
+    ## Either "file" (one file per region) or "function" (regions are
+    ## emitted as functions in the preprocessed script)
+    region_mode: str = "file"
+    ## The policy ("iteration" or "loop") of each loop kind (see preprocess_loop)
+    loop_policy: dict = None
+    ## How many adjacent commands are merged in a region (see replace_regions_in_sequence)
+    granularity: str = "command"
+    ## The maximum number of commands in a merged region (unbounded if None)
+    max_region_size: int = None
+    ## Selects the regions to stub (all of them if None)
+    policy: InstrumentationPolicy = None
+    ## Only selects the regions that are worth stubbing (all of them if None, see cost.py)
+    cost_model: CostModel = None
+    ## Whether stubs pass the source lines of their region to the runtime profiler
+    profile: bool = False
+    ## Whether function bodies are preprocessed (see preprocess_node_defun)
+    function_bodies: bool = False
+    ## Whether adjacent independent regions run in parallel (see schedule_parallel_regions)
+    parallel: bool = False
+    ## Whether deterministic regions replay their earlier executions (see memo.py)
+    memoize: bool = False
+    ## Whether the scripts that `source` reads are preprocessed by the runtime (see
+    ## make_sourced_command)
+    instrument_sourced: bool = False
+
+    def __post_init__(self):
+        if self.loop_policy is None:
+            self.loop_policy = DEFAULT_LOOP_POLICY
+
+
 class TransformationState:
     """Manages state during AST transformation and region replacement"""
 
-    def __init__(self):
-        self._node_counter = 0
+    def __init__(
+        self,
+        options,
+        region_dir=None,
+        region_namespace="0",
+        region_index=False,
+        regions=None,
+        first_id=0,
+    ):
+        ## Region ids continue from first_id (e.g., after the ones of an incremental index)
+        self._node_counter = first_id
+        ## The TransformationOptions of the run
+        self.options = options
+        ## Where region files are written (a fresh temporary file if None)
+        self.region_dir = region_dir
+        ## Every Region (by region id), if regions are kept in memory instead of
+        ## written to region files (see api.py)
+        self.regions = regions
+        ## Prefix of region ids, unique per script so that the region functions
+        ## of different preprocessed scripts do not clash
+        self.region_namespace = region_namespace
+        ## The function that defines every region (by region id) in "function" mode
+        self.region_definitions = {}
+        ## The scopes of the function definitions that are being preprocessed (innermost last)
+        self.function_scopes = []
+        ## The effects of the regions that can run in parallel (by region id, see effects.py)
+        self.region_effects = {}
+        ## The (encoded) region index entries of the regions (by region id), if an index is
+        ## written (None otherwise, see region_index.py)
+        self.region_index_entries = {} if region_index else None
 
     def get_next_id(self):
         new_id = self._node_counter
@@ -52,12 +159,84 @@ class TransformationState:
     def get_number_of_ids(self):
         return self._node_counter
 
-    def replace_df_region(self, asts, disable_parallel_pipelines=False, ast_text=None):
+    def get_next_region_id(self):
+        ## The regions of a function body are scoped to the function
+        if self.function_scopes:
+            return f"{self.region_namespace}_{self.function_scopes[-1]}_{self.get_next_id()}"
+        return f"{self.region_namespace}_{self.get_next_id()}"
+
+    def instruments_function_bodies(self):
+        return self.options.function_bodies
+
+    def instruments_sourced_scripts(self):
+        return self.options.instrument_sourced
+
+    def enter_function(self, function_name):
+        """Starts preprocessing the body of a function and returns its scope"""
+        scope = function_scope_of(function_name)
+        self.function_scopes.append(scope)
+        return scope
+
+    def leave_function(self):
+        self.function_scopes.pop()
+
+    def get_function_scope(self):
+        """The scope of the innermost function body being preprocessed (None if there is none)"""
+        return self.function_scopes[-1] if self.function_scopes else None
+
+    def get_loop_policy(self, loop_kind):
+        return self.options.loop_policy[loop_kind]
+
+    def get_granularity(self):
+        return self.options.granularity
+
+    def is_region_full(self, region_size):
+        max_region_size = self.options.max_region_size
+        return max_region_size is not None and region_size >= max_region_size
+
+    def selects(self, ast_node):
+        policy, cost_model = self.options.policy, self.options.cost_model
+        if policy is not None and not policy.selects(ast_node):
+            return False
+        return cost_model is None or cost_model.selects(ast_node)
+
+    def schedules_parallel_regions(self):
+        return self.options.parallel
+
+    def take_region_effects(self, region_id):
+        """The effects of a region if it can run in parallel (None otherwise), which are forgotten"""
+        return self.region_effects.pop(region_id, None)
+
+    def forget_region_effects(self):
+        self.region_effects = {}
+
+    def get_region_definitions(self):
+        """The shell text that defines the regions emitted as functions"""
+        return "".join(self.region_definitions.values())
+
+    def get_region_definition(self, region_id):
+        return self.region_definitions.get(region_id)
+
+    def take_region_definitions(self):
+        """Like get_region_definitions, but forgets the regions (once they are written out)"""
+        region_definitions = self.get_region_definitions()
+        self.region_definitions = {}
+        return region_definitions
+
+    def replace_df_region(
+        self,
+        asts,
+        disable_parallel_pipelines=False,
+        ast_text=None,
+        region_id=None,
+        defer_exit_status=False,
+        line_range=None,
+    ):
         """Replace a dataflow region with a call to jit.sh runtime"""
         from util import ptempfile
 
-        # Create sequential script file
-        sequential_script_file_name = ptempfile()
+        if region_id is None:
+            region_id = self.get_next_region_id()
 
         # Get shell text from ASTs
         if ast_text is None:
@@ -65,30 +244,155 @@ class TransformationState:
         else:
             text_to_output = ast_text
 
-        # Write script to file
-        with open(sequential_script_file_name, "w", encoding="utf-8") as script_file:
-            script_file.write(text_to_output)
+        ## The region saves its exit status so that evaluating it does not fail (see make_deferred_status_stub)
+        if defer_exit_status:
+            text_to_output += "\n" + DEFERRED_EXIT_STATUS_TRAILER
 
         # Create AST node that calls jit.sh
-        # Generates: __jit_script_to_execute=<file> source jit.sh
+        # Generates: __jit_region_id=<id> [__jit_script_to_execute=<file>] source jit.sh
         assignments = [
-            ["__jit_script_to_execute", string_to_argument(sequential_script_file_name)],
+            ("__jit_region_id", region_id),
         ]
 
-        arguments = [
-            string_to_argument("source"),
-            string_to_argument(RUNTIME_EXECUTABLE),
-        ]
-        runtime_node = make_command(arguments, assignments=assignments)
-
-        return to_ast_node(runtime_node)
-
+        sequential_script_file_name = None
+        if self.options.region_mode == "function":
+            self.region_definitions[region_id] = make_region_function(region_id, text_to_output)
+        else:
+            # Create sequential script file
+            if self.region_dir is None:
+                sequential_script_file_name = ptempfile()
+            else:
+                sequential_script_file_name = os.path.join(
+                    self.region_dir, f"region_{region_id}"
+                )
+
+            # Write script to file (unless the caller keeps the regions, see Region.write)
+            if self.regions is None:
+                with open(sequential_script_file_name, "w", encoding="utf-8") as script_file:
+                    script_file.write(text_to_output)
+
+            assignments.append(("__jit_script_to_execute", sequential_script_file_name))
+
+        if defer_exit_status:
+            assignments.append(("__jit_defer_exit_status", "1"))
+
+        ## The profile maps every region to the source lines that it spans
+        ## (the ones of its commands, unless the caller knows the exact ones)
+        if (
+            self.options.profile
+            or self.region_index_entries is not None
+            or self.regions is not None
+        ) and line_range is None:
+            line_range = line_range_of(asts)
+        if self.options.profile:
+            if line_range is not None:
+                first_line, last_line = line_range
+                assignments.append(("__jit_region_lines", f"{first_line}-{last_line}"))
+
+        ## Regions whose exit status is deferred are never run in parallel, and the last region
+        ## of the script can only run after the regions before it (to not lose its exit status)
+        if self.options.parallel and not defer_exit_status:
+            effects = region_effects(asts)
+            if effects is not None:
+                effects.can_spawn = not disable_parallel_pipelines
+                self.region_effects[region_id] = effects
+
+        if self.region_index_entries is not None:
+            self.region_index_entries[region_id] = region_index_entry(region_id, asts, line_range)
+
+        if self.regions is not None:
+            self.regions[region_id] = Region(
+                region_id, text_to_output, sequential_script_file_name, line_range
+            )
+
+        runtime_node = make_command_node(
+            ["source", self.options.runtime_executable], assignments=assignments
+        )
+
+        ## The exit status of a memoized region is replayed, so it cannot be deferred
+        if self.options.memoize and not defer_exit_status:
+            spec = memo_spec(asts, text_to_output)
+            if spec is not None:
+                runtime_node.assignments.extend(spec.assignments())
+
+        if defer_exit_status:
+            return make_deferred_status_stub(runtime_node)
+        return runtime_node
+
+
+class Region:
+    """A region that the preprocessor replaced with a stub"""
+
+    __slots__ = ("region_id", "text", "path", "line_range")
+
+    def __init__(self, region_id, text, path, line_range):
+        self.region_id = region_id
+        ## The text that the region runs (which jit.sh evaluates)
+        self.text = text
+        ## The region file that the stub names (None if regions are functions)
+        self.path = path
+        ## The first and last source lines of the region (None if unknown)
+        self.line_range = line_range
+
+    def write(self):
+        """Writes the region file that the stub names (if there is one)"""
+        if self.path is not None:
+            with open(self.path, "w", encoding="utf-8") as script_file:
+                script_file.write(self.text)
+
+    def __repr__(self):
+        return f"Region({self.region_id!r}, lines={self.line_range})"
+
+
+## The scope of a function in region ids (and in the runtime's per-function counters), which
+## is its name with every character that cannot be in a region id (see incremental.py) replaced.
+def function_scope_of(function_name):
+    return re.sub(r"[^0-9A-Za-z_]", "_", function_name)
+
+
+def make_region_function(region_id, region_text):
+    """
+    Generates the function that jit.sh calls to get the text of a region.
+    The function only returns the (escaped) text in `__jit_region_code` so that
+    jit.sh can evaluate it in the current context, exactly like a sourced region file.
+    """
+    return f"__jit_region_{region_id}()\n{{\n    __jit_region_code='{hex_escape(region_text)}'\n}}\n"
+
+
+def region_namespace_of(input_script_path):
+    """A short prefix for region ids that is stable for the same script contents"""
+    with open(input_script_path, "rb") as input_file:
+        return region_namespace_of_bytes(input_file.read())
+
+
+def region_namespace_of_bytes(script_bytes):
+    return hashlib.sha256(script_bytes).hexdigest()[:8]
+
+
+def preprocess(
+    input_script_path,
+    output_file,
+    options,
+    region_dir=None,
+    region_index=None,
+):
+    """
+    Preprocess a shell script by parsing, transforming, and unparsing ASTs,
+    and write it to a binary output file (and the metadata of its regions to
+    the region index file, if one is given)
+    """
+    with open(input_script_path, "rb") as input_file:
+        script_bytes = input_file.read()
+    trans_state = TransformationState(
+        options,
+        region_dir=region_dir,
+        region_namespace=region_namespace_of_bytes(script_bytes),
+        region_index=region_index is not None,
+    )
 
-def preprocess(input_script_path, bash_mode=False):
-    """Preprocess a shell script by parsing, transforming, and unparsing ASTs"""
     ## 1. Execute the POSIX shell parser that returns the AST in JSON
     preprocessing_parsing_start_time = datetime.now()
-    ast_objects = parse_shell_to_asts(input_script_path, bash_mode=bash_mode)
+    ast_objects = parse_shell_to_asts(input_script_path, bash_mode=options.bash_mode)
     preprocessing_parsing_end_time = datetime.now()
     print_time_delta(
         "Preprocessing -- Parsing",
@@ -96,10 +400,20 @@ def preprocess(input_script_path, bash_mode=False):
         preprocessing_parsing_end_time,
     )
 
+    preprocess_parsed_script(ast_objects, script_bytes, trans_state, output_file)
+
+    if region_index is not None:
+        write_region_index(region_index, trans_state.region_index_entries)
+        entries = trans_state.region_index_entries
+        log(f"Region index ({len(entries)} regions) written to: {region_index}")
+
+
+def preprocess_parsed_script(ast_objects, script_bytes, trans_state, output_file):
+    """Preprocesses the parsed ASTs of a script and writes it to a binary output file"""
     ## 2. Preprocess ASTs by replacing possible candidates for compilation
     ##    with calls to the PaSh runtime.
     preprocessing_pash_start_time = datetime.now()
-    preprocessed_asts = preprocess_asts(ast_objects)
+    preprocessed_asts = preprocess_asts(ast_objects, trans_state)
     preprocessing_pash_end_time = datetime.now()
     print_time_delta(
         "Preprocessing -- PaSh",
@@ -107,9 +421,16 @@ def preprocess(input_script_path, bash_mode=False):
         preprocessing_pash_end_time,
     )
 
-    ## 3. Translate the new AST back to shell syntax
+    ## 3. Translate the new AST back to shell syntax. The ASTs that were not modified
+    ##    are copied from the source bytes, so only the ones with regions are unparsed.
     preprocessing_unparsing_start_time = datetime.now()
-    preprocessed_shell_script = from_ast_objects_to_shell(preprocessed_asts)
+    ## Regions emitted as functions are defined before the script uses them
+    output_file.write(trans_state.get_region_definitions().encode("utf-8", errors="replace"))
+    write_asts_to_shell_file(
+        preprocessed_asts,
+        output_file,
+        SourceLines(script_bytes, bash_mode=trans_state.options.bash_mode),
+    )
 
     preprocessing_unparsing_end_time = datetime.now()
     print_time_delta(
@@ -117,17 +438,314 @@ def preprocess(input_script_path, bash_mode=False):
         preprocessing_unparsing_start_time,
         preprocessing_unparsing_end_time,
     )
-    return preprocessed_shell_script
 
 
-def preprocess_asts(ast_objects):
+def preprocess_stream(input_script_path, output_file, options, region_dir=None):
+    """
+    Preprocess a shell script like preprocess(), but emit the regions of its top-level
+    commands as they are parsed, writing the commands to an (unbuffered) output file one
+    at a time, so that a shell can run the first ones while the rest are preprocessed.
+    The script is still read as a whole (for its region namespace and source lines).
+    """
+    with open(input_script_path, "rb") as input_file:
+        script_bytes = input_file.read()
+    source_lines = SourceLines(script_bytes, bash_mode=options.bash_mode)
+    trans_state = TransformationState(
+        options,
+        region_dir=region_dir,
+        region_namespace=region_namespace_of_bytes(script_bytes),
+    )
+
+    preprocessing_start_time = datetime.now()
+    first_command_time = None
+    ast_objects = iter_shell_to_asts(input_script_path, bash_mode=options.bash_mode)
+    for preprocessed_ast, _line_range in preprocess_ast_cases.replace_ast_regions_with_lines(
+        ast_objects, trans_state
+    ):
+        ## Regions emitted as functions are defined right before the command that uses them
+        region_definitions = trans_state.take_region_definitions()
+        if region_definitions:
+            region_definitions = (
+                STREAM_DEFINITIONS_PROLOGUE + region_definitions + STREAM_DEFINITIONS_EPILOGUE
+            )
+        write_all(
+            output_file,
+            region_definitions.encode("utf-8", errors="replace")
+            + ast_object_to_shell_bytes(preprocessed_ast, source_lines)
+            + b"\n",
+        )
+        if first_command_time is None:
+            first_command_time = datetime.now()
+            print_time_delta(
+                "Preprocessing -- First command", preprocessing_start_time, first_command_time
+            )
+    print_time_delta("Preprocessing -- Stream", preprocessing_start_time, datetime.now())
+
+
+def write_all(output_file, data):
+    """Writes all the data to an unbuffered file (whose writes can be partial)"""
+    data = memoryview(data)
+    while len(data) > 0:
+        data = data[output_file.write(data):]
+
+
+def preprocess_incremental(input_script_path, index, options):
+    """
+    Preprocess a shell script like preprocess(), but reuse the preprocessed commands
+    of the last run whose lines did not change (see incremental.py)
+    """
+    ## The bytes that are not UTF-8 are kept as surrogates, so that they reach the output
+    ## (and the index) as they are
+    with open(input_script_path, "rb") as input_file:
+        lines = input_file.read().decode("utf-8", errors="surrogateescape").split("\n")
+
+    with index.locked():
+        last_index = index.load()
+        if last_index is None:
+            namespace, first_id, reused_units = region_namespace_of(input_script_path), 0, []
+        else:
+            ## Region ids keep their namespace and new ones never reuse old numbers
+            namespace, first_id = last_index["namespace"], last_index["next_id"]
+            ## With --profile, the stubs contain their line numbers, so they cannot move
+            reused_units = incremental.match_units(
+                last_index["lines"], last_index["units"], lines, allow_moves=not options.profile
+            )
+        log(f"Incremental preprocessing: reusing {len(reused_units)} units")
+
+        trans_state = TransformationState(
+            options,
+            region_dir=index.regions_dir(),
+            region_namespace=namespace,
+            first_id=first_id,
+        )
+        preprocessing_start_time = datetime.now()
+        try:
+            units = preprocess_changed_lines(lines, reused_units, trans_state, options.bash_mode)
+        except ParsingError as e:
+            if len(reused_units) == 0:
+                raise
+            ## The changed lines might only parse together with the rest of the script
+            log(f"Incremental preprocessing: preprocessing the whole script ({e})")
+            units = preprocess_changed_lines(lines, [], trans_state, options.bash_mode)
+        print_time_delta(
+            "Preprocessing -- Incremental",
+            preprocessing_start_time,
+            datetime.now(),
+        )
+
+        index.save(
+            {
+                "namespace": namespace,
+                "next_id": trans_state.get_number_of_ids(),
+                "lines": lines,
+                "units": units,
+            }
+        )
+        index.remove_unused_regions(units, last_index["units"] if last_index is not None else [])
+
+    ## Regions emitted as functions are defined before the script uses them
+    region_definitions = [
+        region_definition
+        for unit in units
+        for region_definition in unit["regions"].values()
+        if region_definition is not None
+    ]
+    unit_texts = [unit["text"] for unit in units if unit["text"] is not None]
+    return "".join(region_definitions) + "\n".join(unit_texts) + "\n"
+
+
+def preprocess_changed_lines(lines, reused_units, trans_state, bash_mode):
+    """Preprocesses the lines that the reused units do not cover and returns all the units"""
+    units = list(reused_units)
+    for (first, last), next_unit in incremental.changed_chunks(reused_units, len(lines)):
+        units += preprocess_chunk(lines, first, last, next_unit, trans_state, bash_mode)
+    return sorted(units, key=lambda unit: unit["first"])
+
+
+def preprocess_chunk(lines, first, last, next_unit, trans_state, bash_mode):
+    """Parses and preprocesses the lines from first to last into units"""
+    ## The chunk is parsed after empty lines, so that line numbers are the same as in the
+    ## script, and together with the next unit, to check that it does not end in the middle
+    ## of a command (e.g., in a quote or a here-document that ends in the next unit).
+    parse_last = last if next_unit is None else next_unit["last"]
+    chunk_bytes = (
+        "\n" * (first - 1) + "\n".join(lines[first - 1 : parse_last]) + "\n"
+    ).encode("utf-8", errors="surrogateescape")
+    fd, chunk_path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as chunk_file:
+            chunk_file.write(chunk_bytes)
+        ast_objects = []
+        for ast_object in parse_shell_to_asts(chunk_path, bash_mode=bash_mode):
+            _ast, _original_text, linno_before, linno_after = ast_object
+            if linno_after <= last:
+                ast_objects.append(ast_object)
+            elif linno_before < last:
+                raise ParsingError(f"lines {first}-{last} end in the middle of a command")
+    finally:
+        os.remove(chunk_path)
+
+    ## Every unit covers the lines after the previous one. Like in preprocess(), the commands
+    ## that were not modified are copied from the source bytes.
+    source_lines = SourceLines(chunk_bytes, bash_mode=bash_mode)
+    units = []
+    previous_last = first - 1
+    for preprocessed_ast, (_ast_first, ast_last) in (
+        preprocess_ast_cases.replace_ast_regions_with_lines(ast_objects, trans_state)
+    ):
+        text = ast_object_to_shell_bytes(preprocessed_ast, source_lines).decode(
+            "utf-8", errors="surrogateescape"
+        )
+        if ast_last <= previous_last:
+            units[-1]["text"] += "\n" + text
+        else:
+            units.append({"first": previous_last + 1, "last": ast_last, "text": text})
+            previous_last = ast_last
+    if len(units) == 0:
+        units.append({"first": first, "last": last, "text": None})
+    units[-1]["last"] = last
+    for unit in units:
+        unit["regions"] = {
+            region_id: trans_state.get_region_definition(region_id)
+            for region_id in incremental.region_ids_of(unit["text"])
+        }
+    return units
+
+
+def preprocess_asts(ast_objects, trans_state):
     """Transform AST objects by replacing regions with JIT runtime calls"""
-    trans_state = TransformationState()
     preprocessed_asts = preprocess_ast_cases.replace_ast_regions(ast_objects, trans_state)
     return preprocessed_asts
 
 
-def parse_args():
+def parse_loop_policy(string):
+    """Parses `POLICY` or `KIND=POLICY,...` into a policy for every loop kind"""
+    loop_policy = dict(DEFAULT_LOOP_POLICY)
+    for item in string.split(","):
+        loop_kind, equals, policy = item.rpartition("=")
+        if policy not in LOOP_POLICIES:
+            raise argparse.ArgumentTypeError(f"invalid loop policy: '{policy}'")
+        if not equals:
+            loop_policy = {loop_kind: policy for loop_kind in LOOP_KINDS}
+        elif loop_kind in LOOP_KINDS:
+            loop_policy[loop_kind] = policy
+        else:
+            raise argparse.ArgumentTypeError(f"invalid loop kind: '{loop_kind}'")
+    return loop_policy
+
+
+def load_policy(policy_path):
+    """Loads an instrumentation policy file (see policy.py)"""
+    try:
+        return InstrumentationPolicy.from_file(policy_path)
+    except (OSError, ValueError) as e:
+        raise argparse.ArgumentTypeError(f"invalid policy file '{policy_path}': {e}")
+
+
+def add_preprocessing_arguments(parser):
+    """Adds the options that affect the preprocessed script (shared with batch.py)"""
+    parser.add_argument(
+        "--runtime-executable",
+        required=True,
+        help="Path to the PaSh runtime executable (jit.sh)"
+    )
+
+    parser.add_argument(
+        "--bash",
+        action="store_true",
+        default=False,
+        help="Interpret the input as a bash script file (experimental)"
+    )
+
+    parser.add_argument(
+        "--region-mode",
+        choices=["file", "function"],
+        default="file",
+        help="Write each region to its own file, or emit regions as functions in the output script"
+    )
+
+    parser.add_argument(
+        "--loop-policy",
+        type=parse_loop_policy,
+        default=DEFAULT_LOOP_POLICY,
+        help="Either a policy for all loops or a comma-separated list of KIND=POLICY, "
+        f"where KIND is one of {', '.join(LOOP_KINDS)} and POLICY is one of {', '.join(LOOP_POLICIES)}; "
+        "'iteration' calls the runtime for the regions of the loop body on every iteration, "
+        "while 'loop' calls it once for the whole loop; defaults to iteration"
+    )
+
+    parser.add_argument(
+        "--granularity",
+        choices=GRANULARITIES,
+        default="command",
+        help="Stub every command as its own region, merge adjacent commands into one region, "
+        "or also merge whole compound commands (without loops); defaults to command"
+    )
+
+    parser.add_argument(
+        "--max-region-size",
+        type=int,
+        default=None,
+        help="Maximum number of commands merged into one region; defaults to no limit"
+    )
+
+    parser.add_argument(
+        "--policy",
+        type=load_policy,
+        default=None,
+        help="A JSON file that selects the regions to stub (see policy.py); defaults to all of them"
+    )
+
+    parser.add_argument(
+        "--cost-threshold",
+        type=float,
+        default=None,
+        help="Only stub the regions whose estimated cost (in rough microseconds, see cost.py) "
+        "is at least this; the decisions are logged with --debug; defaults to stubbing all of them"
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Pass the source lines of every region to the runtime, "
+        "which records a profile when PASH_PROFILE is set (see profile_report.py)"
+    )
+
+    parser.add_argument(
+        "--function-bodies",
+        action="store_true",
+        default=False,
+        help="Also preprocess the bodies of function definitions, with region ids scoped "
+        "to the function, and count the calls of every function and the time spent in it"
+    )
+
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        default=False,
+        help="Run adjacent regions that do not depend on each other (see effects.py) as "
+        "parallel jobs, at most PASH_JIT_JOBS at a time (see runtime/jit_scheduler.sh)"
+    )
+
+    parser.add_argument(
+        "--memoize",
+        action="store_true",
+        default=False,
+        help="Replay the outputs of deterministic regions (see memo.py) when their inputs did "
+        "not change since an earlier execution, from PASH_MEMO_DIR (see runtime/jit_memo.sh)"
+    )
+
+    parser.add_argument(
+        "--instrument-sourced",
+        action="store_true",
+        default=False,
+        help="Make the runtime preprocess the scripts that `source` and `.` commands read, "
+        "once per file in PASH_SOURCE_DIR (see runtime/jit_source.sh)"
+    )
+
+
+def parse_args(argv=None):
     """Parse command-line arguments for the preprocessor"""
     parser = argparse.ArgumentParser(
         description="Preprocess shell scripts for PaSh",
@@ -136,7 +754,7 @@ def parse_args():
 
     parser.add_argument(
         "input_script",
-        help="Path to the input shell script to preprocess"
+        help="Path to the input shell script to preprocess (- to read it from stdin)"
     )
 
     parser.add_argument(
@@ -146,34 +764,122 @@ def parse_args():
     )
 
     parser.add_argument(
-        "--runtime-executable",
-        required=True,
-        help="Path to the PaSh runtime executable (jit.sh)"
+        "-d",
+        "--debug",
+        type=int,
+        default=0,
+        help="Configure debug level; defaults to 0"
+    )
+
+    add_preprocessing_arguments(parser)
+
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory to cache preprocessed scripts in (disabled by default); the regions "
+        "of cached scripts are always functions"
     )
 
     parser.add_argument(
-        "--bash",
+        "--cache-max-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE,
+        help="Maximum size of the preprocessing cache in bytes"
+    )
+
+    parser.add_argument(
+        "--incremental-dir",
+        default=None,
+        help="Directory to keep an index of every script in, so that the next run only "
+        "preprocesses the commands that changed (disabled by default)"
+    )
+
+    parser.add_argument(
+        "--stream",
         action="store_true",
         default=False,
-        help="Interpret the input as a bash script file (experimental)"
+        help="Emit the regions of every top-level command as they are parsed, e.g., "
+        "to a FIFO that a shell runs while it is written (see sh-instrument.sh --stream)"
     )
 
     parser.add_argument(
-        "-d",
-        "--debug",
-        type=int,
-        default=0,
-        help="Configure debug level; defaults to 0"
+        "--region-index",
+        default=None,
+        help="Path to write the metadata of every region to, by region id, so that runtime "
+        "analyses do not parse regions again (see region_index.py)"
     )
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    ## Cached scripts could call the region files of an index, which change on every run
+    if args.cache_dir is not None and args.incremental_dir is not None:
+        parser.error("--cache-dir and --incremental-dir cannot be used together")
+    ## The regions of a reused command could run in parallel with the ones of a changed command
+    if args.parallel and args.incremental_dir is not None:
+        parser.error("--parallel cannot be used with --incremental-dir")
+    ## Both need the whole preprocessed script before writing it
+    if args.stream and (args.cache_dir is not None or args.incremental_dir is not None):
+        parser.error("--stream cannot be used with --cache-dir or --incremental-dir")
+    ## The index is written from the regions of a run, which these reuse or do not wait for
+    if args.region_index is not None and (
+        args.cache_dir is not None or args.incremental_dir is not None or args.stream
+    ):
+        parser.error("--region-index cannot be used with --cache-dir, --incremental-dir or --stream")
+    if args.input_script == "-" and args.incremental_dir is not None:
+        parser.error("--incremental-dir needs the path of the input script")
+    ## Cached scripts define their regions as functions, since another run can evict an
+    ## entry (and so its region files) while its script still runs
+    if args.cache_dir is not None:
+        args.region_mode = "function"
+    return args
+
+
+def transformation_options(args):
+    """The TransformationOptions given by the command-line arguments"""
+    return TransformationOptions(
+        runtime_executable=args.runtime_executable,
+        bash_mode=args.bash,
+        region_mode=args.region_mode,
+        loop_policy=args.loop_policy,
+        granularity=args.granularity,
+        max_region_size=args.max_region_size,
+        policy=args.policy,
+        cost_model=cost_model_of(args),
+        profile=args.profile,
+        function_bodies=args.function_bodies,
+        parallel=args.parallel,
+        memoize=args.memoize,
+        instrument_sourced=args.instrument_sourced,
+    )
 
 
-def main():
+def cost_model_of(args):
+    """The cost model given by the command-line arguments (None if there is none)"""
+    return CostModel(args.cost_threshold) if args.cost_threshold is not None else None
+
+
+def cache_options(args):
+    """The preprocessing options that are part of the cache key"""
+    return {
+        "version": PREPROCESSOR_VERSION,
+        "bash": args.bash,
+        "runtime_executable": args.runtime_executable,
+        "region_mode": args.region_mode,
+        "loop_policy": args.loop_policy,
+        "granularity": args.granularity,
+        "max_region_size": args.max_region_size,
+        "policy": args.policy.to_json() if args.policy is not None else None,
+        "cost_threshold": args.cost_threshold,
+        "profile": args.profile,
+        "function_bodies": args.function_bodies,
+        "parallel": args.parallel,
+        "memoize": args.memoize,
+        "instrument_sourced": args.instrument_sourced,
+    }
+
+
+def main(argv=None):
     """Main entry point for the preprocessor"""
-    global RUNTIME_EXECUTABLE
-
-    args = parse_args()
+    args = parse_args(argv)
 
     # Initialize logging
     logging.basicConfig(format="%(message)s")
@@ -182,24 +888,100 @@ def main():
     elif args.debug >= 2:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    # Set runtime executable path
-    RUNTIME_EXECUTABLE = args.runtime_executable
+    ## A script on stdin (e.g., the command of `sh-instrument.sh -c`) is kept in a memory
+    ## file while it is preprocessed, since the parsers only read files
+    with contextlib.ExitStack() as input_files:
+        if args.input_script == "-":
+            args.input_script = input_files.enter_context(memory_file(read_stdin()))
+        preprocess_main(args)
+
+
+def read_stdin():
+    with open(0, "rb", closefd=False) as stdin:
+        return stdin.read()
+
 
+def preprocess_main(args):
+    """Preprocesses the input script as the command-line arguments say, and exits"""
     log("Preprocessor starting...")
     log(f"Input script: {args.input_script}")
     log(f"Output file: {args.output}")
     log(f"Runtime executable: {args.runtime_executable}")
     log(f"Bash mode: {args.bash}")
+    log(f"Region mode: {args.region_mode}")
+    log(f"Loop policy: {args.loop_policy}")
+    log(f"Granularity: {args.granularity} (max region size: {args.max_region_size})")
+    log(f"Policy: {args.policy.to_json() if args.policy is not None else None}")
+    log(f"Cost threshold: {args.cost_threshold}")
+    log(f"Profile: {args.profile}")
+    log(f"Function bodies: {args.function_bodies}")
+    log(f"Parallel: {args.parallel}")
+    log(f"Memoize: {args.memoize}")
+    log(f"Instrument sourced scripts: {args.instrument_sourced}")
+    log(f"Cache directory: {args.cache_dir}")
+    log(f"Incremental directory: {args.incremental_dir}")
+    log(f"Stream: {args.stream}")
+    log(f"Region index: {args.region_index}")
     log("-" * 40)
 
+    if args.stream:
+        try:
+            ## Unbuffered, so that every command reaches the shell as soon as it is written
+            with open(args.output, "wb", buffering=0) as output_file:
+                preprocess_stream(args.input_script, output_file, transformation_options(args))
+        except BrokenPipeError:
+            ## The shell exited before reading the whole script (e.g., it ran `exit`)
+            log("The reader of the preprocessed script exited early")
+        except Exception as e:
+            log(f"ERROR: Preprocessing failed: {e}", level=0)
+            sys.exit(1)
+        log(f"Preprocessed script streamed to: {args.output}")
+        log("-" * 40)
+        sys.exit(0)
+
     # Preprocess the script
     try:
-        preprocessed_script = preprocess(args.input_script, bash_mode=args.bash)
+        cache = None
+        if args.cache_dir is not None:
+            cache = PreprocessingCache(args.cache_dir, args.cache_max_size)
+            with open(args.input_script, "rb") as input_file:
+                key = cache_key(input_file.read(), cache_options(args))
+            if cache.lookup(key, args.output):
+                log(f"Preprocessing cache hit: {key}")
+                log(f"Preprocessed script written to: {args.output}")
+                log("-" * 40)
+                sys.exit(0)
+            log(f"Preprocessing cache miss: {key}")
+            if not cache.reserve(key):
+                ## Another process is filling this entry, so we just do not cache
+                cache = None
 
         # Write the preprocessed script to output file
-        with open(args.output, "wb") as output_file:
-            preprocessed_script_bytes = preprocessed_script.encode("utf-8", errors="replace")
-            output_file.write(preprocessed_script_bytes)
+        try:
+            with open(args.output, "wb") as output_file:
+                if args.incremental_dir is not None:
+                    index = IncrementalIndex(
+                        args.incremental_dir, index_key(args.input_script, cache_options(args))
+                    )
+                    preprocessed_script = preprocess_incremental(
+                        args.input_script, index, transformation_options(args)
+                    )
+                    output_file.write(
+                        preprocessed_script.encode("utf-8", errors="surrogateescape")
+                    )
+                else:
+                    preprocess(
+                        args.input_script,
+                        output_file,
+                        transformation_options(args),
+                        region_index=args.region_index,
+                    )
+        except BaseException:
+            if cache is not None:
+                cache.abandon(key)
+            raise
+        if cache is not None:
+            cache.commit(key, args.output)
 
         log(f"Preprocessed script written to: {args.output}")
         log("-" * 40)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Profile report - Ranks the regions of a profiled run by their time and JIT overhead.
+
+The profile is written by `sh-instrument.sh --profile FILE` and has one
+tab-separated record per line:
+
+  S <script>                                                 the profiled script
+  X <region id> <first>-<last> <overhead> <body> <status>    one region execution (times in us)
+  F <function> <calls> <time>                                one outermost call of a function
+
+See runtime/jit_profile.sh for how the times are measured. Functions are only
+recorded if their bodies are instrumented (see runtime/jit_function_call.sh),
+and the ids of the regions in their bodies are scoped to them.
+"""
+
+import sys
+import argparse
+
+SORT_KEYS = ["total", "calls", "overhead"]
+
+
+class RegionProfile:
+    """The aggregated executions of a region"""
+
+    def __init__(self, region_id, lines):
+        self.region_id = region_id
+        self.lines = lines
+        self.calls = 0
+        self.failures = 0
+        self.overhead = 0
+        self.body = 0
+
+    def add_execution(self, overhead, body, exit_status):
+        self.calls += 1
+        self.overhead += overhead
+        self.body += body
+        if exit_status != 0:
+            self.failures += 1
+
+    def total(self):
+        return self.overhead + self.body
+
+    def overhead_ratio(self):
+        return self.overhead / self.total() if self.total() > 0 else 0.0
+
+    def sort_key(self, sort_by):
+        if sort_by == "calls":
+            return (self.calls, self.total())
+        if sort_by == "overhead":
+            return (self.overhead, self.total())
+        return (self.total(), self.calls)
+
+
+class FunctionProfile:
+    """The aggregated calls of a function, and of the regions in its body"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.calls = 0
+        self.time = 0
+        self.region_calls = 0
+        self.region_body = 0
+        self.region_overhead = 0
+
+    def add_calls(self, calls, time):
+        self.calls += calls
+        self.time += time
+
+    def add_region(self, region):
+        self.region_calls += region.calls
+        self.region_body += region.body
+        self.region_overhead += region.overhead
+
+    def sort_key(self, sort_by):
+        if sort_by == "calls":
+            return (self.calls, self.time)
+        if sort_by == "overhead":
+            return (self.region_overhead, self.time)
+        return (self.time, self.calls)
+
+
+## Region ids are <namespace>_<n>, or <namespace>_<scope>_<n> in a function body
+def function_scope_of(region_id):
+    parts = region_id.split("_", 1)[-1].rsplit("_", 1)
+    return parts[0] if len(parts) == 2 else None
+
+
+def read_profile(profile_file):
+    """
+    Returns the profiled script (None if unknown), the profile of every region,
+    and the profile of every function (by scope)
+    """
+    script = None
+    regions = {}
+    functions = {}
+    for line_number, line in enumerate(profile_file, start=1):
+        fields = line.rstrip("\n").split("\t")
+        try:
+            if fields[0] == "S" and len(fields) == 2:
+                script = None if fields[1] == "-" else fields[1]
+            elif fields[0] == "X" and len(fields) == 6:
+                region_id, lines, overhead, body, exit_status = fields[1:]
+                if region_id not in regions:
+                    regions[region_id] = RegionProfile(region_id, lines)
+                regions[region_id].add_execution(int(overhead), int(body), int(exit_status))
+            elif fields[0] == "F" and len(fields) == 4:
+                scope, calls, time = fields[1], int(fields[2]), int(fields[3])
+                functions.setdefault(scope, FunctionProfile(scope)).add_calls(calls, time)
+            else:
+                raise ValueError(line.rstrip("\n"))
+        except ValueError:
+            ## A record can be cut short if the script was killed while writing it
+            print(f"Skipping malformed record on line {line_number}", file=sys.stderr)
+    for region in regions.values():
+        scope = function_scope_of(region.region_id)
+        if scope is not None:
+            functions.setdefault(scope, FunctionProfile(scope)).add_region(region)
+    return script, list(regions.values()), list(functions.values())
+
+
+def read_source_lines(script):
+    if script is None:
+        return None
+    try:
+        with open(script, encoding="utf-8", errors="replace") as script_file:
+            return script_file.read().splitlines()
+    except OSError:
+        return None
+
+
+## Returns the first source line of a region (shortened to fit in the report)
+def source_of(region, source_lines, width=40):
+    if source_lines is None or region.lines == "-":
+        return ""
+    first_line = int(region.lines.split("-")[0])
+    if not 1 <= first_line <= len(source_lines):
+        return ""
+    text = source_lines[first_line - 1].strip()
+    return text if len(text) <= width else text[: width - 3] + "..."
+
+
+def format_ms(us):
+    return f"{us / 1000:.3f}"
+
+
+def print_table(header, rows, output):
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(field.ljust(width) for field, width in zip(row, widths)).rstrip(), file=output)
+
+
+def print_report(script, regions, functions=(), sort_by="total", top=None, output=sys.stdout):
+    source_lines = read_source_lines(script)
+    regions = sorted(regions, key=lambda region: region.sort_key(sort_by), reverse=True)
+    total_overhead = sum(region.overhead for region in regions)
+    total_body = sum(region.body for region in regions)
+    total_calls = sum(region.calls for region in regions)
+
+    print(f"Script: {script if script is not None else '-'}", file=output)
+    print(
+        f"Regions: {len(regions)}, calls: {total_calls}, "
+        f"body: {format_ms(total_body)} ms, overhead: {format_ms(total_overhead)} ms",
+        file=output,
+    )
+    print(file=output)
+    header = [
+        "region", "lines", "calls", "failed", "total_ms", "body_ms", "overhead_ms", "overhead_%", "source"
+    ]
+    rows = [
+        [
+            region.region_id,
+            region.lines,
+            str(region.calls),
+            str(region.failures),
+            format_ms(region.total()),
+            format_ms(region.body),
+            format_ms(region.overhead),
+            f"{100 * region.overhead_ratio():.1f}",
+            source_of(region, source_lines),
+        ]
+        for region in regions[:top]
+    ]
+    print_table(header, rows, output)
+
+    if not functions:
+        return
+    functions = sorted(functions, key=lambda function: function.sort_key(sort_by), reverse=True)
+    print(file=output)
+    print(f"Functions: {len(functions)}", file=output)
+    print(file=output)
+    header = ["function", "calls", "total_ms", "region_calls", "region_body_ms", "region_overhead_ms"]
+    rows = [
+        [
+            function.scope,
+            str(function.calls),
+            format_ms(function.time),
+            str(function.region_calls),
+            format_ms(function.region_body),
+            format_ms(function.region_overhead),
+        ]
+        for function in functions[:top]
+    ]
+    print_table(header, rows, output)
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments for the profile report"""
+    parser = argparse.ArgumentParser(
+        description="Rank the regions of a profiled run by time, calls, and instrumentation overhead",
+        prog="profile_report.py"
+    )
+
+    parser.add_argument(
+        "profile",
+        help="Path to the profile written by `sh-instrument.sh --profile`"
+    )
+
+    parser.add_argument(
+        "--sort",
+        choices=SORT_KEYS,
+        default="total",
+        help="Rank regions (and functions) by their total time, number of calls, "
+        "or JIT overhead; defaults to total"
+    )
+
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=None,
+        help="Only report the first N regions"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main entry point for the profile report"""
+    args = parse_args(argv)
+    with open(args.profile, encoding="utf-8", errors="replace") as profile_file:
+        script, regions, functions = read_profile(profile_file)
+    print_report(script, regions, functions, sort_by=args.sort, top=args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Region index - The metadata of every region of a preprocessed script, so that runtime
+analyses can look a region up by its id (`$JIT_REGION_ID` in jit.sh) instead of parsing
+its text again.
+
+The preprocessor writes the index with `--region-index FILE`. Every entry is a JSON
+object with the region's id, source lines, serialized shasta AST (a list of the ASTs of
+the region, see `AstNode.json()`), the variables that it reads and writes, the commands
+that it invokes, and its redirections:
+
+  {"id": ..., "lines": [<first>, <last>] or null, "ast": [...],
+   "variables": {"read": [...], "written": [...]}, "commands": [...],
+   "redirections": [{"fd": <fd>, "type": <type>, "target": <word or null>}, ...]}
+
+The variables and commands are found syntactically (e.g., `x=1`, `read x`, `$x`), so
+the ones that a region uses through `eval` or functions are not in them.
+
+The index is a binary file that can be memory-mapped, and looking a region up only
+decodes its entry:
+
+  header   MAGIC, <number of regions> (u32), <offset of the table> (u32)
+  entries  the entries, as compact UTF-8 JSON
+  table    for every region (sorted by id): <offset> <length> of its id, and
+           <offset> <length> of its entry (u32 each, little-endian)
+
+where the ids are stored next to their entries. To print the entries of some regions
+(or of all of them) as JSON lines:
+
+  python3 preprocessor/region_index.py index.bin [REGION_ID ...]
+"""
+
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+
+MAGIC = b"SHRIDX01"
+HEADER = struct.Struct("<8sII")
+TABLE_ENTRY = struct.Struct("<IIII")
+
+## The builtins that assign the variables in their (non-option) arguments
+ASSIGNING_BUILTINS = {"declare", "export", "local", "readonly", "typeset", "unset"}
+READING_BUILTINS = {"read", "mapfile", "readarray"}
+WRAPPER_BUILTINS = {"builtin", "command"}
+VARIABLE_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+## Variables in the raw words of the bash parser (`$x`, `${x...}`)
+RAW_VARIABLE = re.compile(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)(:?=)?")
+
+
+def region_index_entry(region_id, asts, line_range):
+    """
+    Returns the (encoded) index entry of a region, given its ASTs and its source lines
+    (or None). It is encoded right away, so that the index does not keep the ASTs.
+    """
+    read, written, commands, redirections = region_summary(asts)
+    entry = {
+        "id": region_id,
+        "lines": list(line_range) if line_range is not None else None,
+        "ast": asts,
+        "variables": {"read": sorted(read), "written": sorted(written)},
+        "commands": commands,
+        "redirections": redirections,
+    }
+    return json.dumps(entry, separators=(",", ":"), default=lambda node: node.json()).encode(
+        "utf-8"
+    )
+
+
+def region_summary(asts):
+    """Returns the variables that a region reads and writes, its commands, and its redirections"""
+    ## These are only imported when an index is built, since the reader does not need them
+    from util import format_arg_chars
+    from shasta.ast_node import (
+        AssignNode,
+        CArgChar,
+        CommandNode,
+        ForNode,
+        RedirectionNode,
+        SelectNode,
+        VArgChar,
+    )
+
+    read, written, commands, redirections = set(), set(), [], []
+    stack = list(reversed(asts))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            ## A word of the bash parser, which keeps words as their raw characters
+            if node and all(isinstance(arg_char, CArgChar) and arg_char.bash_mode for arg_char in node):
+                for name, assign in RAW_VARIABLE.findall(format_arg_chars(node)):
+                    read.add(name)
+                    if assign:
+                        written.add(name)
+                continue
+            stack.extend(reversed(node))
+            continue
+        if isinstance(node, tuple):
+            stack.extend(reversed(node))
+            continue
+        if isinstance(node, dict):
+            stack.extend(reversed(list(node.values())))
+            continue
+        if isinstance(node, CArgChar):
+            continue
+        if isinstance(node, AssignNode):
+            written.add(node.var)
+        elif isinstance(node, VArgChar):
+            read.add(node.var)
+            if node.fmt == "Assign":
+                written.add(node.var)
+        elif isinstance(node, (ForNode, SelectNode)):
+            written.add(format_arg_chars(node.variable))
+        elif isinstance(node, CommandNode):
+            words = [format_arg_chars(argument) for argument in node.arguments]
+            while words and words[0] in WRAPPER_BUILTINS:
+                words = words[1:]
+            if words:
+                if words[0] not in commands:
+                    commands.append(words[0])
+                written.update(assigned_variables(words))
+        if isinstance(node, RedirectionNode):
+            redirections.append(redirection_metadata(node, format_arg_chars))
+        if hasattr(node, "__dict__"):
+            stack.extend(reversed(list(vars(node).values())))
+    return read, written, commands, redirections
+
+
+## The variables that a builtin assigns (e.g., `read -r x y`, `local x=1`, `printf -v x`)
+def assigned_variables(words):
+    name, arguments = words[0], words[1:]
+    if name == "printf" and len(arguments) >= 2 and arguments[0] == "-v":
+        arguments = arguments[1:2]
+    elif name == "getopts" and len(arguments) >= 2:
+        arguments = arguments[1:2]
+    elif name not in ASSIGNING_BUILTINS and name not in READING_BUILTINS:
+        return []
+    variables = []
+    for argument in arguments:
+        if argument.startswith("-"):
+            continue
+        variable = argument.split("=", 1)[0]
+        if VARIABLE_NAME.fullmatch(variable):
+            variables.append(variable)
+    return variables
+
+
+def redirection_metadata(redirection, format_arg_chars):
+    fd = redirection.fd[1] if redirection.fd[0] == "fixed" else format_arg_chars(redirection.fd[1])
+    if redirection.NodeName == "Dup":
+        ## The bash parser keeps the target descriptor as a number, and the POSIX one as a word
+        target = redirection.arg[1]
+        target = str(target) if redirection.arg[0] == "fixed" else format_arg_chars(target)
+        return {"fd": fd, "type": redirection.dup_type, "target": target}
+    if redirection.NodeName == "Heredoc":
+        return {"fd": fd, "type": redirection.heredoc_type, "target": None}
+    if redirection.NodeName == "SingleArg":
+        if redirection.redir_type == "CloseThis":
+            return {"fd": fd, "type": redirection.redir_type, "target": None}
+        ## `&> f` keeps its target in place of the descriptor
+        return {"fd": None, "type": redirection.redir_type, "target": fd}
+    return {"fd": fd, "type": redirection.redir_type, "target": format_arg_chars(redirection.arg)}
+
+
+def write_region_index(path, entries):
+    """Writes the index of some encoded entries (by region id), replacing the file atomically"""
+    ids = sorted(entries)
+    data = bytearray(HEADER.size)
+    table = []
+    for region_id in ids:
+        key = region_id.encode("utf-8")
+        entry = entries[region_id]
+        table.append((len(data), len(key), len(data) + len(key), len(entry)))
+        data += key
+        data += entry
+    HEADER.pack_into(data, 0, MAGIC, len(ids), len(data))
+    for table_entry in table:
+        data += TABLE_ENTRY.pack(*table_entry)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as index_file:
+        index_file.write(data)
+    os.replace(temporary_path, path)
+
+
+class RegionIndex:
+    """A region index, memory-mapped, whose entries are decoded when they are looked up"""
+
+    def __init__(self, path):
+        with open(path, "rb") as index_file:
+            if os.fstat(index_file.fileno()).st_size < HEADER.size:
+                raise ValueError(f"{path} is not a region index")
+            self.data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.table_offset = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a region index")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.data.close()
+
+    def table_entry(self, i):
+        return TABLE_ENTRY.unpack_from(self.data, self.table_offset + i * TABLE_ENTRY.size)
+
+    def region_id(self, i):
+        key_offset, key_length, _offset, _length = self.table_entry(i)
+        return self.data[key_offset:key_offset + key_length].decode("utf-8")
+
+    def region_ids(self):
+        return [self.region_id(i) for i in range(self.count)]
+
+    def get(self, region_id):
+        """Returns the entry of a region (None if it is not in the index)"""
+        key = region_id.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, offset, length = self.table_entry(middle)
+            middle_key = self.data[key_offset:key_offset + key_length]
+            if middle_key == key:
+                return json.loads(self.data[offset:offset + length])
+            if middle_key < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments for the region index"""
+    parser = argparse.ArgumentParser(
+        description="Print the entries of a region index as JSON lines",
+        prog="region_index.py"
+    )
+
+    parser.add_argument(
+        "index",
+        help="Path to the index written by `preprocessor.py --region-index`"
+    )
+
+    parser.add_argument(
+        "region_ids",
+        nargs="*",
+        help="The regions to print (all of them by default)"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main entry point for the region index"""
+    args = parse_args(argv)
+    exit_code = 0
+    with RegionIndex(args.index) as index:
+        for region_id in args.region_ids or index.region_ids():
+            entry = index.get(region_id)
+            if entry is None:
+                print(f"Region {region_id} is not in the index", file=sys.stderr)
+                exit_code = 1
+                continue
+            print(json.dumps(entry))
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
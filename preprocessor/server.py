@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Preprocessing server - Keeps the preprocessor warm and serves requests over a Unix socket.
+
+The server imports the parsers and initializes libdash once, and then forks a
+child for every request so that concurrent requests do not share parser state.
+Each request carries the working directory and the command-line arguments of a
+`preprocessor.py` invocation together with the client's stdin, stdout and stderr
+(passed as SCM_RIGHTS ancillary data), so the child behaves exactly like a
+one-shot preprocessor run. The child answers with a single byte: its exit code.
+
+The client side is `runtime/preprocess-client`, which `sh-instrument.sh` uses
+when `PASH_PREPROCESSOR_SOCKET` points to a running server.
+"""
+
+import sys
+import os
+import argparse
+import logging
+import signal
+import socket
+import socketserver
+import struct
+
+import preprocessor
+from parse import warm_up_parsers
+
+
+## Number of file descriptors sent by the client: stdin, stdout, stderr
+CLIENT_FDS = 3
+RECV_BUFFER_SIZE = 65536
+
+
+def log(*args, level=1):
+    preprocessor.log(*args, level=level)
+
+
+def peer_uid(connection):
+    """Returns the uid of the process on the other end of a Unix socket"""
+    creds = connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _pid, uid, _gid = struct.unpack("3i", creds)
+    return uid
+
+
+def receive_request(connection):
+    """Receives the client fds and the NUL-separated cwd and arguments"""
+    data, fds, _flags, _addr = socket.recv_fds(
+        connection, RECV_BUFFER_SIZE, CLIENT_FDS
+    )
+    chunks = [data]
+    while data:
+        data = connection.recv(RECV_BUFFER_SIZE)
+        chunks.append(data)
+    fields = b"".join(chunks).split(b"\0")
+    ## The payload is NUL-terminated so the last field is always empty
+    fields = [os.fsdecode(field) for field in fields[:-1]]
+    return fds, fields[0], fields[1:]
+
+
+def run_request(fds, cwd, argv):
+    """Runs the preprocessor with the client's fds, cwd and arguments"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for target_fd, client_fd in enumerate(fds):
+        os.dup2(client_fd, target_fd)
+        os.close(client_fd)
+    os.chdir(cwd)
+
+    ## The child must start from the same logging state as a one-shot run
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        preprocessor.main(argv)
+        exit_code = 0
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return exit_code
+
+
+class PreprocessRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        connection = self.request
+        if peer_uid(connection) != os.getuid():
+            log("Rejecting connection from a different user")
+            return
+        fds, cwd, argv = receive_request(connection)
+        if len(fds) != CLIENT_FDS:
+            log("Rejecting request without the client fds")
+            for fd in fds:
+                os.close(fd)
+            return
+        exit_code = run_request(fds, cwd, argv)
+        connection.sendall(bytes([exit_code & 0xFF]))
+
+
+class ForkingUnixStreamServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def parse_args():
+    """Parse command-line arguments for the preprocessing server"""
+    parser = argparse.ArgumentParser(
+        description="Serve preprocessing requests over a Unix socket",
+        prog="server.py"
+    )
+
+    parser.add_argument(
+        "--socket",
+        required=True,
+        help="Path of the Unix socket to listen on"
+    )
+
+    parser.add_argument(
+        "-d",
+        "--debug",
+        type=int,
+        default=0,
+        help="Configure debug level; defaults to 0"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """Main entry point for the preprocessing server"""
+    args = parse_args()
+
+    logging.basicConfig(format="%(message)s")
+    if args.debug >= 1:
+        logging.getLogger().setLevel(logging.INFO)
+
+    ## Load both parsers and initialize libdash before accepting requests
+    warm_up_parsers()
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    ## Only the current user may connect to the socket
+    old_umask = os.umask(0o177)
+    try:
+        server = ForkingUnixStreamServer(args.socket, PreprocessRequestHandler)
+    finally:
+        os.umask(old_umask)
+
+    ## Remove the socket when stopped with SIGTERM as well as with SIGINT
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+
+    log(f"Preprocessing server listening on: {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
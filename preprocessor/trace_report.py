@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Trace report - Decodes the trace of a run, as a timeline or as a summary per region.
+
+The trace is written by `sh-instrument.sh --trace FILE` and has one JSON
+record per line, sorted by time:
+
+  {"time": <s>, "pid": <pid>, "region": <region id>, "phase": <phase>, "status": <status>}
+
+where the phases of a region execution are `enter`, `body`, and `exit`, or
+only `bypass` if the region was hot. See runtime/jit_trace.sh for details.
+"""
+
+import sys
+import argparse
+import json
+
+PHASES = ["enter", "body", "exit", "bypass"]
+
+
+class RegionTrace:
+    """The executions of a region in a trace"""
+
+    def __init__(self, region_id):
+        self.region_id = region_id
+        self.executions = 0
+        self.bypassed = 0
+        self.failures = 0
+        self.unfinished = 0
+        self.total = 0.0
+        self.body = 0.0
+        self.pids = set()
+
+    def add_execution(self, pid, enter_time, body_time, exit_time, exit_status):
+        self.executions += 1
+        self.pids.add(pid)
+        self.total += exit_time - enter_time
+        if body_time is not None:
+            self.body += exit_time - body_time
+        if exit_status != 0:
+            self.failures += 1
+
+    def add_bypass(self, pid, exit_status):
+        self.executions += 1
+        self.bypassed += 1
+        self.pids.add(pid)
+        if exit_status != 0:
+            self.failures += 1
+
+    def add_unfinished(self, pid):
+        self.executions += 1
+        self.unfinished += 1
+        self.pids.add(pid)
+
+
+def read_trace(trace_file):
+    """Returns the records of a trace (as dicts), in the order they were written"""
+    records = []
+    for line_number, line in enumerate(trace_file, start=1):
+        try:
+            record = json.loads(line)
+            if record["phase"] not in PHASES:
+                raise ValueError(record["phase"])
+            records.append(record)
+        except (ValueError, KeyError, TypeError):
+            ## A record can be cut short if the script was killed while writing it
+            print(f"Skipping malformed record on line {line_number}", file=sys.stderr)
+    return records
+
+
+def summarize(records):
+    """
+    Returns the trace of every region, matching the `exit` of every execution with the
+    last `enter` of the same region in the same process (since regions can be nested)
+    """
+    regions = {}
+    open_executions = {}
+    for record in records:
+        pid, region_id = record["pid"], record["region"]
+        if region_id not in regions:
+            regions[region_id] = RegionTrace(region_id)
+        stack = open_executions.setdefault(pid, [])
+        if record["phase"] == "enter":
+            stack.append([region_id, record["time"], None])
+        elif record["phase"] == "body":
+            for execution in reversed(stack):
+                if execution[0] == region_id:
+                    execution[2] = record["time"]
+                    break
+        elif record["phase"] == "exit":
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == region_id:
+                    _region_id, enter_time, body_time = stack.pop(i)
+                    regions[region_id].add_execution(
+                        pid, enter_time, body_time, record["time"], record["status"]
+                    )
+                    break
+        else:
+            regions[region_id].add_bypass(pid, record["status"])
+    ## Executions that never exited (e.g., the script exited in them)
+    for pid, stack in open_executions.items():
+        for region_id, _enter_time, _body_time in stack:
+            regions[region_id].add_unfinished(pid)
+    return list(regions.values())
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:.3f}"
+
+
+def print_table(header, rows, output):
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(field.ljust(width) for field, width in zip(row, widths)).rstrip(), file=output)
+
+
+def print_timeline(records, output=sys.stdout):
+    start_time = records[0]["time"] if records else 0
+    header = ["time_ms", "pid", "region", "phase", "status"]
+    rows = [
+        [
+            format_ms(record["time"] - start_time),
+            str(record["pid"]),
+            record["region"],
+            record["phase"],
+            str(record["status"]),
+        ]
+        for record in records
+    ]
+    print_table(header, rows, output)
+
+
+def print_summary(regions, top=None, output=sys.stdout):
+    regions = sorted(regions, key=lambda region: (region.total, region.executions), reverse=True)
+    header = ["region", "executions", "bypassed", "failed", "unfinished", "pids", "total_ms", "body_ms"]
+    rows = [
+        [
+            region.region_id,
+            str(region.executions),
+            str(region.bypassed),
+            str(region.failures),
+            str(region.unfinished),
+            str(len(region.pids)),
+            format_ms(region.total),
+            format_ms(region.body),
+        ]
+        for region in regions[:top]
+    ]
+    print_table(header, rows, output)
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments for the trace report"""
+    parser = argparse.ArgumentParser(
+        description="Decode the trace of a run as a timeline, or summarize it per region",
+        prog="trace_report.py"
+    )
+
+    parser.add_argument(
+        "trace",
+        help="Path to the trace written by `sh-instrument.sh --trace`"
+    )
+
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Summarize the executions of every region instead of printing every record"
+    )
+
+    parser.add_argument(
+        "--pid",
+        type=int,
+        action="append",
+        default=None,
+        help="Only decode the records of this process (can be given several times)"
+    )
+
+    parser.add_argument(
+        "--region",
+        action="append",
+        default=None,
+        help="Only decode the records of this region (can be given several times)"
+    )
+
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=None,
+        help="Only summarize the first N regions (by total time)"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main entry point for the trace report"""
+    args = parse_args(argv)
+    with open(args.trace, encoding="utf-8", errors="replace") as trace_file:
+        records = read_trace(trace_file)
+    if args.pid is not None:
+        records = [record for record in records if record["pid"] in args.pid]
+    if args.region is not None:
+        records = [record for record in records if record["region"] in args.region]
+    if args.summary:
+        print_summary(summarize(records), top=args.top)
+    else:
+        print_timeline(records)
+
+
+if __name__ == "__main__":
+    main()
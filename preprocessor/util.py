@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import tempfile
@@ -5,8 +6,13 @@ import tempfile
 from shasta.ast_node import *
 from shasta.json_to_ast import *
 
+LOGGING_PREFIX = "PaSh:"
+
 ## This class is used by the preprocessor in ast_to_ir
+## (one per preprocessed node, so it only has slots)
 class PreprocessedAST:
+    __slots__ = ("ast", "replace_whole", "non_maximal", "something_replaced", "last_ast")
+
     def __init__(
         self, ast, replace_whole, non_maximal, something_replaced=True, last_ast=False
     ):
@@ -30,11 +36,66 @@ class PreprocessedAST:
         return self.last_ast
 
 
+##
+## Traversal of the AST
+##
+
+
+## Returns the commands that are directly nested in an AST node
+## (not including the ones in arguments, e.g., in command substitutions).
+def command_children(ast_node):
+    for value in vars(ast_node).values():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for child in values:
+            if isinstance(child, dict):
+                child = child.get("cbody")
+            if isinstance(child, (Command, GroupNode)):
+                yield child
+
+
+## Returns an AST node and all the commands nested in it (in pre-order).
+## It keeps an explicit stack so that deeply nested ASTs do not hit the recursion limit.
+def walk_commands(ast_node):
+    stack = [ast_node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(list(command_children(node))))
+
+
+## Returns the (first, last) source lines of the commands in some ASTs,
+## or None if none of them has a line number (e.g., the ones we generate).
+def line_range_of(asts):
+    line_numbers = [
+        node.line_number
+        for ast in asts
+        for node in walk_commands(ast)
+        if getattr(node, "line_number", None) is not None and node.line_number > 0
+    ]
+    if len(line_numbers) == 0:
+        return None
+    return min(line_numbers), max(line_numbers)
+
+
+## Returns the smallest line range that contains all the given ones (None if any is unknown).
+def join_line_ranges(line_ranges):
+    if len(line_ranges) == 0 or any(line_range is None for line_range in line_ranges):
+        return None
+    return (
+        min(first for first, _last in line_ranges),
+        max(last for _first, last in line_ranges),
+    )
+
+
 ## This class represents text that was not modified at all by preprocessing, and therefore does not
-## need to be unparsed.
+## need to be unparsed. The line range (if known) is the one of the text in the source script,
+## so that the text can be copied from the source bytes (see parse.write_asts_to_shell_file).
 class UnparsedScript:
-    def __init__(self, text):
+    __slots__ = ("text", "line_range")
+
+    def __init__(self, text, line_range=None):
         self.text = text
+        self.line_range = line_range
 
 
 ##
@@ -68,6 +129,30 @@ def char_to_arg_char(char):
     return ["C", ord(char)]
 
 
+## Like to_ast_node(make_command(...)) for arguments and (variable, value) assignments
+## that are plain strings, but builds the typed command directly, since it is called
+## for the stub of every region.
+def make_command_node(arguments, assignments=None):
+    assignments = [] if assignments is None else assignments
+    return CommandNode(
+        0,
+        [AssignNode(var, string_to_arg_chars(value)) for var, value in assignments],
+        [string_to_arg_chars(argument) for argument in arguments],
+        [],
+    )
+
+
+## The characters of the strings that are in every stub (e.g., the path of jit.sh)
+## are only built once, and shared by the stubs (since ASTs never modify them).
+@functools.lru_cache(maxsize=64)
+def cached_arg_chars(string):
+    return tuple(to_arg_from_string(string))
+
+
+def string_to_arg_chars(string):
+    return list(cached_arg_chars(string))
+
+
 def make_command(arguments, redirections=None, assignments=None):
     redirections = [] if redirections is None else redirections
     assignments = [] if assignments is None else assignments
@@ -76,6 +161,143 @@ def make_command(arguments, redirections=None, assignments=None):
     return node
 
 
+## Escapes every byte of a string as \xHH. The escaped string is a single line
+## that contains none of the original words, so it can be kept in a shell
+## variable without showing up in `set -v` traces or in `set` output.
+## The original string is `$'<escaped>'`.
+def hex_escape(string):
+    if len(string) == 0:
+        return ""
+    return "\\x" + string.encode("utf-8").hex(" ").replace(" ", "\\x")
+
+
+## Generates: { <stub> ; __jit_set_region_exit_status && : ; }
+##
+## This is needed for regions whose exit status can come from a failure that was ignored
+## under `set -e` (e.g., `false && :`), since returning that status from a simple command
+## (such as `eval` or `source` in jit.sh, or the stub itself) would exit. Such a region
+## ends by saving its exit status (`__jit_region_exit_status=$?`), the stub (called with
+## `__jit_defer_exit_status=1`) returns 0, and the exit status is only set after it, in a
+## position where a non-zero one does not trigger `set -e`. Failures that are not ignored
+## still exit inside the region.
+def make_deferred_status_stub(stub):
+    set_status = make_command_node(["__jit_set_region_exit_status"])
+    return GroupNode(
+        SemiNode(stub, AndNode(set_status, make_command_node([":"]), no_braces=True))
+    )
+
+
+## Generates: __jit_parallel_job=<mode>:<command>,... <stub>
+##
+## The stub of a region that runs in parallel with the regions next to it (see
+## runtime/jit_scheduler.sh), with the external commands that it runs (which the
+## runtime checks are not functions).
+def make_parallel_job_stub(stub, mode, commands):
+    job = AssignNode("__jit_parallel_job", string_to_arg_chars(f"{mode}:{','.join(commands)}"))
+    return CommandNode(
+        stub.line_number, [job] + stub.assignments, stub.arguments, stub.redir_list
+    )
+
+
+## Generates: declare -F <function> > /dev/null || source "$RUNTIME_DIR/<runtime file>"
+##
+## which loads the runtime file that defines a function, unless it is already defined.
+def make_runtime_load(function_name, runtime_file):
+    check_function = CommandNode(
+        0,
+        [],
+        [string_to_arg_chars("declare"), string_to_arg_chars("-F"),
+         string_to_arg_chars(function_name)],
+        [FileRedirNode("To", ("fixed", 1), string_to_arg_chars("/dev/null"))],
+    )
+    runtime_path = QArgChar(
+        [VArgChar("Normal", False, "RUNTIME_DIR", [])] + string_to_arg_chars(f"/{runtime_file}")
+    )
+    load_runtime = CommandNode(0, [], [string_to_arg_chars("source"), [runtime_path]], [])
+    return OrNode(check_function, load_runtime, no_braces=True)
+
+
+## Generates:
+##   { declare -F __jit_function_enter > /dev/null || source "$RUNTIME_DIR/jit_function_call.sh" ;
+##     __jit_function_define <scope> ; <definition> ; }
+##
+## The hooks of instrumented function bodies (see runtime/jit_function_call.sh) are
+## loaded where the function is defined, since it can be called before any region runs.
+def make_instrumented_function_definition(scope, definition):
+    load_hooks = make_runtime_load("__jit_function_enter", "jit_function_call.sh")
+    define = make_command_node(["__jit_function_define", scope])
+    return GroupNode(SemiNode(load_hooks, SemiNode(define, definition)))
+
+
+## Generates: { __jit_function_enter <scope> && : ; <body> ; __jit_function_leave <scope> && : ; }
+##
+## Like the loop iteration hook, both hooks return the exit status that they are called
+## with, and `&& :` makes sure that a non-zero one does not trigger `set -e`. The status
+## of the function is the one of its body. A `return` in the body calls the leave hook
+## itself (see make_function_return).
+def make_instrumented_function_body(scope, body):
+    enter = make_command_node(["__jit_function_enter", scope])
+    leave = make_command_node(["__jit_function_leave", scope])
+    ## A `{ ... }` body (without redirections) is not nested in another group
+    if isinstance(body, GroupNode):
+        body = body.body
+    return GroupNode(
+        SemiNode(
+            AndNode(enter, make_command_node([":"]), no_braces=True),
+            SemiNode(body, AndNode(leave, make_command_node([":"]), no_braces=True)),
+        )
+    )
+
+
+## Generates: { __jit_function_leave <scope> && return [n] || return [n] ; }
+##
+## Either way the function returns, and `return` without an argument returns the
+## status that the leave hook returns, which is the one before it was called.
+## The group keeps the list together when it is in another `&&` or `||` list.
+def make_function_return(scope, return_command):
+    leave = make_command_node(["__jit_function_leave", scope])
+    return GroupNode(
+        OrNode(AndNode(leave, return_command, no_braces=True), return_command, no_braces=True)
+    )
+
+
+def is_return_command(ast_node):
+    return (
+        isinstance(ast_node, CommandNode)
+        and len(ast_node.arguments) > 0
+        and format_arg_chars(ast_node.arguments[0]) == "return"
+    )
+
+
+## `source FILE [ARGUMENTS...]` or `. FILE [ARGUMENTS...]`, but not with options
+def is_source_command(ast_node):
+    return (
+        isinstance(ast_node, CommandNode)
+        and len(ast_node.arguments) > 1
+        and format_arg_chars(ast_node.arguments[0]) in ("source", ".")
+        and not format_arg_chars(ast_node.arguments[1]).startswith("-")
+    )
+
+
+## Generates:
+##   { declare -F __jit_source_resolve > /dev/null || source "$RUNTIME_DIR/jit_source.sh" ;
+##     __jit_source_resolve <file> [arguments...] ; source "${__jit_sourced[@]}" ; }
+##
+## The resolver expands the words of the command once, into `__jit_sourced`, with the file
+## replaced by its preprocessed version (see runtime/jit_source.sh). The assignments and
+## redirections stay on the `source` command, and so does its exit status.
+def make_sourced_command(source_command):
+    load_resolver = make_runtime_load("__jit_source_resolve", "jit_source.sh")
+    resolve = CommandNode(
+        0, [], [string_to_arg_chars("__jit_source_resolve")] + source_command.arguments[1:], []
+    )
+    source_command.arguments = [
+        source_command.arguments[0],
+        [QArgChar([VArgChar("Normal", False, "__jit_sourced", string_to_arg_chars("[@]"))])],
+    ]
+    return GroupNode(SemiNode(load_resolver, SemiNode(resolve, source_command)))
+
+
 def make_nop():
     return make_command([string_to_argument(":")])
 
@@ -88,6 +310,28 @@ def ptempfile():
     os.close(fd)
     return name
 
+## Yields every item of an iterable together with whether it is the last one,
+## looking only one item ahead (so that the iterable can be a stream).
+## If getting the next item fails (e.g., with a parsing error), the current
+## item is still yielded (as the last one) before the error is raised.
+def with_last(iterable):
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    while True:
+        try:
+            next_item = next(iterator)
+        except StopIteration:
+            break
+        except Exception:
+            yield item, True
+            raise
+        yield item, False
+        item = next_item
+    yield item, True
+
 def unzip(lst):
     res = [[i for i, j in lst], [j for i, j in lst]]
     return res
@@ -16,6 +16,7 @@ allexport_flag="+a"
 verbose_flag=""
 xtrace_flag=""
 debug_level=0
+stream=false
 
 # Usage function
 usage() {
@@ -35,6 +36,7 @@ Options:
   -v                  Print shell input lines as they are read
   -x                  Print commands and their arguments as they execute
   -d, --debug LEVEL   Set debug level (0=none, 1=info, 2=debug)
+  --stream            Run the script while it is being written (e.g., to a FIFO)
   -h, --help          Show this help message
 EOF
     exit 0
@@ -85,6 +87,10 @@ while [ $# -gt 0 ]; do
             debug_level="$2"
             shift 2
             ;;
+        --stream)
+            stream=true
+            shift
+            ;;
         -h|--help)
             usage
             ;;
@@ -96,8 +102,8 @@ while [ $# -gt 0 ]; do
     esac
 done
 
-# Verify script exists
-if [ ! -f "$script_path" ]; then
+# Verify script exists (it is a FIFO when streamed)
+if [ ! -e "$script_path" ]; then
     echo "Error: Script not found: $script_path" >&2
     exit 1
 fi
@@ -108,14 +114,32 @@ log "Script path: $script_path"
 log "Shell name: $shell_name"
 log "Arguments: ${script_args[*]}"
 log "Flags: a=$allexport_flag, v=$verbose_flag, x=$xtrace_flag"
+log "Stream: $stream"
 log "----------------------------------------"
 
+# The main shell writes its trace records to a file that is opened once here, and
+# that it inherits (see runtime/jit_trace.sh). Its pid stays the same after `exec`.
+if [ -n "${PASH_TRACE_DIR-}" ]; then
+    exec {trace_fd}>>"$PASH_TRACE_DIR/$$"
+    export PASH_TRACE_FD="$trace_fd" PASH_TRACE_PID="$$"
+    log "Trace: $PASH_TRACE_DIR/$$ (fd $trace_fd)"
+fi
+
 # Build bash command
 bash_cmd="/usr/bin/env bash"
 
 # Add flags
 bash_flags="$allexport_flag $verbose_flag $xtrace_flag"
 
+# A streamed script is executed as a script file, since bash reads those as it runs them,
+# while `source` reads the whole file before running anything. Its $0 would be the path of
+# the script, so the script is expected to restore it first (see sh-instrument.sh --stream).
+# Uses: bash [flags] script [args...]
+if [ "$stream" = true ]; then
+    log "Executing: $bash_cmd $bash_flags $script_path ${script_args[*]}"
+    exec $bash_cmd $bash_flags "$script_path" "${script_args[@]}"
+fi
+
 # Execute the script
 # Uses: bash [flags] -c "source script" shell_name [args...]
 log "Executing: $bash_cmd $bash_flags -c \"source $script_path\" $shell_name ${script_args[*]}"
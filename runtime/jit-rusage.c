@@ -0,0 +1,63 @@
+#include <stdio.h>
+#include <sys/resource.h>
+
+// A loadable bash builtin that sets `__jit_rusage_max_rss` to the peak RSS (in KiB) of
+// the children that the shell waited for, which only getrusage(2) reports:
+//
+//   enable -f jit-rusage.so __jit_rusage && __jit_rusage
+//
+// It is used by the resource accounting (see jit_accounting.sh). It is built without the
+// headers of bash (which are seldom installed), so it declares the few definitions of
+// bash that it uses, which have been the same since bash 4.
+
+typedef struct word_desc {
+    char *word;
+    int flags;
+} WORD_DESC;
+
+typedef struct word_list {
+    struct word_list *next;
+    WORD_DESC *word;
+} WORD_LIST;
+
+struct builtin {
+    char *name;
+    int (*function)(WORD_LIST *);
+    int flags;
+    char * const *long_doc;
+    const char *short_doc;
+    char *handle;
+};
+
+#define BUILTIN_ENABLED 0x01
+#define EXECUTION_SUCCESS 0
+#define EXECUTION_FAILURE 1
+
+extern void *bind_variable(const char *name, char *value, int flags);
+
+static int jit_rusage_builtin(WORD_LIST *list)
+{
+    struct rusage usage;
+    char value[32];
+
+    if (getrusage(RUSAGE_CHILDREN, &usage) != 0) {
+        return EXECUTION_FAILURE;
+    }
+    snprintf(value, sizeof(value), "%ld", usage.ru_maxrss);
+    bind_variable("__jit_rusage_max_rss", value, 0);
+    return EXECUTION_SUCCESS;
+}
+
+static char *jit_rusage_doc[] = {
+    "Set __jit_rusage_max_rss to the peak RSS (in KiB) of the waited-for children.",
+    (char *) NULL
+};
+
+struct builtin __jit_rusage_struct = {
+    "__jit_rusage",
+    jit_rusage_builtin,
+    BUILTIN_ENABLED,
+    jit_rusage_doc,
+    "__jit_rusage",
+    0
+};
@@ -0,0 +1,99 @@
+#!/bin/bash
+
+## Defines the resource accounting that jit.sh does around every region when
+## `PASH_ACCOUNTING_DIR` is set (see `--accounting` in sh-instrument.sh). It only uses
+## builtins: it reads the counters of the shell from /proc before and after the region,
+## and appends one record per region execution:
+##
+##   A <region id> <first line>-<last line> <body (us)> <user> <system> <faults> <ns processes> <read> <written> <max rss>
+##
+## where <user> and <system> are the CPU time (in clock ticks) and <faults> the page faults
+## of the shell and of its children (from /proc/<pid>/stat), <read> and <written> are the
+## bytes that they read and wrote through system calls, including pipes (rchar and wchar of
+## /proc/<pid>/io), <ns processes> is the number of processes that were started in the pid
+## namespace while the region ran (from the last pid that the kernel assigned, or `-` if it
+## is unknown), and <max rss> is the peak RSS (in KiB) of the children of the shell (from
+## getrusage(2), through the __jit_rusage builtin of runtime/jit-rusage.so, or `-` if it
+## is not built).
+##
+## The counters of a child only include it once the shell waited for it, so a background
+## job is accounted to the region that waits for it. The processes are the ones of the
+## whole pid namespace, so they include the processes of regions that run at the same
+## time (e.g., with `--parallel`) and of other programs. getrusage(2) only keeps the peak
+## RSS of all the children so far, so <max rss> is 0 if no child of the region went over
+## the peak of the children of earlier regions.
+## The lines are `-` unless the preprocessor was run with `--profile`.
+##
+## Every process (e.g., a subshell or a background job) writes to its own file in
+## `PASH_ACCOUNTING_DIR`, named after its pid, and sh-instrument.sh sums up the records
+## of every region when the script exits (see preprocessor/accounting_report.py).
+
+__jit_accounting_pid=0
+## Processes are counted across a wrap of the pid counter
+__jit_accounting_pid_max=32768
+if [ -r /proc/sys/kernel/pid_max ]; then
+    read -r __jit_accounting_pid_max < /proc/sys/kernel/pid_max
+fi
+## Subshells inherit the builtin, so it is only loaded once
+__jit_rusage_max_rss=-
+if enable -f "$RUNTIME_LIBRARY_DIR/jit-rusage.so" __jit_rusage 2> /dev/null; then
+    __jit_rusage
+fi
+
+## Sets `__jit_accounting_counters` to the current counters: user and system CPU time,
+## page faults, last pid, bytes read and written, and peak RSS of the children
+__jit_accounting_read()
+{
+    local IFS=' ' line rchar=0 wchar=0 last_pid=-
+    local -a stat
+    read -r line < "/proc/$BASHPID/stat"
+    ## The fields after the command name (which can contain spaces), from the 3rd one on
+    stat=(${line##*) })
+    { read -r _ rchar; read -r _ wchar; } < "/proc/$BASHPID/io"
+    if [ -r /proc/sys/kernel/ns_last_pid ]; then
+        read -r last_pid < /proc/sys/kernel/ns_last_pid
+    fi
+    if [ "$__jit_rusage_max_rss" != - ]; then
+        __jit_rusage
+    fi
+    ## utime + cutime, stime + cstime, and minflt + cminflt + majflt + cmajflt (see proc(5))
+    __jit_accounting_counters="$((stat[11] + stat[13])) $((stat[12] + stat[14]))"
+    __jit_accounting_counters+=" $((stat[7] + stat[8] + stat[9] + stat[10])) $last_pid $rchar $wchar $__jit_rusage_max_rss"
+}
+
+## Saves the counters before the region runs
+__jit_accounting_start()
+{
+    __jit_accounting_read
+    __jit_accounting_before=$__jit_accounting_counters
+}
+
+## Saves the counters after the region ran
+__jit_accounting_end()
+{
+    __jit_accounting_read
+    __jit_accounting_after=$__jit_accounting_counters
+}
+
+## Appends the record of the current region
+__jit_accounting_region()
+{
+    local IFS=' ' processes=- max_rss=-
+    local -a before=($__jit_accounting_before) after=($__jit_accounting_after)
+    if (( __jit_accounting_pid != BASHPID )); then
+        exec {__jit_accounting_fd}>>"$PASH_ACCOUNTING_DIR/$BASHPID"
+        __jit_accounting_pid=$BASHPID
+    fi
+    if [ "${before[3]}" != - ] && [ "${after[3]}" != - ]; then
+        processes=$(( (after[3] - before[3] + __jit_accounting_pid_max) % __jit_accounting_pid_max ))
+    fi
+    if [ "${after[6]}" != - ]; then
+        max_rss=$(( after[6] > before[6] ? after[6] : 0 ))
+    fi
+    printf 'A\t%s\t%s\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%s\n' \
+        "$JIT_REGION_ID" "${__jit_profile_lines:--}" \
+        "$(( ${__jit_region_body_end/[.,]/} - ${__jit_region_body_start/[.,]/} ))" \
+        "$((after[0] - before[0]))" "$((after[1] - before[1]))" "$((after[2] - before[2]))" \
+        "$processes" "$((after[4] - before[4]))" "$((after[5] - before[5]))" "$max_rss" \
+        >&"$__jit_accounting_fd"
+}
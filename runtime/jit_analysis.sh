@@ -0,0 +1,60 @@
+#!/bin/bash
+
+## Defines the client of the analysis server (see preprocessor/analysis_server.py), which
+## jit.sh calls before and after every region when `PASH_ANALYSIS_DIR` is set (see
+## `--analysis` in sh-instrument.sh). It only uses builtins, except for creating the FIFO
+## of the replies to a process, once per process. Every event is written as one line to
+## the `requests` FIFO, which is shared by all processes, and the replies to a process
+## are read from its own FIFO (named after its pid), so that the events of concurrent
+## processes (e.g., subshells or background jobs) and their replies are never mixed up.
+##
+## The client waits for the reply to every event, i.e., for the analysis to see it, except
+## for the events after a region with `PASH_ANALYSIS_ASYNC` set (see --analysis_async).
+## Both FIFOs are opened for reading and writing, so that opening them never blocks and
+## writing an event never fails with SIGPIPE, but a process that waits for a reply blocks
+## if the server exited (e.g., a background job that outlived the script).
+
+__jit_analysis_pid=0
+
+## Opens the FIFOs of the current process, unless it already did
+__jit_analysis_connect()
+{
+    if (( __jit_analysis_pid != BASHPID )); then
+        exec {__jit_analysis_request_fd}<>"$PASH_ANALYSIS_DIR/requests"
+        [ -p "$PASH_ANALYSIS_DIR/$BASHPID" ] || mkfifo -m 600 "$PASH_ANALYSIS_DIR/$BASHPID"
+        exec {__jit_analysis_reply_fd}<>"$PASH_ANALYSIS_DIR/$BASHPID"
+        __jit_analysis_pid=$BASHPID
+    fi
+}
+
+## Sends the event before the current region runs, and marks it done if the analysis is
+## done with it
+__jit_analysis_pre()
+{
+    local reply
+    __jit_analysis_connect
+    printf 'pre\t1\t%d\t%s\t%d\t%s\t%s\n' "$BASHPID" "$JIT_REGION_ID" \
+        "$__jit_previous_exit_status" "$__jit_region_start" "$SCRIPT_TO_EXECUTE" \
+        >&"$__jit_analysis_request_fd"
+    read -r -u "$__jit_analysis_reply_fd" reply
+    if [ "$reply" = done ]; then
+        __jit_region_done
+    fi
+}
+
+## Sends the event after the current region ran (and waits until the analysis saw it)
+__jit_analysis_post()
+{
+    local reply
+    __jit_analysis_connect
+    if [ -n "${PASH_ANALYSIS_ASYNC-}" ]; then
+        printf 'post\t0\t%d\t%s\t%d\t%s\t%s\n' "$BASHPID" "$JIT_REGION_ID" \
+            "$__jit_runtime_final_status" "$__jit_region_body_end" "$__jit_region_body_start" \
+            >&"$__jit_analysis_request_fd"
+        return 0
+    fi
+    printf 'post\t1\t%d\t%s\t%d\t%s\t%s\n' "$BASHPID" "$JIT_REGION_ID" \
+        "$__jit_runtime_final_status" "$__jit_region_body_end" "$__jit_region_body_start" \
+        >&"$__jit_analysis_request_fd"
+    read -r -u "$__jit_analysis_reply_fd" reply
+}
@@ -0,0 +1,72 @@
+#!/bin/bash
+
+## Defines the hooks of function bodies that are instrumented (see `--function_bodies`
+## in sh-instrument.sh). The preprocessor inserts `__jit_function_enter <function> && :`
+## at the start of the body, and `__jit_function_leave <function>` at its end and before
+## every `return` in it, so the hooks run in plain bash (without entering jit.sh) on
+## every call. <function> is the scope of the function in its region ids.
+##
+## The hooks are called for every call of the function, so they only use a few builtins.
+## Being called before `&& :`, they never trigger `set -e` themselves.
+
+## Counts the calls of each function and the time spent in it (in us), where the time of
+## calls that are active at the same time (e.g., recursive ones) is only counted once
+declare -gAi __jit_function_calls __jit_function_time __jit_function_depth __jit_function_first_call
+declare -gAi __jit_function_pid __jit_function_nested
+declare -gA __jit_function_start
+
+## Called where the function is defined. Its counters are set there (keeping the ones
+## of a previous definition), so that the hooks do not need defaults with `set -u`.
+__jit_function_define()
+{
+    [[ -v __jit_function_calls[$1] ]] || __jit_function_calls[$1]=0
+    [[ -v __jit_function_time[$1] ]] || __jit_function_time[$1]=0
+    [[ -v __jit_function_depth[$1] ]] || __jit_function_depth[$1]=0
+    [[ -v __jit_function_first_call[$1] ]] || __jit_function_first_call[$1]=0
+    [[ -v __jit_function_pid[$1] ]] || __jit_function_pid[$1]=0
+    [[ -v __jit_function_nested[$1] ]] || __jit_function_nested[$1]=0
+}
+
+__jit_function_enter()
+{
+    ## Like the loop iteration hook, the hooks must not change `$?` (see jit_loop_iteration.sh)
+    local __jit_function_status=$?
+    ## A subshell (e.g., `$(f)` in f) starts counting its outermost call again,
+    ## but the time of the call in the parent shell already includes the time here
+    if (( ++__jit_function_calls[$1], __jit_function_depth[$1]++ == 0 )) ||
+           (( __jit_function_pid[$1] != BASHPID && (__jit_function_nested[$1] = 1) )); then
+        __jit_function_start[$1]=$EPOCHREALTIME
+        (( __jit_function_depth[$1] = 1,
+           __jit_function_first_call[$1] = __jit_function_calls[$1],
+           __jit_function_pid[$1] = BASHPID ))
+    fi
+
+    ##
+    ## Your per-call analysis on function $1 (call ${__jit_function_calls[$1]}) here!
+    ##
+
+    return "$__jit_function_status"
+}
+
+__jit_function_leave()
+{
+    local __jit_function_status=$?
+    if (( --__jit_function_depth[$1] == 0 )); then
+        ## EPOCHREALTIME has a 6-digit microsecond fraction (its separator depends on the locale)
+        local end=$EPOCHREALTIME start=${__jit_function_start[$1]}
+        local elapsed=$(( ${end:0:-7}${end: -6} - ${start:0:-7}${start: -6} ))
+        if (( __jit_function_nested[$1] )); then
+            elapsed=0
+        fi
+        __jit_function_time[$1]+=$elapsed
+
+        ## The profile gets a record for every outermost call (in every shell):
+        ##   F <function> <calls until it returned> <time (us)>
+        if [ -n "${PASH_PROFILE-}" ]; then
+            printf 'F\t%s\t%d\t%d\n' \
+                "$1" "$(( __jit_function_calls[$1] - __jit_function_first_call[$1] + 1 ))" \
+                "$elapsed" >> "$PASH_PROFILE"
+        fi
+    fi
+    return "$__jit_function_status"
+}
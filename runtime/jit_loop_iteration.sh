@@ -0,0 +1,23 @@
+#!/bin/bash
+
+## Defines the per-iteration hook of loops that are stubbed as a single region
+## (see `--loop_policy` in sh-instrument.sh). The preprocessor inserts
+## `__jit_loop_iteration <region id> && :` at the start of the loop body, so
+## the hook runs in plain bash (without re-entering jit.sh) on every iteration.
+
+## Counts the iterations of each loop region (indexed by region id)
+declare -gAi __jit_loop_iterations
+
+__jit_loop_iteration()
+{
+    ## The hook must not change `$?` for the loop body. It returns the saved
+    ## status and is called before `&& :`, so a non-zero status does not trigger `set -e`.
+    local __jit_loop_status=$?
+    __jit_loop_iterations[$1]+=1
+
+    ##
+    ## Your per-iteration analysis on region $1 (iteration ${__jit_loop_iterations[$1]}) here!
+    ##
+
+    return "$__jit_loop_status"
+}
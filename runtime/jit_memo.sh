@@ -0,0 +1,169 @@
+#!/bin/bash
+
+## Defines the memoization of the regions that the preprocessor found deterministic (see
+## `--memoize` in sh-instrument.sh and preprocessor/memo.py), whose stubs set:
+##
+## - `__jit_memo` to `<hash of the region text>:<commands>`, where <commands> are the
+##   (comma-separated) external commands of the region,
+## - `__jit_memo_inputs`, `__jit_memo_outputs` and `__jit_memo_variables` to the
+##   (space-separated) files that it reads and writes, and the variables that it reads
+##   (where `@` stands for the positional parameters).
+##
+## The key of an execution hashes the region text, the working directory, the shell options
+## (`$-`), the variables that the region reads and the ones that its commands read (e.g., the locale, see `__jit_memo_environment`), and the identity
+## (device, inode, size and modification time) of its input files. The outputs of every
+## key are stored in an entry of `PASH_MEMO_DIR`:
+##
+##   <key>/stdout, <key>/stderr  what the region wrote to its stdout and stderr
+##   <key>/output.<i>            the i-th output file, if the region left a regular file
+##   <key>/status                its exit status, which is written last
+##
+## On a hit, jit.sh replays the entry instead of running the region, and the output files
+## are copied back with their modification time (so that the regions that read them find
+## the same identity). On a miss, the region runs with its stdout and stderr in the new
+## entry, which are written out after it ran (so its output only shows up once it is done).
+## The store is bounded to `PASH_MEMO_MAX_SIZE` bytes (256MiB by default) by removing the
+## least recently used entries, under a lock that replays take shared, so that an entry is
+## never removed while it is replayed.
+##
+## A region is not memoized if one of its commands is a function, or while tracing
+## (`set -x` or `set -v`, since the replay would show up in the trace).
+
+__jit_memo_max_size=${PASH_MEMO_MAX_SIZE:-268435456}
+## The variables that the deterministic commands (and word splitting) depend on
+__jit_memo_environment="IFS LANG LC_ALL LC_COLLATE LC_CTYPE LC_MESSAGES LC_NUMERIC LC_TIME TZ PATH POSIXLY_CORRECT"
+## Temporary entries that are older than this (in minutes) were abandoned by a process that died
+__jit_memo_abandoned_minutes=60
+
+## Splits a list of literal words (which contain no separator and no pattern) into
+## `__jit_memo_words`, whatever IFS the script set
+__jit_memo_split()
+{
+    local IFS=$2
+    __jit_memo_words=($1)
+}
+
+## Prints the key of the current region. Neither this function nor its caller have local
+## variables, since `declare -p` would print them instead of the variables of the script.
+__jit_memo_hash()
+{
+    {
+        printf '%s\0' "${__jit_memo%%:*}" "$PWD" "$__jit_previous_set_status"
+        __jit_memo_split "${__jit_memo_variables-} $__jit_memo_environment" ' '
+        if [[ " ${__jit_memo_variables-} " == *" @ "* ]]; then
+            printf '%s\0' "${__jit_region_state#*:}"
+        fi
+        declare -p -- "${__jit_memo_words[@]}" 2> /dev/null
+        __jit_memo_split "${__jit_memo_inputs-}" ' '
+        if (( ${#__jit_memo_words[@]} > 0 )); then
+            stat -L -c '%n %d %i %s %y' -- "${__jit_memo_words[@]}" 2>&1
+        fi
+    } | sha256sum
+}
+
+## Replays the current region and sets `__jit_region_command` to return its exit status if
+## its key is stored, or creates a new entry (`__jit_memo_entry`) and makes
+## `__jit_region_command` run the region with its stdout and stderr in it otherwise
+__jit_memo_prepare()
+{
+    __jit_memo_entry=
+    __jit_memo_split "${__jit_memo#*:}" ','
+    for __jit_memo_command in "${__jit_memo_words[@]}"; do
+        if declare -F -- "$__jit_memo_command" > /dev/null; then
+            return 0
+        fi
+    done
+    if [[ $__jit_previous_set_status == *[vx]* ]]; then
+        return 0
+    fi
+    __jit_memo_key=$(__jit_memo_hash)
+    __jit_memo_key=${__jit_memo_key%% *}
+    __jit_memo_split "${__jit_memo_outputs-}" ' '
+    __jit_memo_files=("${__jit_memo_words[@]}")
+
+    exec {__jit_memo_lock_fd}>> "$PASH_MEMO_DIR/.lock"
+    flock -s "$__jit_memo_lock_fd"
+    if [ -f "$PASH_MEMO_DIR/$__jit_memo_key/status" ]; then
+        __jit_redir_output echo "$$: (2) Region $JIT_REGION_ID is replayed from $__jit_memo_key"
+        __jit_memo_replay "$PASH_MEMO_DIR/$__jit_memo_key"
+        exec {__jit_memo_lock_fd}>&-
+        __jit_region_command='__jit_set_exit_status "$__jit_memo_status"'
+        return 0
+    fi
+    exec {__jit_memo_lock_fd}>&-
+
+    __jit_redir_output echo "$$: (2) Region $JIT_REGION_ID is stored in $__jit_memo_key"
+    __jit_memo_entry="$PASH_MEMO_DIR/.tmp-$BASHPID-$__jit_memo_key"
+    rm -rf -- "$__jit_memo_entry"
+    mkdir -- "$__jit_memo_entry" || { __jit_memo_entry=; return 0; }
+    __jit_region_command+=' > "$__jit_memo_entry/stdout" 2> "$__jit_memo_entry/stderr"'
+}
+
+## Writes out the outputs of an entry and sets `__jit_memo_status` to its exit status
+__jit_memo_replay()
+{
+    local entry=$1 i
+    if [ -s "$entry/stdout" ]; then
+        cat -- "$entry/stdout"
+    fi
+    if [ -s "$entry/stderr" ]; then
+        cat -- "$entry/stderr" >&2
+    fi
+    for i in "${!__jit_memo_files[@]}"; do
+        if [ -f "$entry/output.$i" ]; then
+            cp --preserve=timestamps -- "$entry/output.$i" "${__jit_memo_files[i]}"
+        fi
+    done
+    ## The modification time of an entry is its last use
+    touch -c -- "$entry"
+    read -r __jit_memo_status < "$entry/status"
+}
+
+## Writes out the outputs of the region that just ran, and stores them with its exit status
+__jit_memo_store()
+{
+    local entry=$__jit_memo_entry i
+    __jit_memo_entry=
+    if [ -s "$entry/stdout" ]; then
+        cat -- "$entry/stdout"
+    fi
+    if [ -s "$entry/stderr" ]; then
+        cat -- "$entry/stderr" >&2
+    fi
+    for i in "${!__jit_memo_files[@]}"; do
+        if [ -f "${__jit_memo_files[i]}" ]; then
+            cp --preserve=timestamps -- "${__jit_memo_files[i]}" "$entry/output.$i"
+        fi
+    done
+    printf '%d\n' "$1" > "$entry/status"
+    ## Another process could have stored the same key in the meantime
+    if ! mv -T -- "$entry" "$PASH_MEMO_DIR/$__jit_memo_key" 2> /dev/null; then
+        rm -rf -- "$entry"
+    fi
+    __jit_memo_evict
+}
+
+## Removes the least recently used entries (but the current one) until the store fits
+__jit_memo_evict()
+{
+    local lock_fd total size entry
+    total=$(du -sb -- "$PASH_MEMO_DIR")
+    if (( ${total%%[[:space:]]*} <= __jit_memo_max_size )); then
+        return 0
+    fi
+    exec {lock_fd}>> "$PASH_MEMO_DIR/.lock"
+    flock -x "$lock_fd"
+    find "$PASH_MEMO_DIR" -mindepth 1 -maxdepth 1 -name '.tmp-*' \
+        -mmin "+$__jit_memo_abandoned_minutes" -exec rm -rf -- {} +
+    total=$(du -sb -- "$PASH_MEMO_DIR")
+    total=${total%%[[:space:]]*}
+    while (( total > __jit_memo_max_size )) && IFS= read -r entry; do
+        if [ "$entry" = "$__jit_memo_key" ]; then
+            continue
+        fi
+        size=$(du -sb -- "$PASH_MEMO_DIR/$entry")
+        rm -rf -- "${PASH_MEMO_DIR:?}/$entry"
+        total=$(( total - ${size%%[[:space:]]*} ))
+    done < <(ls -1tr -- "$PASH_MEMO_DIR")
+    exec {lock_fd}>&-
+}
@@ -0,0 +1,24 @@
+#!/bin/bash
+
+## Defines the profiler that jit.sh calls after every region when `PASH_PROFILE`
+## is set (see `--profile` in sh-instrument.sh). It only uses builtins, and it
+## appends one record per region execution to the profile:
+##
+##   X <region id> <first line>-<last line> <overhead (us)> <body (us)> <exit status>
+##
+## The body is the time spent evaluating the region itself and the overhead is
+## the rest of the time spent in jit.sh (saving and switching the shell state
+## and your analysis). The lines are `-` if the preprocessor was not run with
+## `--profile`. Records are appended with `>>`, so regions that run in
+## subshells or background jobs can share the profile.
+
+__jit_profile_region()
+{
+    ## EPOCHREALTIME is in seconds with a microsecond fraction (its separator depends on the locale)
+    local end=${EPOCHREALTIME/[.,]/}
+    local start=${__jit_region_start/[.,]/}
+    local body=$(( ${__jit_region_body_end/[.,]/} - ${__jit_region_body_start/[.,]/} ))
+    printf 'X\t%s\t%s\t%d\t%d\t%d\n' \
+        "$JIT_REGION_ID" "${__jit_profile_lines:--}" "$((end - start - body))" "$body" \
+        "$__jit_runtime_final_status" >> "$PASH_PROFILE"
+}
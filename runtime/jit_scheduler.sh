@@ -0,0 +1,91 @@
+#!/bin/bash
+
+## Defines the scheduler of the regions that the preprocessor proved independent of the
+## regions next to them (see `--parallel` in sh-instrument.sh and preprocessor/effects.py).
+## The stubs of a group of adjacent independent regions set `__jit_parallel_job` to
+## `<mode>:<commands>`, where <commands> are the (comma-separated) external commands of
+## the region and <mode> is:
+##
+## - `spawn` for every region of the group but the last, which runs (through jit.sh, like
+##   any other region) as a background job, once fewer than `PASH_JIT_JOBS` (the number
+##   of cores by default) jobs of the group are running,
+## - `last` for the last region of the group, which runs in the foreground and then waits
+##   for the jobs of the group, so that the exit status of the group is its exit status.
+##
+## A region only runs in parallel with the rest of its group if none of its commands is a
+## function (whose effects are not known), if `set -e` is off (a failure would exit before
+## the next regions run), and if the script did not start a background job of its own (the
+## jobs would change `$!`). Otherwise, it waits for the jobs of its group and runs in the
+## foreground. Jobs run in subshells, so the executions that they count (e.g., to make
+## a region hot) are lost, and an ERR trap does not run when they fail.
+
+if [ -z "${PASH_JIT_JOBS-}" ]; then
+    __jit_parallel_max_jobs=$(nproc 2> /dev/null || echo 1)
+else
+    __jit_parallel_max_jobs=$PASH_JIT_JOBS
+fi
+## The pids of the running jobs of the group, and of the last job that was started
+declare -ga __jit_parallel_jobs=()
+__jit_parallel_last_pid=
+
+## Returns whether the region of the given job runs in parallel with the rest of its group
+__jit_parallel_can_run()
+{
+    local commands=${1#*:}
+    if [[ $- == *e* ]] || (( __jit_parallel_max_jobs < 1 )); then
+        return 1
+    fi
+    if [[ -n ${!:-} && ${!:-} != "$__jit_parallel_last_pid" ]]; then
+        return 1
+    fi
+    while [ -n "$commands" ]; do
+        if declare -F -- "${commands%%,*}" > /dev/null; then
+            return 1
+        fi
+        if [[ $commands == *,* ]]; then
+            commands=${commands#*,}
+        else
+            commands=
+        fi
+    done
+}
+
+## Waits until fewer than `PASH_JIT_JOBS` jobs of the group are running
+__jit_parallel_throttle()
+{
+    local pid pids job
+    while (( ${#__jit_parallel_jobs[@]} >= __jit_parallel_max_jobs )); do
+        if (( BASH_VERSINFO[0] * 100 + BASH_VERSINFO[1] >= 501 )); then
+            wait -n -p pid "${__jit_parallel_jobs[@]}"
+        else
+            ## Older versions of bash can only wait for a given job
+            pid=${__jit_parallel_jobs[0]}
+            wait "$pid"
+        fi
+        pids=()
+        for job in "${__jit_parallel_jobs[@]}"; do
+            if [ "$job" != "$pid" ]; then
+                pids+=("$job")
+            fi
+        done
+        __jit_parallel_jobs=("${pids[@]}")
+    done
+}
+
+## Records a job that was started
+__jit_parallel_started()
+{
+    __jit_parallel_jobs+=("$1")
+    __jit_parallel_last_pid=$1
+    __jit_redir_output echo "$$: (0) Region $__jit_region_id runs in job $1"
+}
+
+## Waits for the jobs of the group and returns the given exit status (0 by default)
+__jit_parallel_wait()
+{
+    if (( ${#__jit_parallel_jobs[@]} > 0 )); then
+        wait "${__jit_parallel_jobs[@]}"
+        __jit_parallel_jobs=()
+    fi
+    return "${1:-0}"
+}
@@ -1,10 +1,59 @@
 #!/bin/bash
 
-from_set=${1?From set not given}
-to_set=${2?To set not given}
-
-## Finds the difference of set variables (removing the c, s one since it cannot be actually set and unset)
-IFS=',' read -r __jit_set_to_remove __jit_set_to_add <<<"$("$RUNTIME_LIBRARY_DIR/set-diff" "$from_set" "$to_set")"
-__jit_redir_output echo "Switching set (from,to,add,remove): ($from_set,$to_set,$__jit_set_to_add,$__jit_set_to_remove)"
-__jit_redir_all_output_always_execute set "-$__jit_set_to_add"
-__jit_redir_all_output_always_execute set "+$__jit_set_to_remove"
+## Defines the functions that save and restore the shell state in jit.sh.
+## They only use builtins so that switching state does not fork.
+
+## Memoizes the "remove,add" difference of each (from,to) pair of set states
+declare -gA __jit_set_diff_cache
+
+## Switches set options from the first state to the second one (both given as `$-`).
+__jit_set_from_to()
+{
+    local from_set=${1?From set not given}
+    local to_set=${2?To set not given}
+
+    if [[ "$from_set" == "$to_set" ]]; then
+        __jit_redir_output echo "Switching set (from,to): ($from_set,$to_set) unchanged"
+        return 0
+    fi
+
+    local diff_key="$from_set/$to_set"
+    local set_diff=${__jit_set_diff_cache[$diff_key]-}
+    if [[ -z "$set_diff" ]]; then
+        ## Finds the difference of set options (removing the c, s one since it cannot be actually set and unset)
+        local set_to_remove="" set_to_add="" flag i
+        for ((i = 0; i < ${#from_set}; i++)); do
+            flag=${from_set:i:1}
+            [[ "$flag" == [cs] || "$to_set" == *"$flag"* ]] || set_to_remove+=$flag
+        done
+        for ((i = 0; i < ${#to_set}; i++)); do
+            flag=${to_set:i:1}
+            [[ "$flag" == [cs] || "$from_set" == *"$flag"* ]] || set_to_add+=$flag
+        done
+        set_diff="$set_to_remove,$set_to_add"
+        __jit_set_diff_cache[$diff_key]=$set_diff
+    fi
+
+    local set_to_remove=${set_diff%,*}
+    local set_to_add=${set_diff#*,}
+    __jit_redir_output echo "Switching set (from,to,add,remove): ($from_set,$to_set,$set_to_add,$set_to_remove)"
+    ## An empty `set -` would also turn off -x and -v, so we skip empty switches
+    if [[ -n "$set_to_add" ]]; then
+        __jit_redir_all_output_always_execute set "-$set_to_add"
+    fi
+    if [[ -n "$set_to_remove" ]]; then
+        __jit_redir_all_output_always_execute set "+$set_to_remove"
+    fi
+}
+
+## Sets `$?` to the given exit code without forking a `(exit "$1")` subshell.
+__jit_set_exit_status()
+{
+    return "$1"
+}
+
+## Sets `$?` to the exit status of the last region, for stubs that defer it (see jit.sh).
+__jit_set_region_exit_status()
+{
+    return "$__jit_runtime_final_status"
+}
@@ -0,0 +1,102 @@
+#!/bin/bash
+
+## Defines the resolution of the scripts that `source` and `.` read (see `--instrument_sourced`
+## in sh-instrument.sh), for which the preprocessor rewrites `source FILE [ARGUMENTS...]` to
+## call `__jit_source_resolve FILE [ARGUMENTS...]` and then source `"${__jit_sourced[@]}"`
+## (see make_sourced_command in preprocessor/util.py).
+##
+## A sourced script is preprocessed the first time that it is sourced, with the preprocessing
+## options of the script (`PASH_SOURCE_PREPROCESSOR_ARGS`), so the scripts that it sources are
+## instrumented too. The preprocessed script is kept in `PASH_SOURCE_DIR` under the identity
+## of the file (device, inode, size and modification time), and every process of the script
+## shares it, so sourcing the same file again only costs a `stat`. A file that cannot be
+## preprocessed (e.g., with a syntax error) is sourced as it is, so that bash reports the
+## error, and it is only tried once.
+
+## The preprocessing server and its client exit with this code when the request could not
+## be served (see run_preprocessor in sh-instrument.sh)
+__jit_source_preprocessor_unavailable=75
+
+## Sets `__jit_sourced` to the words of a `source` command, where the file is replaced by its
+## preprocessed version if it is a file that can be preprocessed
+__jit_source_resolve()
+{
+    __jit_sourced=("$@")
+    if [ -z "${PASH_SOURCE_DIR-}" ]; then
+        return 0
+    fi
+    local file identity entry
+    __jit_source_find "$1"
+    file=$__jit_source_file
+    if [ -z "$file" ] || [ ! -f "$file" ] || [ ! -r "$file" ]; then
+        return 0
+    fi
+    identity=$(stat -L -c '%d-%i-%s-%.9Y' -- "$file") || return 0
+    entry="$PASH_SOURCE_DIR/$identity"
+    if [ ! -f "$entry" ] && [ ! -e "$entry.failed" ]; then
+        __jit_source_preprocess "$file" "$entry"
+    fi
+    if [ -f "$entry" ]; then
+        __jit_redir_output echo "$$: Sourcing $file preprocessed in $entry"
+        __jit_sourced[0]=$entry
+    fi
+    return 0
+}
+
+## Sets `__jit_source_file` to the file that `source` reads given its name: a name without
+## a slash is looked up in PATH (with `shopt -s sourcepath`), and then in the current
+## directory (unless in POSIX mode), and it is empty if there is no such file
+__jit_source_find()
+{
+    local directory path
+    __jit_source_file=$1
+    if [[ $1 == */* ]]; then
+        return 0
+    fi
+    if shopt -q sourcepath; then
+        ## Every entry of PATH is followed by a colon (and an empty one is the current directory)
+        path=$PATH:
+        while [ -n "$path" ]; do
+            directory=${path%%:*}
+            path=${path#*:}
+            if [ -f "${directory:-.}/$1" ] && [ -r "${directory:-.}/$1" ]; then
+                __jit_source_file=${directory:-.}/$1
+                return 0
+            fi
+        done
+    fi
+    if [[ :$SHELLOPTS: == *:posix:* ]]; then
+        __jit_source_file=
+    fi
+}
+
+## Preprocesses a sourced script into its entry (with the preprocessing server if there is
+## one), or marks the entry as failed
+__jit_source_preprocess()
+{
+    local file=$1 entry=$2 output="$PASH_SOURCE_DIR/.tmp-$BASHPID" status
+    local -a options
+    eval "options=($PASH_SOURCE_PREPROCESSOR_ARGS)"
+    __jit_redir_output echo "$$: Preprocessing sourced script $file in $entry"
+    status=$__jit_source_preprocessor_unavailable
+    if [ -n "${PASH_PREPROCESSOR_SOCKET-}" ] && [ -S "$PASH_PREPROCESSOR_SOCKET" ] &&
+           [ -x "$RUNTIME_LIBRARY_DIR/preprocess-client" ]; then
+        status=0
+        __jit_redir_all_output_always_execute "$RUNTIME_LIBRARY_DIR/preprocess-client" \
+            "$PASH_PREPROCESSOR_SOCKET" "$file" --output "$output" "${options[@]}" || status=$?
+    fi
+    if (( status == __jit_source_preprocessor_unavailable )); then
+        status=0
+        __jit_redir_all_output_always_execute "$PASH_TOP/python_pkgs/bin/python" \
+            "$PASH_TOP/preprocessor/preprocessor.py" "$file" --output "$output" "${options[@]}" ||
+            status=$?
+    fi
+    ## Another process could have preprocessed the same file in the meantime, which is the same
+    if (( status == 0 )); then
+        mv -f -- "$output" "$entry"
+    else
+        __jit_redir_output echo "$$: Sourced script $file could not be preprocessed ($status)"
+        rm -f -- "$output"
+        : > "$entry.failed"
+    fi
+}
@@ -0,0 +1,49 @@
+#!/bin/bash
+
+## Defines the tiers of region execution in jit.sh. A region starts fully instrumented
+## (every execution goes through the seven steps of jit.sh). Once it is hot, i.e., it ran
+## `PASH_JIT_HOT_THRESHOLD` times (see `--hot_threshold` in sh-instrument.sh), or the
+## analysis called `__jit_region_done` on it, its later executions bypass the JIT: jit.sh
+## only counts them and runs the region directly (see (0) in jit.sh).
+##
+## A region only bypasses the JIT in the shell state that it became hot in, i.e., the same
+## `$-` and the same positional parameters. When either changes, the region is fully
+## instrumented again until it is hot in the new state. Regions never become hot while
+## tracing (`set -x` or `set -v`), since the bypass would show up in the trace.
+
+## The executions of every region (including the ones that bypassed the JIT)
+declare -gAi __jit_region_executions
+## The fully instrumented executions of every region since it was last hot
+declare -gAi __jit_region_warm_executions
+## The shell state (`$-:<quoted positional parameters>`) in which a region bypasses the JIT
+declare -gA __jit_region_bypass
+
+## Called by jit.sh on every fully instrumented execution of a region, before the analysis
+__jit_region_warm_up()
+{
+    __jit_region_executions[$1]+=1
+    if [[ -v __jit_region_bypass[$1] ]]; then
+        ## The region was hot in another shell state
+        __jit_redir_output echo "$$: (2) Region $1 is no longer hot in state: $__jit_region_state"
+        unset "__jit_region_bypass[$1]"
+        __jit_region_warm_executions[$1]=0
+    fi
+    __jit_region_warm_executions[$1]+=1
+    if (( ${PASH_JIT_HOT_THRESHOLD:-0} > 0 &&
+          __jit_region_warm_executions[$1] >= PASH_JIT_HOT_THRESHOLD )); then
+        __jit_region_done "$1"
+    fi
+}
+
+## Marks a region (by default, the current one) as done: its next executions in the
+## current shell state bypass the JIT. It can be called by the analysis before the
+## region runs (step (2) in jit.sh), since nested regions change the shell state after.
+__jit_region_done()
+{
+    local region_id=${1:-$JIT_REGION_ID}
+    if [[ ${__jit_region_state%%:*} == *[vx]* ]]; then
+        return 0
+    fi
+    __jit_redir_output echo "$$: (2) Region $region_id is hot in state: $__jit_region_state"
+    __jit_region_bypass[$region_id]=$__jit_region_state
+}
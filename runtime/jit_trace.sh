@@ -0,0 +1,37 @@
+#!/bin/bash
+
+## Defines the tracer that jit.sh calls around every region when `PASH_TRACE_DIR` is set
+## (see `--trace` in sh-instrument.sh). It only uses builtins, and it writes one JSON
+## line per record to a file descriptor that every process opens once:
+##
+##   {"time":<s.us>,"pid":<pid>,"region":"<region id>","phase":"<phase>","status":<status>}
+##
+## where the phases of a region are `enter` (jit.sh is entered, with the exit status
+## before the region), `body` (the region starts, with the same status), and `exit`
+## (the region ended, with its exit status), or only `bypass` (with its exit status)
+## if the region is hot (see runtime/jit_tiers.sh).
+##
+## Every process (e.g., a subshell or a background job) writes to its own file in
+## `PASH_TRACE_DIR`, named after its pid, so that records of concurrent processes are
+## never interleaved, and sh-instrument.sh merges the files by time when the script exits.
+## The main shell inherits the descriptor of its file from runner.sh.
+
+__jit_trace_pid=${PASH_TRACE_PID:-0}
+__jit_trace_fd=${PASH_TRACE_FD-}
+
+## Writes the records of the current region, given as <phase> <time> <status> triples
+__jit_trace()
+{
+    if (( __jit_trace_pid != BASHPID )); then
+        exec {__jit_trace_fd}>>"$PASH_TRACE_DIR/$BASHPID"
+        __jit_trace_pid=$BASHPID
+    fi
+    local records=()
+    while (( $# >= 3 )); do
+        ## EPOCHREALTIME has a 6-digit microsecond fraction (its separator depends on the locale)
+        records+=("${2:0:-7}.${2: -6}" "$BASHPID" "$JIT_REGION_ID" "$1" "$3")
+        shift 3
+    done
+    printf '{"time":%s,"pid":%d,"region":"%s","phase":"%s","status":%d}\n' \
+        "${records[@]}" >&"$__jit_trace_fd"
+}
@@ -0,0 +1,106 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <limits.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+
+// Returned when the server cannot be reached so that the caller can fall back
+// to running the preprocessor directly (same value as EX_TEMPFAIL).
+#define EXIT_UNAVAILABLE 75
+
+static int send_all(int sock, const char* buf, size_t len)
+{
+    while (len > 0) {
+        ssize_t sent = send(sock, buf, len, 0);
+        if (sent < 0) {
+            return -1;
+        }
+        buf += sent;
+        len -= sent;
+    }
+    return 0;
+}
+
+int main(int argc, char* argv[]) {
+    // arg#1 -> server socket
+    // arg#2.. -> preprocessor.py arguments
+    if (argc < 2) {
+        fprintf(stderr, "Usage: %s SOCKET [PREPROCESSOR_ARGS...]\n", argv[0]);
+        exit(EXIT_UNAVAILABLE);
+    }
+
+    struct sockaddr_un addr;
+    memset(&addr, 0, sizeof(addr));
+    addr.sun_family = AF_UNIX;
+    if (strlen(argv[1]) >= sizeof(addr.sun_path)) {
+        exit(EXIT_UNAVAILABLE);
+    }
+    strcpy(addr.sun_path, argv[1]);
+
+    int sock = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (sock < 0 || connect(sock, (struct sockaddr*) &addr, sizeof(addr)) < 0) {
+        exit(EXIT_UNAVAILABLE);
+    }
+
+    // The payload is the working directory followed by the arguments,
+    // each of them NUL-terminated.
+    char cwd[PATH_MAX];
+    if (getcwd(cwd, sizeof(cwd)) == NULL) {
+        exit(EXIT_UNAVAILABLE);
+    }
+    size_t payloadLen = strlen(cwd) + 1;
+    for (int i = 2; i < argc; i++) {
+        payloadLen += strlen(argv[i]) + 1;
+    }
+    char* payload = malloc(payloadLen);
+    size_t offset = 0;
+    strcpy(payload, cwd);
+    offset += strlen(cwd) + 1;
+    for (int i = 2; i < argc; i++) {
+        strcpy(payload + offset, argv[i]);
+        offset += strlen(argv[i]) + 1;
+    }
+
+    // The first chunk carries our stdin, stdout, and stderr so that the server
+    // reads and writes exactly where a one-shot preprocessor would.
+    int fds[3] = {0, 1, 2};
+    char control[CMSG_SPACE(sizeof(fds))];
+    memset(control, 0, sizeof(control));
+    struct iovec iov = { .iov_base = payload, .iov_len = payloadLen };
+    struct msghdr msg;
+    memset(&msg, 0, sizeof(msg));
+    msg.msg_iov = &iov;
+    msg.msg_iovlen = 1;
+    msg.msg_control = control;
+    msg.msg_controllen = sizeof(control);
+    struct cmsghdr* cmsg = CMSG_FIRSTHDR(&msg);
+    cmsg->cmsg_level = SOL_SOCKET;
+    cmsg->cmsg_type = SCM_RIGHTS;
+    cmsg->cmsg_len = CMSG_LEN(sizeof(fds));
+    memcpy(CMSG_DATA(cmsg), fds, sizeof(fds));
+
+    ssize_t sent = sendmsg(sock, &msg, 0);
+    if (sent < 0
+        || send_all(sock, payload + sent, payloadLen - sent) < 0
+        || shutdown(sock, SHUT_WR) < 0) {
+        exit(EXIT_UNAVAILABLE);
+    }
+    free(payload);
+
+    // The server answers with the exit code of the preprocessor. If it
+    // closes the connection without answering, the request never completed.
+    unsigned char exitCode;
+    ssize_t received;
+    do {
+        received = read(sock, &exitCode, 1);
+    } while (received < 0 && errno == EINTR);
+    if (received <= 0) {
+        exit(EXIT_UNAVAILABLE);
+    }
+
+    close(sock);
+    return exitCode;
+}
@@ -82,19 +82,23 @@ else
             >&2 "$@"
         }
     else
+        ## The log file is only opened once, and the runner inherits its descriptor
+        exec {PASH_REDIR_FD}>>"$PASH_REDIR"
+        export PASH_REDIR_FD
+
         __jit_redir_output()
         {
-            >>"$PASH_REDIR" "$@"
+            >&"$PASH_REDIR_FD" "$@"
         }
 
         __jit_redir_all_output()
         {
-            >>"$PASH_REDIR" 2>&1 "$@"
+            >&"$PASH_REDIR_FD" 2>&1 "$@"
         }
 
         __jit_redir_all_output_always_execute()
         {
-            >>"$PASH_REDIR" 2>&1 "$@"
+            >&"$PASH_REDIR_FD" 2>&1 "$@"
         }
     fi
 fi
@@ -120,6 +124,25 @@ verbose_flag=""
 xtrace_flag=""
 command_mode=""
 command_text=""
+region_mode="file"
+loop_policy="iteration"
+granularity="command"
+max_region_size=""
+policy_file=""
+cost_threshold=""
+profile_file=""
+trace_file=""
+accounting_file=""
+function_bodies=false
+hot_threshold=""
+parallel=false
+jobs=""
+stream=false
+region_index_file=""
+analysis_file=""
+analysis_async=false
+memoize=false
+instrument_sourced=false
 
 # Parse arguments
 i=1
@@ -143,6 +166,76 @@ while [ $i -le $# ]; do
         --bash)
             bash_flag="--bash"
             ;;
+        --region_mode)
+            region_mode="$next_arg"
+            i=$next_i
+            ;;
+        --loop_policy)
+            loop_policy="$next_arg"
+            i=$next_i
+            ;;
+        --granularity)
+            granularity="$next_arg"
+            i=$next_i
+            ;;
+        --max_region_size)
+            max_region_size="$next_arg"
+            i=$next_i
+            ;;
+        --policy)
+            policy_file="$next_arg"
+            i=$next_i
+            ;;
+        --cost_threshold)
+            cost_threshold="$next_arg"
+            i=$next_i
+            ;;
+        --profile)
+            profile_file="$next_arg"
+            i=$next_i
+            ;;
+        --trace)
+            trace_file="$next_arg"
+            i=$next_i
+            ;;
+        --accounting)
+            accounting_file="$next_arg"
+            i=$next_i
+            ;;
+        --function_bodies)
+            function_bodies=true
+            ;;
+        --hot_threshold)
+            hot_threshold="$next_arg"
+            i=$next_i
+            ;;
+        --parallel)
+            parallel=true
+            ;;
+        --jobs)
+            jobs="$next_arg"
+            i=$next_i
+            ;;
+        --stream)
+            stream=true
+            ;;
+        --region_index)
+            region_index_file="$next_arg"
+            i=$next_i
+            ;;
+        --analysis)
+            analysis_file="$next_arg"
+            i=$next_i
+            ;;
+        --analysis_async)
+            analysis_async=true
+            ;;
+        --memoize)
+            memoize=true
+            ;;
+        --instrument_sourced)
+            instrument_sourced=true
+            ;;
         -a)
             allexport_flag="-a"
             ;;
@@ -181,9 +274,8 @@ done
 
 # Handle -c command mode
 if [ -n "$command_mode" ]; then
-    # Create temporary file for command text
-    input_script=$(mktemp)
-    echo "$command_text" > "$input_script"
+    ## The preprocessor reads the command text from stdin (see run_preprocessor)
+    input_script=-
     # If there are additional args, first becomes shell_name
     if [ ${#script_args[@]} -gt 0 ]; then
         shell_name="${script_args[0]}"
@@ -191,18 +283,311 @@ if [ -n "$command_mode" ]; then
     fi
 fi
 
-# Create temporary file for preprocessed output
-preprocessed_output=$(mktemp)
+## A preprocessed script that is only printed is not streamed, and neither is one
+## whose region index is written (the index is only complete after the whole script)
+if [ "$preprocess_only" = true ] || [ -n "$region_index_file" ]; then
+    stream=false
+fi
 
-# Step 1: Call preprocessor.py to transform the script
-__jit_redir_all_output echo "PaSh: Calling preprocessor..."
-"$PYTHON_VENV" "$PASH_TOP/preprocessor/preprocessor.py" \
-    "$input_script" \
-    --output "$preprocessed_output" \
-    --runtime-executable "$PASH_TOP/jit.sh" \
-    --debug "$PASH_DEBUG_LEVEL" \
+if [ "$stream" = true ]; then
+    ## The preprocessor writes the script to a FIFO that the runner executes as it is written
+    stream_dir=$(mktemp -d)
+    preprocessed_output="$stream_dir/preprocessed"
+    mkfifo "$preprocessed_output"
+else
+    # Create temporary file for preprocessed output
+    preprocessed_output=$(mktemp)
+fi
+
+## The options that the script and the scripts that it sources are preprocessed with
+preprocessing_options=(
+    --runtime-executable "$PASH_TOP/jit.sh"
+    --debug "$PASH_DEBUG_LEVEL"
+    --region-mode "$region_mode"
+    --loop-policy "$loop_policy"
+    --granularity "$granularity"
     $bash_flag
+)
+if [ -n "$max_region_size" ]; then
+    preprocessing_options+=(--max-region-size "$max_region_size")
+fi
+## The path is absolute since sourced scripts are preprocessed wherever the script is
+if [ -n "$policy_file" ]; then
+    preprocessing_options+=(--policy "$(realpath -m -- "$policy_file")")
+fi
+if [ -n "$cost_threshold" ]; then
+    preprocessing_options+=(--cost-threshold "$cost_threshold")
+fi
+if [ "$function_bodies" = true ]; then
+    preprocessing_options+=(--function-bodies)
+fi
+if [ "$parallel" = true ]; then
+    preprocessing_options+=(--parallel)
+fi
+if [ "$memoize" = true ]; then
+    preprocessing_options+=(--memoize)
+fi
+if [ "$instrument_sourced" = true ]; then
+    preprocessing_options+=(--instrument-sourced)
+fi
 
+preprocessor_args=(
+    "$input_script"
+    --output "$preprocessed_output"
+    "${preprocessing_options[@]}"
+)
+## The profile (and the accounting) only has the source lines of the regions of the script
+if [ -n "$profile_file" ] || [ -n "$accounting_file" ]; then
+    preprocessor_args+=(--profile)
+fi
+## The runtime looks regions up in their index by `$JIT_REGION_ID` (see preprocessor/region_index.py).
+## The path is absolute since the script can change its directory.
+if [ -n "$region_index_file" ]; then
+    export PASH_REGION_INDEX="$(realpath -- "$region_index_file")"
+    preprocessor_args+=(--region-index "$PASH_REGION_INDEX")
+fi
+## A streamed script is never complete before it runs, so it is neither indexed nor cached.
+## Scripts given with -c have no path, so they are never indexed,
+## and neither are scripts with parallel regions (see --parallel in preprocessor.py).
+## The region index is only written when the script is preprocessed.
+if [ "$stream" = true ]; then
+    preprocessor_args+=(--stream)
+elif [ -n "$region_index_file" ]; then
+    :
+elif [ -n "$PASH_PREPROCESS_INCREMENTAL_DIR" ] && [ -z "$command_mode" ] && [ "$parallel" = false ]; then
+    preprocessor_args+=(--incremental-dir "$PASH_PREPROCESS_INCREMENTAL_DIR")
+elif [ -n "$PASH_PREPROCESS_CACHE_DIR" ]; then
+    preprocessor_args+=(--cache-dir "$PASH_PREPROCESS_CACHE_DIR")
+    if [ -n "$PASH_PREPROCESS_CACHE_MAX_SIZE" ]; then
+        preprocessor_args+=(--cache-max-size "$PASH_PREPROCESS_CACHE_MAX_SIZE")
+    fi
+fi
+
+## The preprocessing server and its client exit with this code when the request
+## could not be served, in which case we run the preprocessor directly.
+PREPROCESSOR_UNAVAILABLE=75
+
+## Calls preprocessor.py (or the preprocessing server) to transform the script, which is
+## given on stdin with -c
+run_preprocessor()
+{
+    if [ -n "$command_mode" ]; then
+        printf '%s\n' "$command_text" | call_preprocessor
+    else
+        call_preprocessor
+    fi
+}
+
+call_preprocessor()
+{
+    local preprocessor_exit_code=$PREPROCESSOR_UNAVAILABLE
+    if [ -n "$PASH_PREPROCESSOR_SOCKET" ] && [ -S "$PASH_PREPROCESSOR_SOCKET" ] &&
+           [ -x "$RUNTIME_LIBRARY_DIR/preprocess-client" ]; then
+        __jit_redir_all_output echo "PaSh: Calling preprocessing server at $PASH_PREPROCESSOR_SOCKET..."
+        "$RUNTIME_LIBRARY_DIR/preprocess-client" "$PASH_PREPROCESSOR_SOCKET" "${preprocessor_args[@]}"
+        preprocessor_exit_code=$?
+    fi
+
+    if [ $preprocessor_exit_code -eq $PREPROCESSOR_UNAVAILABLE ]; then
+        __jit_redir_all_output echo "PaSh: Calling preprocessor..."
+        "$PYTHON_VENV" "$PASH_TOP/preprocessor/preprocessor.py" "${preprocessor_args[@]}"
+        preprocessor_exit_code=$?
+    fi
+    return $preprocessor_exit_code
+}
+
+## The runtime appends a record for every region to the profile (see runtime/jit_profile.sh),
+## after a record of the script that the line numbers refer to.
+start_profile()
+{
+    ## The path is absolute since the script can change its directory
+    : > "$profile_file"
+    export PASH_PROFILE="$(realpath -- "$profile_file")"
+    if [ -n "$command_mode" ]; then
+        printf 'S\t-\n' > "$PASH_PROFILE"
+    else
+        printf 'S\t%s\n' "$(realpath -- "$input_script")" > "$PASH_PROFILE"
+    fi
+}
+
+## Every process of the script writes its trace records to its own file in a temporary
+## directory (see runtime/jit_trace.sh), and the files are merged by time when it exits.
+start_trace()
+{
+    trace_file="$(realpath -- "$trace_file")"
+    export PASH_TRACE_DIR="$(mktemp -d)"
+}
+
+finish_trace()
+{
+    find "$PASH_TRACE_DIR" -type f -exec cat {} + | LC_ALL=C sort -s -t, -k1,1 > "$trace_file"
+    rm -rf "$PASH_TRACE_DIR"
+}
+
+## Every process of the script writes the resources that its regions used to its own file in
+## a temporary directory (see runtime/jit_accounting.sh), and the regions are ranked by the
+## resources that they used when it exits (see preprocessor/accounting_report.py).
+start_accounting()
+{
+    accounting_file="$(realpath -- "$accounting_file")"
+    export PASH_ACCOUNTING_DIR="$(mktemp -d)"
+    if [ -n "$command_mode" ]; then
+        printf 'S\t-\n' > "$PASH_ACCOUNTING_DIR/script"
+    else
+        printf 'S\t%s\n' "$(realpath -- "$input_script")" > "$PASH_ACCOUNTING_DIR/script"
+    fi
+}
+
+finish_accounting()
+{
+    "$PYTHON_VENV" "$PASH_TOP/preprocessor/accounting_report.py" "$PASH_ACCOUNTING_DIR" \
+        > "$accounting_file"
+    rm -rf "$PASH_ACCOUNTING_DIR"
+}
+
+## The analysis server runs for the whole script, and the processes of the script send it
+## their events through FIFOs in a temporary directory (see preprocessor/analysis_server.py).
+## The script only starts once the server is ready, i.e., once it loaded the analysis.
+start_analysis()
+{
+    local ready_fd ready=
+    export PASH_ANALYSIS_DIR="$(mktemp -d)"
+    mkfifo -m 600 "$PASH_ANALYSIS_DIR/requests" "$PASH_ANALYSIS_DIR/ready"
+    if [ "$analysis_async" = true ]; then
+        export PASH_ANALYSIS_ASYNC=1
+    fi
+    "$PYTHON_VENV" "$PASH_TOP/preprocessor/analysis_server.py" "$analysis_file" \
+        --dir "$PASH_ANALYSIS_DIR" --debug "$PASH_DEBUG_LEVEL" &
+    analysis_server_pid=$!
+    exec {ready_fd}<>"$PASH_ANALYSIS_DIR/ready"
+    until read -r -t 1 -u "$ready_fd" ready; do
+        kill -0 "$analysis_server_pid" 2> /dev/null || break
+    done
+    exec {ready_fd}<&-
+    if [ "$ready" != ready ]; then
+        echo "Error: The analysis server failed to start" >&2
+        rm -rf "$PASH_ANALYSIS_DIR"
+        exit 1
+    fi
+}
+
+## The server handles the events that are still queued before it finishes the analysis
+finish_analysis()
+{
+    printf 'finish\n' > "$PASH_ANALYSIS_DIR/requests"
+    wait "$analysis_server_pid"
+    rm -rf "$PASH_ANALYSIS_DIR"
+}
+
+## Regions bypass the JIT after this many executions (see runtime/jit_tiers.sh)
+if [ -n "$hot_threshold" ]; then
+    export PASH_JIT_HOT_THRESHOLD="$hot_threshold"
+fi
+
+## At most this many regions of a group run as background jobs (see runtime/jit_scheduler.sh)
+if [ -n "$jobs" ]; then
+    export PASH_JIT_JOBS="$jobs"
+fi
+
+## Deterministic regions replay their earlier executions from this store, which is shared
+## by all runs (see runtime/jit_memo.sh)
+if [ "$memoize" = true ]; then
+    export PASH_MEMO_DIR="$(realpath -m -- "${PASH_MEMO_DIR:-${XDG_CACHE_HOME:-$HOME/.cache}/sh-instrument/memo}")"
+    mkdir -p -- "$PASH_MEMO_DIR"
+fi
+
+## The scripts that the script sources are preprocessed by the runtime the first time that
+## they are sourced, and kept in a temporary directory that every process of the script
+## shares (see runtime/jit_source.sh), through the preprocessing cache, which lets other
+## runs reuse them if it is enabled.
+start_sourced_scripts()
+{
+    export PASH_SOURCE_DIR="$(mktemp -d)"
+    export PASH_SOURCE_PREPROCESSOR_ARGS="$(
+        printf '%q ' "${preprocessing_options[@]}" \
+            --cache-dir "${PASH_PREPROCESS_CACHE_DIR:-$PASH_SOURCE_DIR/cache}"
+        if [ -n "$PASH_PREPROCESS_CACHE_DIR" ] && [ -n "$PASH_PREPROCESS_CACHE_MAX_SIZE" ]; then
+            printf '%q ' --cache-max-size "$PASH_PREPROCESS_CACHE_MAX_SIZE"
+        fi
+    )"
+}
+
+finish_sourced_scripts()
+{
+    rm -rf "$PASH_SOURCE_DIR"
+}
+
+## Runs the preprocessed script with runner.sh
+run_runner()
+{
+    __jit_redir_all_output echo "PaSh: Calling runner..."
+    "$PASH_TOP/runner.sh" \
+        "$preprocessed_output" \
+        "$shell_name" \
+        "${script_args[@]}" \
+        $allexport_flag \
+        $verbose_flag \
+        $xtrace_flag \
+        --debug "$PASH_DEBUG_LEVEL" \
+        "$@"
+}
+
+if [ "$stream" = true ]; then
+    if [ -n "$profile_file" ]; then
+        start_profile
+    fi
+    if [ -n "$trace_file" ]; then
+        start_trace
+    fi
+    if [ -n "$accounting_file" ]; then
+        start_accounting
+    fi
+    if [ -n "$analysis_file" ]; then
+        start_analysis
+    fi
+    if [ "$instrument_sourced" = true ]; then
+        start_sourced_scripts
+    fi
+
+    ## The preprocessor runs in the background, next to the runner. The FIFO is also kept
+    ## open for writing here until the preprocessor exits, so that the runner reads the
+    ## end of the script even if the preprocessor failed before opening it. The first line
+    ## restores $0, which would otherwise be the path of the FIFO (see runner.sh --stream).
+    {
+        printf 'BASH_ARGV0=%q\n' "$shell_name" >&3
+        run_preprocessor 3>&-
+    } 3>"$preprocessed_output" &
+    preprocessor_pid=$!
+
+    run_runner --stream
+    runner_exit_code=$?
+    if [ -n "$trace_file" ]; then
+        finish_trace
+    fi
+    if [ -n "$accounting_file" ]; then
+        finish_accounting
+    fi
+    if [ -n "$analysis_file" ]; then
+        finish_analysis
+    fi
+    if [ "$instrument_sourced" = true ]; then
+        finish_sourced_scripts
+    fi
+
+    wait "$preprocessor_pid"
+    preprocessor_exit_code=$?
+    rm -rf "$stream_dir"
+
+    ## Like a syntax error in bash, a preprocessing error stops the script where it happens
+    if [ $preprocessor_exit_code -ne 0 ]; then
+        __jit_redir_all_output echo "PaSh: Preprocessor failed with exit code $preprocessor_exit_code"
+        exit $preprocessor_exit_code
+    fi
+    exit $runner_exit_code
+fi
+
+# Step 1: Call preprocessor.py to transform the script
+run_preprocessor
 preprocessor_exit_code=$?
 
 if [ $preprocessor_exit_code -ne 0 ]; then
@@ -218,23 +603,39 @@ if [ "$preprocess_only" = true ]; then
     exit 0
 fi
 
-# Step 2: Call runner.sh to execute the preprocessed script
-__jit_redir_all_output echo "PaSh: Calling runner..."
-"$PASH_TOP/runner.sh" \
-    "$preprocessed_output" \
-    "$shell_name" \
-    "${script_args[@]}" \
-    $allexport_flag \
-    $verbose_flag \
-    $xtrace_flag \
-    --debug "$PASH_DEBUG_LEVEL"
+if [ -n "$profile_file" ]; then
+    start_profile
+fi
+if [ -n "$trace_file" ]; then
+    start_trace
+fi
+if [ -n "$accounting_file" ]; then
+    start_accounting
+fi
+if [ -n "$analysis_file" ]; then
+    start_analysis
+fi
+if [ "$instrument_sourced" = true ]; then
+    start_sourced_scripts
+fi
 
+# Step 2: Call runner.sh to execute the preprocessed script
+run_runner
 runner_exit_code=$?
+if [ -n "$trace_file" ]; then
+    finish_trace
+fi
+if [ -n "$accounting_file" ]; then
+    finish_accounting
+fi
+if [ -n "$analysis_file" ]; then
+    finish_analysis
+fi
+if [ "$instrument_sourced" = true ]; then
+    finish_sourced_scripts
+fi
 
 # Clean up temporary files if we created them
-if [ -n "$command_mode" ]; then
-    rm -f "$input_script"
-fi
 rm -f "$preprocessed_output"
 
 exit $runner_exit_code
@@ -0,0 +1,6 @@
+## Regions that use different resources (see --accounting in sh-instrument.sh)
+for i in 1 2 3; do
+    printf '%s\n' "$i" > /dev/null
+done
+seq 1 300000 | sort -rn | tail -n 1
+head -c 100000 /dev/zero | wc -c
@@ -0,0 +1,7 @@
+## Every region is sent to the analysis server before and after it runs
+for i in 1 2 3; do
+    echo "iteration $i"
+done
+false
+( echo subshell; true )
+echo done
@@ -0,0 +1,85 @@
+"""
+Preprocesses the given scripts with the API (see preprocessor/api.py) from many threads and
+asyncio tasks at a time, and checks that every result is the output of preprocessor.py:
+
+  api-threads.py PASH_TOP SCRIPT...
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+PASH_TOP = sys.argv[1]
+SCRIPTS = sys.argv[2:]
+sys.path.insert(0, os.path.join(PASH_TOP, "preprocessor"))
+
+import api  # noqa: E402
+
+RUNTIME = os.path.join(PASH_TOP, "jit.sh")
+OPTIONS = [
+    ({}, ["--region-mode", "function"]),
+    (
+        {"bash": True, "granularity": "block"},
+        ["--region-mode", "function", "--bash", "--granularity", "block"],
+    ),
+]
+THREADS = 8
+ROUNDS = 4
+
+
+def preprocessed_by_cli(script, arguments):
+    with tempfile.NamedTemporaryFile() as output:
+        subprocess.run(
+            [sys.executable, os.path.join(PASH_TOP, "preprocessor", "preprocessor.py"), script,
+             "--output", output.name, "--runtime-executable", RUNTIME, *arguments],
+            check=True,
+        )
+        return output.read()
+
+
+def main():
+    jobs = []
+    for script in SCRIPTS:
+        with open(script, "rb") as script_file:
+            source = script_file.read()
+        for options, arguments in OPTIONS:
+            jobs.append((source, options, preprocessed_by_cli(script, arguments)))
+
+    with ThreadPoolExecutor(THREADS) as executor:
+        results = list(executor.map(
+            lambda job: api.preprocess(job[0], runtime=RUNTIME, **job[1]).script, jobs * ROUNDS
+        ))
+
+    async def preprocess_all():
+        return await asyncio.gather(
+            *(
+                api.preprocess_async(source, runtime=RUNTIME, **options)
+                for source, options, _ in jobs
+            )
+        )
+
+    results += [result.script for result in asyncio.run(preprocess_all())]
+    expected = [output for _, _, output in jobs] * (ROUNDS + 1)
+    different = sum(result != output for result, output in zip(results, expected))
+    print(f"{len(results)} preprocessed, {different} different from preprocessor.py")
+
+    ## Region files are only written when asked for
+    with tempfile.TemporaryDirectory() as region_dir:
+        result = api.preprocess(
+            jobs[0][0], runtime=RUNTIME, region_mode="file", region_dir=region_dir
+        )
+        written_before = len(os.listdir(region_dir))
+        result.write_region_files()
+        print(f"{written_before} region files before writing them, {len(os.listdir(region_dir))} after")
+
+    try:
+        api.preprocess(b"if then\n", runtime=RUNTIME)
+    except api.ParsingError:
+        print("parsing error")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+## Keeps running while other runs evict its preprocessing cache entry (see test_cache)
+echo "before $1"
+sleep "${2:-0}"
+echo "after $1"
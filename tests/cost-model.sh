@@ -0,0 +1,12 @@
+## Cheap builtins (which are left as they are) next to expensive commands
+set -- a b c
+shift
+x=1
+: "$x"
+true
+echo "cheap $x $1"
+echo "expensive $(echo sub)"
+printf '%s\n' b a | sort
+f() { local y=1; echo "f $y"; }
+f
+if [ "$x" -eq 1 ]; then echo one; fi
@@ -0,0 +1,14 @@
+false
+echo $?
+(exit 3)
+echo $?
+echo "status after echo: $?"
+! true
+echo $?
+set -u
+false || echo "or after false: $?"
+set +u
+set -e
+if false; then echo unreachable; else echo "else branch: $?"; fi
+false && echo unreachable
+echo "after and: done"
@@ -0,0 +1,45 @@
+set -e
+
+fib()
+{
+    if [ "$1" -lt 2 ]; then
+        echo "$1"
+        return
+    fi
+    local a b
+    a=$(fib $(( $1 - 1 )))
+    b=$(fib $(( $1 - 2 )))
+    echo $(( a + b ))
+}
+
+count()
+{
+    local n=0
+    for x in "$@"; do
+        n=$((n + 1))
+    done
+    echo "count $n" | cat
+    [ "$n" -gt 2 ] && return 3
+    false || true
+}
+
+in_subshell() ( echo "subshell $1"; return 4 )
+
+status_at_entry() { echo "entry $?"; }
+
+shift_args() { shift; echo "rest $*"; }
+
+outer()
+{
+    inner() { echo "inner $1"; return 2; }
+    inner "$1" || echo "inner status $?"
+}
+
+fib 6
+count a b c || echo "count status $?"
+count a
+in_subshell x || echo "subshell status $?"
+false || status_at_entry
+shift_args 1 2 3
+outer y
+inner z || echo "inner status $?"
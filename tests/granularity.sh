@@ -0,0 +1,25 @@
+set -e
+x=1
+echo "start $x"
+true && echo and
+false && echo never
+false || echo or
+! false
+echo "status $?"
+{ false && : ; }
+echo "status $?"
+if [ "$x" = 1 ]; then
+    y=2
+    echo "then $y"
+fi
+case "$x" in
+    1) echo one ;;
+esac
+echo background &
+wait
+false || true; echo "after $?"
+( exit 3 ) || echo "subshell $?"
+for i in 1 2; do
+    echo "loop $i" && false || :
+done
+echo "end $x $y"
@@ -0,0 +1,28 @@
+## Regions that run many times, in different shell states and with different arguments
+count() {
+    echo "count $1 $#" | cat
+    [ "$1" -lt 3 ] && :
+}
+
+for i in 1 2 3 4 5 6; do
+    count "$i" x
+    echo "status $?"
+done
+
+set -- one two
+for i in 1 2 3; do
+    echo "args $# $*"
+    [ "$#" -gt 0 ] && shift
+done
+
+set -u
+for i in 1 2 3; do
+    echo "nounset $i"
+    false || echo "ignored $i"
+done
+set +u
+
+for j in a b c; do
+    set -- "$j"
+    echo "arg $1"
+done
@@ -0,0 +1,39 @@
+## Loops that leave their function or an enclosing loop
+
+find_first()
+{
+    local wanted=$1
+    shift
+    for x in "$@"; do
+        echo "checking $x" | cat
+        if [ "$x" = "$wanted" ]; then
+            return 7
+        fi
+    done
+    return 0
+}
+
+find_first b a b c
+echo "find_first returned $?"
+find_first z a b c
+echo "find_first returned $?"
+
+for i in 1 2 3; do
+    for j in 1 2 3; do
+        [ "$j" -eq 2 ] && continue 2
+        [ "$i" -eq 3 ] && break 2
+        echo "pair $i $j" | cat
+    done
+    echo "not reached $i"
+done
+echo "after the nested loops"
+
+n=0
+while true; do
+    n=$((n + 1))
+    for k in 1 2; do
+        echo "inner $n $k" | cat
+        [ "$n" -ge 2 ] && break 2
+    done
+done
+echo "left the while loop after $n"
@@ -0,0 +1,43 @@
+set -e
+for i in 1 2 3; do
+    for j in a b; do
+        [ "$j" = b ] && continue
+        echo "$i $j"
+    done
+    [ "$i" = 2 ] && break
+done
+n=0
+while [ "$n" -lt 3 ]; do
+    n=$((n + 1))
+done
+until [ "$n" -eq 0 ]; do
+    n=$((n - 1))
+done
+echo "$n"
+## The loop body must see the exit status from before the loop
+! true
+for i in 1; do
+    echo "status $?"
+done
+printf '%s\n' x y | while read -r line; do
+    echo "line $line"
+done
+while read -r line; do
+    echo "redirected $line"
+done < loops.sh | head -n 1
+for i in a; do false && : ; done
+echo "passed ignored failure"
+## A failure in the body stops the loop (and the subshell) under set -e
+set +e
+(
+    set -e
+    for i in 1 2; do
+        false
+        echo "not reached $i"
+    done
+)
+echo "set -e stopped the loop with status $?"
+set -e
+for i in a; do
+    true
+done
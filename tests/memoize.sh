@@ -0,0 +1,10 @@
+## Deterministic regions replay their outputs when their inputs did not change
+cd "$1"
+sort words | uniq -c > counts
+cat counts
+grep -c a words
+tr a-z A-Z < words | head -n 1
+## These depend on what changes between runs
+echo "$2" | tr a-z A-Z
+printf '%s\n' "$2" >> runs
+sort runs
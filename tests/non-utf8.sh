@@ -0,0 +1,3 @@
+## The bytes that are not UTF-8 must reach the shell as they are
+x=' latin1 '
+printf "%s" "$x" | od -An -tx1
@@ -0,0 +1,37 @@
+## Independent commands (which run in parallel with --parallel) next to dependent ones
+dir=$(mktemp -d)
+cd "$dir"
+printf '%s\n' c a b > in1
+printf '%s\n' z y > in2
+sort in1 > out1
+sort -r in2 > out2
+wc -l in1 > count
+sleep 0
+cat out1 out2 count
+## The last region of a group keeps its exit status
+sort in1 > out3
+grep -q x in2
+echo "status $?"
+## A function with the name of a command runs after the jobs of its group
+sort() { sorted=yes; command sort "$@"; }
+sort in2 > out4
+sort in1 > out5
+echo "function $sorted"
+cat out3 out4 out5
+unset -f sort
+## Under set -e, the regions run one after the other
+set -e
+sort in1 > out6
+sort in2 > out7
+set +e
+cat out6 out7
+## A background job of the script keeps its $!
+sleep 0 &
+pid=$!
+sort in1 > out8
+sort in2 > out9
+wait "$pid"
+[ "$pid" = "$!" ] && echo "pid kept"
+cat out8 out9
+cd /
+rm -r "$dir"
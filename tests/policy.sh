@@ -0,0 +1,13 @@
+cd "$(dirname "$0")"
+echo start
+x=$(printf '%s\n' b a | sort | head -n 1)
+printf '%s\n' c a b | sort | tail -n 1
+curl_fake() { echo "fake $1"; }
+curl_fake url
+if true; then
+  echo inside
+  printf '%s\n' z | cat
+fi
+sleep 0 &
+wait
+echo "$x done"
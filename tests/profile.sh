@@ -0,0 +1,6 @@
+echo start
+for i in 1 2 3; do
+  echo "$i" |
+    cat
+done
+false || echo failed
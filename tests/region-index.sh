@@ -0,0 +1,10 @@
+## The region index records what every region reads, writes and runs
+greeting=hello
+read -r first rest <<END
+one two three
+END
+echo "$greeting $first ${count:=3}" | tr a-z A-Z
+for word in $rest; do
+    printf -v last '%s' "$word"
+done
+echo "$last $count" > /dev/null 2>&1
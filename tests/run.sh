@@ -194,6 +194,462 @@ test_set()
     cat set.sh.out
 }
 
+## Tests loops that are stubbed as a single region
+test_loop_policy()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --loop_policy loop loops.sh
+        $shell --loop_policy loop --cost_threshold 100 loops.sh
+        ## The loops that the cost model does not select are stubbed per iteration
+        $shell --loop_policy loop --cost_threshold 100 --preprocess_only --output_preprocessed loops.sh |
+            grep -c '__jit_region_id='
+    else
+        $shell loops.sh
+        $shell loops.sh
+        echo 3
+    fi
+}
+
+## Tests that loops that `return`, `break N` or `continue N` are stubbed per iteration
+test_loop_exits()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --loop_policy loop loop-exits.sh
+        $shell --loop_policy loop --function_bodies --region_mode function loop-exits.sh
+    else
+        $shell loop-exits.sh
+        $shell loop-exits.sh
+    fi
+}
+
+## Tests stubbing only the regions selected by a policy
+test_policy()
+{
+    local shell=$1 policy all without_sort selected
+    if [ "$shell" != "bash" ]; then
+        $shell --policy policy.json policy.sh
+        ## Every policy stubs fewer regions: none, one that excludes `sort`, and policy.json
+        ## (the counts of the first two depend on the parser, see --bash)
+        policy=$(mktemp)
+        echo '{"exclude": [{"command": "sort"}]}' > "$policy"
+        all=$($shell --preprocess_only --output_preprocessed policy.sh | grep -c '__jit_region_id=')
+        without_sort=$($shell --policy "$policy" --preprocess_only --output_preprocessed policy.sh |
+            grep -c '__jit_region_id=')
+        selected=$($shell --policy policy.json --preprocess_only --output_preprocessed policy.sh |
+            grep -c '__jit_region_id=')
+        rm -f "$policy"
+        [ "$without_sort" -lt "$all" ] && [ "$selected" -lt "$without_sort" ] &&
+            echo "fewer stubs with every policy"
+        echo "$selected stubs with policy.json"
+    else
+        $shell policy.sh
+        echo "fewer stubs with every policy"
+        echo "3 stubs with policy.json"
+    fi
+}
+
+## Tests stubbing only the regions that are worth their JIT overhead
+test_cost_model()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --cost_threshold 100 cost-model.sh
+        $shell --cost_threshold 100 --granularity block cost-model.sh
+        ## Only the command substitution, the pipeline, and the function call are stubbed
+        $shell --cost_threshold 100 --preprocess_only --output_preprocessed cost-model.sh |
+            grep -c '__jit_region_id='
+    else
+        $shell cost-model.sh
+        $shell cost-model.sh
+        echo 3
+    fi
+}
+
+## Tests that profiling records every execution of a region with its source lines
+test_profile()
+{
+    local shell=$1
+    rm -f profile.tsv
+    if [ "$shell" != "bash" ]; then
+        $shell --profile profile.tsv profile.sh
+        awk -F'\t' '$1 == "X" && $3 == "3-4" { n++ } END { print n, "iterations" }' profile.tsv
+        awk -F'\t' '$1 == "X" && $3 == "6-6" && $6 != 0 { print "exit status", $6 }' profile.tsv
+        rm -f profile.tsv
+    else
+        $shell profile.sh
+        echo 3 iterations
+        echo exit status 1
+    fi
+}
+
+## Tests preprocessing a script again after changing some of its lines
+test_incremental()
+{
+    local shell=$1 index_dir options
+    for options in "" "--region_mode function --granularity block"; do
+        index_dir=$(mktemp -d)
+        cp granularity.sh incremental.sh.tmp
+        if [ "$shell" != "bash" ]; then
+            PASH_PREPROCESS_INCREMENTAL_DIR="$index_dir" $shell $options incremental.sh.tmp
+            ls "$index_dir"/*/regions > "$index_dir/regions"
+        else
+            $shell incremental.sh.tmp
+        fi
+        { echo 'echo inserted'; sed '3s/.*/echo "changed $x"/' granularity.sh; } > incremental.sh.tmp
+        if [ "$shell" != "bash" ]; then
+            ## The unchanged commands are reused, and the region files of the first version
+            ## are kept for the runs that may still source them
+            PASH_PREPROCESS_INCREMENTAL_DIR="$index_dir" $shell $options -d 1 incremental.sh.tmp \
+                2> "$index_dir/log"
+            grep -o "reusing [0-9]* units" "$index_dir/log"
+            ls "$index_dir"/*/regions | comm -23 "$index_dir/regions" - | wc -l
+        else
+            $shell incremental.sh.tmp
+            if [ -z "$options" ]; then echo "reusing 16 units"; else echo "reusing 2 units"; fi
+            echo 0
+        fi
+        rm -rf "$index_dir" incremental.sh.tmp
+    done
+    ## The bytes that are not UTF-8 are kept, also in the commands that are reused
+    index_dir=$(mktemp -d)
+    if [ "$shell" != "bash" ]; then
+        PASH_PREPROCESS_INCREMENTAL_DIR="$index_dir" $shell --bash non-utf8.sh
+        PASH_PREPROCESS_INCREMENTAL_DIR="$index_dir" $shell --bash non-utf8.sh
+    else
+        $shell non-utf8.sh
+        $shell non-utf8.sh
+    fi
+    rm -rf "$index_dir"
+}
+
+## Tests instrumenting function bodies, whose calls are profiled
+test_function_bodies()
+{
+    local shell=$1
+    rm -f profile.tsv
+    if [ "$shell" != "bash" ]; then
+        $shell --function_bodies --profile profile.tsv function-bodies.sh
+        awk -F'\t' '$1 == "F" && $2 == "fib" { n += $3 } END { print "fib", n, "calls" }' profile.tsv
+        rm -f profile.tsv
+        $shell --function_bodies --granularity block --region_mode function function-bodies.sh
+    else
+        $shell function-bodies.sh
+        echo fib 25 calls
+        $shell function-bodies.sh
+    fi
+}
+
+test_hot_regions()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --hot_threshold 2 hot-regions.sh
+        $shell --hot_threshold 1 --region_mode function --granularity block hot-regions.sh
+    else
+        $shell hot-regions.sh
+        $shell hot-regions.sh
+    fi
+}
+
+test_parallel()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --parallel parallel.sh
+        $shell --parallel --jobs 1 --bash --region_mode function parallel.sh
+        ## The stubs of the regions in groups of independent regions
+        $shell --parallel --preprocess_only --output_preprocessed parallel.sh |
+            grep -c '__jit_parallel_job='
+    else
+        $shell parallel.sh
+        $shell parallel.sh
+        echo 13
+    fi
+}
+
+test_trace()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --trace trace.ndjson trace.sh
+        ## Every region that was entered exited, and the subshell wrote its own records
+        awk '/"phase":"enter"/ { n++ } /"phase":"exit"/ { n-- }
+             { split($0, f, "\"pid\":"); split(f[2], p, ","); if (!(p[1] in pids)) { pids[p[1]]; k++ } }
+             END { print n, "unfinished,", (k > 1 ? "several" : "one"), "processes" }' trace.ndjson
+        "$PASH_TOP/python_pkgs/bin/python" "$PASH_TOP/preprocessor/trace_report.py" --summary trace.ndjson |
+            awk 'NR > 1 { n += $2 } END { print (n > 0 ? "decoded" : "empty") }'
+        rm -f trace.ndjson
+    else
+        $shell trace.sh
+        echo 0 unfinished, several processes
+        echo decoded
+    fi
+}
+
+test_region_index()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --region_index region-index.bin region-index.sh
+        ## The commands, variables and redirections of every region, without parsing it again
+        "$PASH_TOP/python_pkgs/bin/python" "$PASH_TOP/preprocessor/region_index.py" region-index.bin |
+            grep -o '"variables": .*'
+        rm -f region-index.bin
+    else
+        $shell region-index.sh
+        cat <<'END'
+"variables": {"read": [], "written": ["first", "rest"]}, "commands": ["read"], "redirections": [{"fd": 0, "type": "XHere", "target": null}]}
+"variables": {"read": ["count", "first", "greeting"], "written": ["count"]}, "commands": ["echo", "tr"], "redirections": []}
+"variables": {"read": ["word"], "written": ["last"]}, "commands": ["printf"], "redirections": []}
+"variables": {"read": ["count", "last"], "written": []}, "commands": ["echo"], "redirections": [{"fd": 1, "type": "To", "target": "/dev/null"}, {"fd": 2, "type": "ToFD", "target": "1"}]}
+END
+    fi
+}
+
+test_analysis()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --analysis "$PASH_TOP/preprocessor/analysis_example.py" analysis.sh 2> analysis.err
+        $shell --analysis_async --bash --region_mode function \
+            --analysis "$PASH_TOP/preprocessor/analysis_example.py" analysis.sh 2>> analysis.err
+        ## The executions and failures that the analysis saw in every region
+        sed 's/^[^:]*: //; s/, [0-9.]*s$//' analysis.err
+        rm -f analysis.err
+    else
+        $shell analysis.sh
+        $shell analysis.sh
+        for i in 1 2; do
+            echo "3 executions, 0 failed"
+            echo "1 executions, 1 failed"
+            echo "1 executions, 0 failed"
+            echo "1 executions, 0 failed"
+            echo "1 executions, 0 failed"
+        done
+    fi
+}
+
+test_memoize()
+{
+    local shell=$1 dir
+    dir=$(mktemp -d)
+    printf '%s\n' b a c a > "$dir/words"
+    if [ "$shell" != "bash" ]; then
+        PASH_MEMO_DIR="$dir/store" $shell --memoize memoize.sh "$dir" first
+        ## The regions whose inputs did not change are replayed
+        PASH_MEMO_DIR="$dir/store" $shell --memoize --region_mode function -d 1 \
+            memoize.sh "$dir" second 2> "$dir/log"
+        grep -c "is replayed" "$dir/log"
+        PASH_MEMO_DIR="$dir/store" $shell --memoize --bash memoize.sh "$dir" third
+    else
+        $shell memoize.sh "$dir" first
+        $shell memoize.sh "$dir" second
+        echo 4
+        $shell memoize.sh "$dir" third
+    fi
+    rm -rf "$dir"
+}
+
+test_sourced()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --instrument_sourced sourced.sh
+        ## Every sourced script is preprocessed once, and then only looked up
+        $shell --instrument_sourced --region_mode function -d 1 sourced.sh 2> sourced.err
+        grep -c "Preprocessing sourced script" sourced.err
+        grep -c "Sourcing .* preprocessed" sourced.err
+        rm -f sourced.err
+        $shell --instrument_sourced --bash --granularity block sourced.sh
+    else
+        $shell sourced.sh
+        $shell sourced.sh
+        echo 2
+        echo 12
+        $shell sourced.sh
+    fi
+}
+
+test_accounting()
+{
+    local shell=$1 options
+    for options in "" "--bash --region_mode function"; do
+        if [ "$shell" != "bash" ]; then
+            $shell --accounting accounting.txt $options accounting.sh
+            ## Every execution is counted, the region that sorts uses the most CPU and sets
+            ## the peak RSS, and the regions with pipelines start processes
+            awk 'NR == 5 { print "first", $2, ($12 > 0 ? "rss" : "no rss") }
+                 NR > 4 { print $2, $3, ($8 >= 2 ? "processes" : "none") }' \
+                accounting.txt | sort
+            rm -f accounting.txt
+        else
+            $shell accounting.sh
+            printf '%s\n' "3-3 3 none" "5-5 1 processes" "6-6 1 processes" "first 5-5 rss"
+        fi
+    done
+}
+
+## Tests the preprocessing cache: hits, misses, and evicting the entry of a running script
+test_cache()
+{
+    local shell=$1 dir running
+    dir=$(mktemp -d)
+    cp cache.sh "$dir/first.sh"
+    { cat cache.sh; echo "## changed"; } > "$dir/second.sh"
+    if [ "$shell" != "bash" ]; then
+        export PASH_PREPROCESS_CACHE_DIR="$dir/cache" PASH_PREPROCESS_CACHE_MAX_SIZE=1
+        $shell -d 1 "$dir/first.sh" miss 2> "$dir/log"
+        grep -c "Preprocessing cache miss" "$dir/log"
+        $shell -d 1 "$dir/first.sh" hit 2> "$dir/log"
+        grep -c "Preprocessing cache hit" "$dir/log"
+        ## The cache only fits one entry, so the second script evicts the first one
+        $shell "$dir/first.sh" running 2 &
+        running=$!
+        sleep 1
+        $shell -d 1 "$dir/second.sh" evicting 2> "$dir/log"
+        grep -c "Evicting preprocessing cache entry" "$dir/log"
+        wait "$running"
+        $shell -d 1 "$dir/first.sh" evicted 2> "$dir/log"
+        grep -c "Preprocessing cache miss" "$dir/log"
+        unset PASH_PREPROCESS_CACHE_DIR PASH_PREPROCESS_CACHE_MAX_SIZE
+    else
+        $shell "$dir/first.sh" miss
+        echo 1
+        $shell "$dir/first.sh" hit
+        echo 1
+        $shell "$dir/first.sh" running 2 &
+        running=$!
+        sleep 1
+        $shell "$dir/second.sh" evicting
+        echo 1
+        wait "$running"
+        $shell "$dir/first.sh" evicted
+        echo 1
+    fi
+    rm -rf "$dir"
+}
+
+## Tests preprocessing through the preprocessing server, and falling back to preprocessing
+## in-process when it cannot be reached
+test_server()
+{
+    local shell=$1 dir server
+    if [ "$shell" != "bash" ]; then
+        dir=$(mktemp -d)
+        "$PASH_TOP/python_pkgs/bin/python" "$PASH_TOP/preprocessor/server.py" \
+            --socket "$dir/server" &
+        server=$!
+        for _ in {1..100}; do
+            [ -S "$dir/server" ] && break
+            sleep 0.1
+        done
+        PASH_PREPROCESSOR_SOCKET="$dir/server" $shell -d 1 loops.sh 2> "$dir/log"
+        grep -c "Calling preprocessing server" "$dir/log"
+        grep -c "Calling preprocessor\.\.\." "$dir/log"
+        kill "$server"
+        wait "$server"
+        ## Without a socket, or with a socket that nothing listens on
+        PASH_PREPROCESSOR_SOCKET="$dir/missing" $shell -d 1 loops.sh 2> "$dir/log"
+        grep -c "Calling preprocessor\.\.\." "$dir/log"
+        "$PASH_TOP/python_pkgs/bin/python" -c \
+            'import socket, sys; socket.socket(socket.AF_UNIX).bind(sys.argv[1])' "$dir/stale"
+        PASH_PREPROCESSOR_SOCKET="$dir/stale" $shell -d 1 loops.sh 2> "$dir/log"
+        grep -c "Calling preprocessing server" "$dir/log"
+        grep -c "Calling preprocessor\.\.\." "$dir/log"
+        rm -rf "$dir"
+    else
+        $shell loops.sh
+        echo 1
+        echo 0
+        $shell loops.sh
+        echo 1
+        $shell loops.sh
+        echo 1
+        echo 1
+    fi
+}
+
+test_api()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        ## The API gives the output of preprocessor.py, even from many threads at a time
+        "$PASH_TOP/python_pkgs/bin/python" api-threads.py "$PASH_TOP" \
+            loops.sh redirect.sh function-bodies.sh heredoc1.sh escape-madness.sh 2> /dev/null
+    else
+        echo "50 preprocessed, 0 different from preprocessor.py"
+        echo "0 region files before writing them, 23 after"
+        echo "parsing error"
+    fi
+}
+
+## Tests preprocessing scripts in a batch to a relative output directory,
+## and running them from another directory
+test_batch()
+{
+    local shell=$1 dir
+    dir=$(mktemp -d)
+    mkdir "$dir/scripts"
+    printf 'echo one | tr a-z A-Z\nfor i in 1 2; do echo "iteration $i" | cat; done\n' > "$dir/scripts/first.sh"
+    printf 'echo "two $1" | cat\n' > "$dir/scripts/second.sh"
+    printf 'if then fi\n' > "$dir/scripts/broken.sh"
+    if [ "$shell" != "bash" ]; then
+        ( cd "$dir" && "$PASH_TOP/python_pkgs/bin/python" "$PASH_TOP/preprocessor/batch.py" \
+            --output-dir out --runtime-executable "$PASH_TOP/jit.sh" \
+            scripts/first.sh scripts/second.sh scripts/broken.sh 2> /dev/null )
+        echo "batch exit $?"
+        ## The script that failed to parse leaves no output behind
+        ls "$dir/out"
+        (
+            export RUNTIME_DIR="$PASH_TOP/runtime"
+            __jit_redir_output() { :; }
+            __jit_redir_all_output() { :; }
+            __jit_redir_all_output_always_execute() { > /dev/null 2>&1 "$@"; }
+            export -f __jit_redir_output __jit_redir_all_output __jit_redir_all_output_always_execute
+            cd / &&
+                "$PASH_TOP/runner.sh" "$dir/out/first.sh" first.sh &&
+                "$PASH_TOP/runner.sh" "$dir/out/second.sh" second.sh arg
+        )
+    else
+        echo "batch exit 1"
+        printf '%s\n' first.sh first.sh.regions second.sh second.sh.regions
+        ( cd / && $shell "$dir/scripts/first.sh" && $shell "$dir/scripts/second.sh" arg )
+    fi
+    rm -rf "$dir"
+}
+
+## Tests running a script while it is preprocessed
+test_stream()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        echo input | $shell --stream stream.sh one two
+        echo "exit $?"
+        echo input | $shell --stream --region_mode function stream.sh one two
+        echo "exit $?"
+    else
+        echo input | $shell stream.sh one two
+        echo "exit $?"
+        echo input | $shell stream.sh one two
+        echo "exit $?"
+    fi
+}
+
+## Tests regions that merge several commands
+test_granularity()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        $shell --granularity sequence --max_region_size 3 granularity.sh
+        $shell --granularity block granularity.sh
+    else
+        $shell granularity.sh
+        $shell granularity.sh
+    fi
+}
+
 test_set_e()
 {
     local shell=$1
@@ -224,6 +680,17 @@ test_unparsing()
     $shell unparsing-special-chars.sh
 }
 
+test_non_utf8()
+{
+    local shell=$1
+    ## libdash only reads UTF-8 scripts, so this one is parsed with libbash
+    if [ "$shell" != "bash" ]; then
+        $shell --bash non-utf8.sh
+    else
+        $shell non-utf8.sh
+    fi
+}
+
 test_new_line_in_var()
 {
     local shell=$1
@@ -348,6 +815,24 @@ test_IFS()
     $shell test-IFS.sh
 }
 
+test_exit_status()
+{
+    local shell=$1
+    $shell exit-status.sh
+}
+
+## Tests regions emitted as functions
+test_region_mode_function()
+{
+    local shell=$1
+    if [ "$shell" != "bash" ]; then
+        shell="$shell --region_mode function"
+    fi
+    $shell exit-status.sh
+    $shell set.sh > /dev/null 2> set.sh.out
+    cat set.sh.out
+}
+
 run_test test1
 run_test test2
 run_test test3
@@ -370,6 +855,7 @@ run_test test_set
 run_test test_set_e
 run_test test_redirect
 run_test test_unparsing
+run_test test_non_utf8
 run_test test_set_e_2
 run_test test_set_e_3
 run_test test_new_line_in_var
@@ -391,6 +877,29 @@ run_test test_star
 run_test test_env_vars
 run_test test_redir_dup
 run_test test_IFS
+run_test test_exit_status
+run_test test_region_mode_function
+run_test test_loop_policy
+run_test test_loop_exits
+run_test test_granularity
+run_test test_policy
+run_test test_cost_model
+run_test test_profile
+run_test test_incremental
+run_test test_stream
+run_test test_function_bodies
+run_test test_hot_regions
+run_test test_trace
+run_test test_parallel
+run_test test_region_index
+run_test test_analysis
+run_test test_memoize
+run_test test_sourced
+run_test test_cache
+run_test test_server
+run_test test_batch
+run_test test_api
+run_test test_accounting
 
 if type lsb_release >/dev/null 2>&1 ; then
    distro=$(lsb_release -i -s)
@@ -0,0 +1,3 @@
+## Sourced by sourced-lib.sh
+shout() { tr a-z A-Z; }
+echo "helpers loaded"
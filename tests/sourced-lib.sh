@@ -0,0 +1,6 @@
+## Sourced by sourced.sh
+[ -n "${SOURCED_LIB_LOADED-}" ] && return 3
+SOURCED_LIB_LOADED=1
+. ./sourced-helpers.sh
+greet() { echo "hello $1" | shout; }
+echo "lib loaded with $# arguments: $*"
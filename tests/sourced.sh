@@ -0,0 +1,12 @@
+## Sources a script (that sources another one) several times, also in a subshell
+. ./sourced-lib.sh one two
+. ./sourced-lib.sh
+greet world
+for i in 1 2 3; do
+    unset SOURCED_LIB_LOADED
+    source sourced-lib.sh "$i" > /dev/null
+done
+( unset SOURCED_LIB_LOADED; . ./sourced-lib.sh subshell )
+false
+. ./sourced-lib.sh
+echo "status $?"
@@ -0,0 +1,13 @@
+echo "$0" "$@"
+read -r line
+echo "read: $line"
+greet() {
+    echo "hello $1" | tr a-z A-Z
+}
+for name in "$@"; do
+    greet "$name"
+done
+false
+echo "status $?"
+exit 4
+echo "not reached"
@@ -0,0 +1,8 @@
+## Regions in the main shell, in a background job, and in a subshell
+for i in 1 2 3; do
+    echo "iteration $i" | cat
+done
+{ echo job | cat; } &
+wait
+( echo subshell | tr a-z A-Z )
+false || echo failed